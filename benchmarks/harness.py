@@ -0,0 +1,95 @@
+"""Measurement helpers shared by the benchmark suite."""
+
+import sys
+import time
+import tracemalloc
+from typing import Callable
+
+
+class MemorySocket:
+    """In-memory stand-in for a connected socket.
+
+    What is sent is kept and handed to recv/recv_into, so CDProto can be
+    driven end to end without the kernel (and without blocking on a full
+    socket buffer). With discard, sent data is dropped, like a subscriber
+    that reads instantly.
+    """
+
+    def __init__(self, discard: bool = False):
+        self.discard = discard
+        self.sent = 0
+        self._buffer = bytearray()
+        self._start = 0
+
+    def send(self, data) -> int:
+        self.sent += len(data)
+        if not self.discard:
+            self._buffer += data
+        return len(data)
+
+    sendall = send
+
+    def recv(self, size: int) -> bytes:
+        data = bytes(self._buffer[self._start : self._start + size])
+        self._start += len(data)
+        if self._start == len(self._buffer):
+            self._buffer.clear()
+            self._start = 0
+        return data
+
+    def recv_into(self, view) -> int:
+        data = self.recv(len(view))
+        view[: len(data)] = data
+        return len(data)
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    """Returns the value below which fraction of the sorted samples lie."""
+    index = min(len(ordered) - 1, int(fraction * len(ordered)))
+    return ordered[index]
+
+
+def measure(operation: Callable[[], object], iterations: int) -> dict:
+    """Run operation repeatedly and summarize its cost.
+
+    ops_per_sec comes from an untimed-per-call loop; the latency
+    percentiles (microseconds) from timing every call of a second loop.
+    peak_bytes is the most memory traced while one call runs, and
+    blocks_per_op the allocated blocks still alive per call afterwards
+    (anything above 0 is kept around, e.g. in caches or a leak).
+    """
+    operation()
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        operation()
+    ops_per_sec = iterations / (time.perf_counter() - start)
+
+    samples = []
+    clock = time.perf_counter_ns
+    for _ in range(iterations):
+        started = clock()
+        operation()
+        samples.append((clock() - started) / 1000)
+    samples.sort()
+
+    blocks = sys.getallocatedblocks()
+    for _ in range(iterations):
+        operation()
+    blocks_per_op = (sys.getallocatedblocks() - blocks) / iterations
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    operation()
+    peak_bytes = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    return {
+        "ops_per_sec": round(ops_per_sec, 1),
+        "p50_us": round(percentile(samples, 0.5), 2),
+        "p90_us": round(percentile(samples, 0.9), 2),
+        "p99_us": round(percentile(samples, 0.99), 2),
+        "peak_bytes": peak_bytes,
+        "blocks_per_op": round(blocks_per_op, 3),
+    }
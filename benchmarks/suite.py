@@ -0,0 +1,335 @@
+"""In-process benchmark suite: codecs, CDProto framing, topic and broker routing.
+
+Prints one JSON document with a result per case, e.g.
+
+    python -m benchmarks.suite --output after.json --baseline before.json
+
+With --baseline, the ops/sec of every case is also compared to a previous
+run and printed to stderr, so regressions between commits stand out.
+"""
+
+import argparse
+import json
+import platform
+import random
+import os
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+from typing import Iterator
+
+from benchmarks.harness import MemorySocket, measure
+from src.broker import Broker
+from src.consts import Command, MiddlewareType, Serializer
+from src.middleware import PickleQueue
+from src.protocol import CDProto
+from src.topics import TopicTrie
+from src.utils import encoder_map
+
+# keys of a result that are measurements rather than parameters
+METRICS = (
+    "ops_per_sec",
+    "p50_us",
+    "p90_us",
+    "p99_us",
+    "peak_bytes",
+    "blocks_per_op",
+    "encoded_bytes",
+    "message_bytes",
+)
+
+# typical messages, beside the random text payloads of every size
+MESSAGES = {
+    "int": {"command": Command.PUBLISH.value, "topic": "/temp", "message": 21},
+    "text": {
+        "command": Command.PUBLISH.value,
+        "topic": "/msg",
+        "message": "Ó mar salgado, quanto do teu sal",
+    },
+    "batch": {
+        "command": Command.PUBLISH_BATCH.value,
+        "topic": "/weather2/humidity",
+        "messages": list(range(100)),
+    },
+}
+
+
+def _payload(size: int) -> str:
+    return "".join(random.choices(string.ascii_letters, k=size))
+
+
+def _topics(count: int, depth: int) -> list[str]:
+    topics = set()
+    while len(topics) < count:
+        topics.add(
+            "".join(
+                "/" + "".join(random.choices(string.ascii_lowercase, k=4))
+                for _ in range(depth)
+            )
+        )
+    return sorted(topics)
+
+
+def codec_cases(sizes: list[int], iterations: int) -> Iterator[dict]:
+    """encode and decode with every entry of encoder_map.
+
+    The messages are a PUBLISH of text of every size, and the MESSAGES.
+    """
+    messages = {
+        size: {
+            "command": Command.PUBLISH.value,
+            "topic": "/weather2/humidity",
+            "message": _payload(size),
+        }
+        for size in sizes
+    }
+    messages.update(MESSAGES)
+    for name, message in messages.items():
+        for serializer, codec in encoder_map.items():
+            body = memoryview(bytes(codec.encode(message)))
+            params = {
+                "serializer": serializer.name,
+                ("payload" if isinstance(name, int) else "message"): name,
+            }
+            yield {
+                "case": "codec.encode",
+                **params,
+                **measure(lambda: codec.encode(message), iterations),
+                "encoded_bytes": len(body),
+            }
+            yield {
+                "case": "codec.decode",
+                **params,
+                **measure(lambda: codec.decode(body), iterations),
+            }
+
+
+def protocol_cases(sizes: list[int], iterations: int) -> Iterator[dict]:
+    """CDProto.send_msg followed by recv_msg through an in-memory socket.
+
+    protocol.message is the encode_msg and decode_msg of a small PUBLISH
+    alone, with the size of the decoded message.
+    """
+    for serializer in Serializer:
+        body = memoryview(
+            CDProto.encode_msg(Command.PUBLISH, serializer, "/weather2/humidity", 42)
+        )[4:]
+
+        def message():
+            CDProto.encode_msg(Command.PUBLISH, serializer, "/weather2/humidity", 42)
+            return CDProto.decode_msg(serializer, body)
+
+        msg = message()
+        yield {
+            "case": "protocol.message",
+            "serializer": serializer.name,
+            **measure(message, iterations),
+            "message_bytes": sys.getsizeof(msg)
+            + sys.getsizeof(getattr(msg, "__dict__", None) or 0),
+        }
+
+    for size in sizes:
+        payload = _payload(size)
+        for serializer in Serializer:
+            sock = MemorySocket()
+
+            def round_trip():
+                CDProto.send_msg(
+                    sock, Command.PUBLISH, serializer, "/weather2/humidity", payload
+                )
+                return CDProto.recv_msg(sock)
+
+            yield {
+                "case": "protocol.round_trip",
+                "serializer": serializer.name,
+                "payload": size,
+                **measure(round_trip, iterations),
+            }
+
+
+def topic_cases(
+    depths: list[int], counts: list[int], iterations: int
+) -> Iterator[dict]:
+    """Routing a publish through a TopicTrie alone, without the broker.
+
+    Every level has one subscriber, as with the /weather2 consumers, and a
+    publish walks the subscribers of its topic's lineage.
+    """
+    for count in counts:
+        for depth in depths:
+            trie = TopicTrie()
+            topics = _topics(count, depth)
+            for topic in topics:
+                for node in trie.insert(topic).lineage():
+                    if not node.subscribers:
+                        node.subscribers[object()] = None
+
+            sample = iter(random.choices(topics, k=4 * iterations + 1))
+
+            def route():
+                for level in trie.insert(next(sample)).lineage():
+                    for _ in level.subscribers:
+                        pass
+
+            yield {
+                "case": "topics.route",
+                "topics": count,
+                "depth": depth,
+                **measure(route, iterations),
+            }
+
+
+def broker_cases(
+    sizes: list[int],
+    fanouts: list[int],
+    depths: list[int],
+    counts: list[int],
+    iterations: int,
+) -> Iterator[dict]:
+    """Broker.publish of a random topic, fanned out to in-memory subscribers.
+
+    Each topic has fanout subscribers on its leaf, spread over the
+    serializers; their sockets drop what they get, so only routing and
+    encoding are measured.
+    """
+    for count in counts:
+        for depth in depths:
+            topics = _topics(count, depth)
+            for fanout in fanouts:
+                broker = Broker(port=0)
+                for topic in topics:
+                    for i in range(fanout):
+                        serializer = list(Serializer)[i % len(Serializer)]
+                        broker.subscribe(topic, MemorySocket(discard=True), serializer)
+
+                for size in sizes:
+                    payload = _payload(size)
+                    sample = iter(random.choices(topics, k=4 * iterations + 1))
+                    result = measure(
+                        lambda: broker.publish(next(sample), payload), iterations
+                    )
+                    yield {
+                        "case": "broker.publish",
+                        "topics": count,
+                        "depth": depth,
+                        "fanout": fanout,
+                        "payload": size,
+                        **result,
+                    }
+                broker.socket.close()
+
+
+def transport_cases(sizes: list[int], iterations: int) -> Iterator[dict]:
+    """push and pull of a publish through a live broker, over TCP and Unix.
+
+    The broker runs in a thread of this process, so the numbers include
+    both ends of the round trip; only the transport differs between them.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "broker.sock")
+        broker = Broker(port=0, unix_path=path)
+        threading.Thread(target=broker.run, daemon=True).start()
+        addresses = {
+            "tcp": "tcp://%s:%d" % broker.socket.getsockname(),
+            "unix": f"unix://{path}",
+        }
+
+        for name, address in addresses.items():
+            consumer = PickleQueue("/bench", MiddlewareType.CONSUMER, address=address)
+            producer = PickleQueue("/bench", MiddlewareType.PRODUCER, address=address)
+            for size in sizes:
+                payload = _payload(size)
+
+                def round_trip():
+                    producer.push(payload)
+                    return consumer.pull()
+
+                yield {
+                    "case": "transport.round_trip",
+                    "transport": name,
+                    "payload": size,
+                    **measure(round_trip, iterations),
+                }
+            consumer.close()
+            producer.close()
+        broker.canceled = True
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def _params(result: dict) -> tuple:
+    return tuple((k, v) for k, v in result.items() if k not in METRICS)
+
+
+def compare(results: list[dict], baseline: list[dict]):
+    """Print the ops/sec of results relative to a baseline run."""
+    previous = {_params(result): result for result in baseline}
+    for result in results:
+        before = previous.get(_params(result))
+        if before is None:
+            continue
+        ratio = result["ops_per_sec"] / before["ops_per_sec"]
+        params = " ".join(f"{k}={v}" for k, v in _params(result)[1:])
+        print(f"{ratio:6.2f}x {result['case']} {params}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=2_000)
+    parser.add_argument("--payloads", type=int, nargs="+", default=[16, 1024, 65536])
+    parser.add_argument("--fanouts", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--counts", type=int, nargs="+", default=[10, 10_000])
+    parser.add_argument(
+        "--only",
+        choices=["codec", "protocol", "topics", "broker", "transport"],
+        nargs="+",
+        default=None,
+    )
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    parser.add_argument("--baseline", help="JSON of a previous run to compare to")
+    args = parser.parse_args()
+
+    random.seed(0)
+    groups = {
+        "codec": lambda: codec_cases(args.payloads, args.iterations),
+        "protocol": lambda: protocol_cases(args.payloads, args.iterations),
+        "topics": lambda: topic_cases(args.depths, args.counts, args.iterations),
+        "broker": lambda: broker_cases(
+            args.payloads, args.fanouts, args.depths, args.counts, args.iterations
+        ),
+        "transport": lambda: transport_cases(args.payloads, args.iterations),
+    }
+    results = []
+    for name, cases in groups.items():
+        if args.only is None or name in args.only:
+            results.extend(cases())
+
+    report = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "iterations": args.iterations,
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(results, json.load(file)["results"])
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
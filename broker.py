@@ -1,7 +1,69 @@
 """Call broker."""
+import argparse
 
 from src.broker import Broker
+from src.federation import FederatedBroker
+from src.sharding import ShardedBroker
 
 if __name__ == "__main__":
-    broker = Broker()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", help="port to listen on", type=int, default=5000)
+    parser.add_argument(
+        "--workers",
+        help="number of processes, each owning part of the root topics",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--store",
+        help="file keeping the last value of every topic across restarts",
+        default=None,
+    )
+    parser.add_argument(
+        "--unix",
+        help="path of a Unix domain socket to listen on as well, for local clients",
+        default=None,
+    )
+    parser.add_argument(
+        "--no-tcp",
+        help="only listen on the Unix domain socket",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--peer",
+        help="address of a broker to federate with (tcp://host:port), repeatable",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--name",
+        help="name of this broker among its federated peers",
+        default=None,
+    )
+    args = parser.parse_args()
+    if args.no_tcp and not args.unix:
+        parser.error("--no-tcp requires --unix")
+    if args.workers > 1:
+        for option, value in (
+            ("--unix", args.unix),
+            ("--no-tcp", args.no_tcp),
+            ("--peer", args.peer),
+            ("--name", args.name),
+        ):
+            if value:
+                parser.error(f"{option} can't be used with --workers")
+    port = None if args.no_tcp else args.port
+
+    if args.workers > 1:
+        broker = ShardedBroker(args.workers, port=args.port, store_path=args.store)
+    elif args.peer or args.name:
+        broker = FederatedBroker(
+            name=args.name,
+            peers=args.peer,
+            port=port,
+            store_path=args.store,
+            unix_path=args.unix,
+        )
+    else:
+        broker = Broker(port=port, store_path=args.store, unix_path=args.unix)
     broker.run()
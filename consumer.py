@@ -19,8 +19,17 @@ if __name__ == "__main__":
         choices=list(q_protocol.keys()),
         default=list(q_protocol.keys())[0],
     )
+    parser.add_argument(
+        "--batch", help="number of messages handled at once", type=int, default=1
+    )
+    parser.add_argument(
+        "--prefetch",
+        help="messages read ahead in the background (0 disables it)",
+        type=int,
+        default=0,
+    )
     args = parser.parse_args()
 
-    c = Consumer(args.topic, q_protocol[args.queue_type])
+    c = Consumer(args.topic, q_protocol[args.queue_type], args.prefetch)
 
-    c.run(int(args.length))
+    c.run(int(args.length), args.batch)
@@ -1,38 +1,126 @@
 """Message Broker"""
 
+import asyncio
+import contextlib
 import selectors
 import socket
-from typing import List, Tuple, Union
+import time
+from collections import deque
+from typing import Iterable, List, Optional, Union
 
-from src.consts import Serializer, Command
+from src.consts import Backpressure, FrameFlag, Serializer, Command
 from src.protocol import (
+    COMPRESS_THRESHOLD,
+    COMPRESSIONS,
+    Ack,
     CDProto,
+    CDProtoBadFormat,
+    FrameReader,
+    Hello,
+    Message,
     SubscribeTopic,
+    PublishBatch,
     PublishMessage,
+    Stats,
     TopicList,
     UnsubscribeTopic,
 )
+from src import transport
+from src.delivery import DEFAULT_WINDOW, Delivery
+from src.history import History
+from src.log import MessageLog, get_logger
+from src.metrics import Metrics
+from src.store import RetainedStore
+from src.topics import TopicNode, TopicTrie, is_pattern, subscriber_type
 
-subscriber_type = tuple[socket.socket, Serializer]
-topic_type = tuple[list[subscriber_type], str]
+# bytes of history moved into a connection's outbound buffer at a time
+REPLAY_CHUNK = 64 * 1024
 
 
 class Broker:
     """Implementation of a PubSub Message Broker."""
 
-    def __init__(self):
-        """Initialize broker."""
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: Optional[int] = 5000,
+        high_water_mark: int = 4 * 1024 * 1024,
+        backpressure: Backpressure = Backpressure.DISCONNECT,
+        sock: Optional[socket.socket] = None,
+        store_path: Optional[str] = None,
+        history: int = 0,
+        history_bytes: int = 256 * 1024,
+        stats_interval: Optional[float] = None,
+        unix_path: Optional[str] = None,
+        delivery_limit: int = 1000,
+        session_expiry: Optional[float] = 3600.0,
+    ):
+        """Initialize broker.
+
+        Every connection gets an outbound buffer; once a subscriber has more
+        than high_water_mark bytes pending, new frames for it are either
+        dropped (SHED) or the connection is closed (DISCONNECT).
+
+        sock is an already listening socket to accept from instead of binding
+        host and port, e.g. one shared by several worker processes.
+
+        With unix_path, the broker also listens on a Unix domain socket at
+        that path, for clients on the same host; with port None as well, it
+        only listens there.
+
+        store_path is the file of a RetainedStore keeping the last value of
+        every topic across restarts; without it values only live in memory.
+
+        With history > 0, every topic level keeps its last history published
+        frames (up to history_bytes of them), and publishes carry a sequence
+        number, so subscribers can ask for the last N messages or for the
+        ones since a sequence number they saw.
+
+        The broker keeps Metrics about itself, answered to the STATS command;
+        with stats_interval, they are also published every stats_interval
+        seconds on "$SYS/broker/..." topics.
+
+        Reliable subscriptions (see Delivery) keep their messages until they
+        are acknowledged. Once one holds delivery_limit of them, connections
+        publishing to it are no longer read from, until it is down to half
+        of that. A subscription without a connection holds up no one: it
+        keeps its last delivery_limit messages, and ends after
+        session_expiry seconds (never if None).
+        """
         self.canceled = False
-        self._host = "localhost"
-        self._port = 5000
+        self._host = host
+        self._port = port
+        self.high_water_mark = high_water_mark
+        self.backpressure = backpressure
+        self.history = history
+        self.history_bytes = history_bytes
+        self.delivery_limit = delivery_limit
+        self.session_expiry = session_expiry
+        self._expiry_at = time.monotonic()
+        self.metrics = Metrics()
+        self.logger = get_logger("broker")
+        # per-message records, rate limited
+        self._messages = MessageLog(self.logger)
+        self.stats_interval = stats_interval
+        self._stats_at = time.monotonic() + (stats_interval or 0)
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind((self._host, self._port))
-        self.socket.listen(100)
+        if sock is None and port is not None:
+            sock = transport.listen((self._host, self._port))
+        self.unix_path = unix_path
+        self.unix_socket: Optional[socket.socket] = None
+        if unix_path is not None:
+            self.unix_socket = transport.listen(f"unix://{unix_path}")
+        if sock is None and self.unix_socket is None:
+            raise ValueError("Broker needs a port, sock or unix_path to listen on")
+        # the TCP socket, or the Unix one when that's the only one
+        self.socket = sock if sock is not None else self.unix_socket
+        self.listening = [self.socket]
+        if self.unix_socket is not None and self.unix_socket is not self.socket:
+            self.listening.append(self.unix_socket)
 
         self.sel = selectors.DefaultSelector()
-        self.sel.register(self.socket, selectors.EVENT_READ, self.accept)
+        for listening in self.listening:
+            self.sel.register(listening, selectors.EVENT_READ, self.accept)
 
         """ publish com id = "root/node_id/leaf_id" 
         nome já diz o percurso
@@ -43,120 +131,926 @@ class Broker:
         """
 
         """
-        {
-          "hello": (
-            [
-              (socket1, Serializer.JSON),
-              (socket2, Serializer.XML),
-              ...
-            ],
-            "abcd"
-          )
-          
-        }
-        
-        JSON equivalent:
-        {
-          "hello": {
-            "subscribers": [
-              {
-                "address": socket1,
-                "serializer": Serializer.JSON
-              },
-              {
-                "address": socket2,
-                "serializer": Serializer.XML
-              },
-              ...
-            ],
-            "last_value": "abcd"
-          }
-        }
+        Topics are kept in a trie (see src/topics.py); each node stores its
+        subscribers, e.g. {socket1: Serializer.JSON, socket2: Serializer.XML},
+        and the last published value. A publish looks its node up once and
+        walks the parent links to reach every ancestor's subscribers.
         """
-        self.topics: dict[str, topic_type] = {}
+        self.topics = TopicTrie()
+        # subscriptions to patterns with "+"/"#" levels, matched on publish
+        self.wildcards = TopicTrie()
+        self.store: Optional[RetainedStore] = None
+        if store_path is not None:
+            self.store = RetainedStore(store_path)
+            for topic, value in self.store.items():
+                node = self.topics.insert(topic)
+                node.value = value
+                node.has_value = True
+
+        # pending outbound bytes per connection; None marks a connection that
+        # overflowed and is closed at the end of the current tick
+        self._outbox: dict[socket.socket, Optional[bytearray]] = {}
+        self._dirty: set[socket.socket] = set()
+        self._readers: dict[socket.socket, FrameReader] = {}
+        # reverse index: the topic nodes each connection is subscribed to
+        self._subscriptions: dict[socket.socket, set[TopicNode]] = {}
+        # history still to be replayed per connection: [node, next seq, format]
+        self._replays: dict[socket.socket, deque[list]] = {}
+        # compression negotiated by the connections that sent a Hello
+        self._compression: dict[socket.socket, FrameFlag] = {}
+        # subscriptions that only want the latest value, per connection
+        self._conflated: dict[socket.socket, set[TopicNode]] = {}
+        # frames held back per connection while its output is pending, the
+        # latest per (conflated subscription, published topic)
+        self._latest: dict[socket.socket, dict[tuple[TopicNode, TopicNode], bytes]] = {}
+        # reliable subscriptions by (client, topic), and by attached connection
+        self._sessions: dict[tuple[str, str], Delivery] = {}
+        self._deliveries: dict[socket.socket, dict[str, Delivery]] = {}
+        # attached reliable subscriptions holding delivery_limit messages or
+        # more, with the connections not read from until they catch up, and
+        # the same by connection
+        self._lagging: dict[Delivery, set[socket.socket]] = {}
+        self._paused: dict[socket.socket, set[Delivery]] = {}
+        # the subscriptions that handling a message made lag
+        self._congested: list[Delivery] = []
 
     def accept(self, sock: socket.socket):
-        conn, _ = sock.accept()
+        try:
+            conn, _ = sock.accept()
+        except BlockingIOError:
+            # another process sharing the socket accepted it first
+            return
+        self.register(conn)
+
+    def register(self, conn: socket.socket):
+        """Start serving a connected socket."""
         conn.setblocking(False)
         self.sel.register(conn, selectors.EVENT_READ, self.read)
+        self._outbox[conn] = bytearray()
+        self._readers[conn] = FrameReader(compressions=FrameFlag.NONE)
+        self.metrics.connected()
 
-    def read(self, conn: socket.socket):
-        msg = CDProto.recv_msg(conn)
+    def disconnect(self, conn: socket.socket):
+        """Drop every subscription of conn and close it."""
+        [
+            self.unsubscribe(node.name, conn)
+            for node in list(self._subscriptions.get(conn, ()))
+        ]
+        self._outbox.pop(conn, None)
+        if self._readers.pop(conn, None) is not None:
+            self.metrics.disconnected()
+        self._replays.pop(conn, None)
+        self._compression.pop(conn, None)
+        self._latest.pop(conn, None)
+        self._detach(conn)
+        self._unpause(conn)
+        self._dirty.discard(conn)
+        if conn in self.sel.get_map():
+            self.sel.unregister(conn)
+        conn.close()
 
-        if msg is None:
-            [self.unsubscribe(topic, conn) for topic in self.topics]
+    def send(self, conn: socket.socket, frame: bytes):
+        """Queue an encoded frame for conn; it is written at the end of the tick."""
+        if conn not in self._outbox:
+            # not a connection accepted by this broker, write it straight away
+            CDProto.send_frame(conn, frame)
+            self.metrics.bytes_out += len(frame)
+            return
+
+        buffer = self._outbox[conn]
+        if buffer is None:
+            return
+        if buffer and len(buffer) + len(frame) > self.high_water_mark:
+            if self.backpressure == Backpressure.DISCONNECT:
+                self._outbox[conn] = None
+                self._dirty.add(conn)
+            return
+
+        buffer += frame
+        self._dirty.add(conn)
+
+    def _send_latest(
+        self,
+        conn: socket.socket,
+        subscription: TopicNode,
+        node: TopicNode,
+        frame: bytes,
+    ):
+        """Send frame, or hold it in place of the previous one of node.
+
+        Each subscription (a level or a pattern) keeps its own, as the
+        frames differ in topic and one doesn't stand in for the other.
+        """
+        if not self._outbox.get(conn):
+            self.send(conn, frame)
+            return
+        self._latest.setdefault(conn, {})[subscription, node] = frame
+        self._dirty.add(conn)
+
+    def write(self, conn: socket.socket):
+        """Write as much of the outbound buffer of conn as the socket takes.
+
+        A history replay is moved into the buffer a chunk at a time, as the
+        socket drains it, so it never holds up the other connections.
+        """
+        buffer = self._outbox.get(conn)
+        if buffer is None:
+            if conn in self._outbox:
+                self.disconnect(conn)
+            return
+        if conn in self._replays and len(buffer) < REPLAY_CHUNK:
+            self._replay(conn, buffer)
+
+        try:
+            sent = conn.send(buffer) if buffer else 0
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.disconnect(conn)
+            return
+        del buffer[:sent]
+        self.metrics.bytes_out += sent
+        if not buffer and conn in self._latest:
+            for frame in self._latest.pop(conn).values():
+                buffer += frame
+
+        pending = buffer or conn in self._replays or conn in self._latest
+        events = 0 if conn in self._paused else selectors.EVENT_READ
+        if pending:
+            events |= selectors.EVENT_WRITE
+        key = self.sel.get_map().get(conn)
+        if key is None:
+            if events:
+                self.sel.register(conn, events, self.read)
+        elif not events:
             self.sel.unregister(conn)
-            conn.close()
+        elif key.events != events:
+            self.sel.modify(conn, events, self.read)
+
+    def flush(self):
+        """Write the frames queued during this tick, one send per connection."""
+        while self._dirty:
+            self.write(self._dirty.pop())
+        if self.store is not None:
+            self.store.commit()
+
+    def read(self, conn: socket.socket):
+        """Handle every complete frame conn has sent so far."""
+        reader = self._readers[conn]
+        try:
+            received = reader.recv(conn)
+        except BlockingIOError:
+            return
+        except OSError:
+            received = 0
+
+        if not received:
+            self.disconnect(conn)
             return
+        self.metrics.bytes_in += received
 
-        msg, serializer = msg
+        try:
+            for serializer, body in reader:
+                self._handle_frame(conn, serializer, body)
+                if conn not in self._readers:
+                    return
+        except CDProtoBadFormat:
+            self.disconnect(conn)
 
-        if isinstance(msg, SubscribeTopic):
-            self.subscribe(msg.topic, conn, serializer)
-            print("1:", msg.topic, serializer)
+    def _handle_frame(self, conn, serializer: Serializer, body: memoryview):
+        """Decode and handle one frame, timing it for the metrics."""
+        started = time.perf_counter_ns()
+        msg = CDProto.decode_msg(serializer, body)
+        self._congested.clear()
+        self.handle(conn, msg, serializer)
+        if self._congested:
+            # stop reading what conn sends until the subscriptions catch up
+            self._hold(conn, self._congested)
+        self.metrics.handled(
+            msg.command.value, serializer, time.perf_counter_ns() - started
+        )
+
+    def handle(self, conn: socket.socket, msg: Message, serializer: Serializer):
+        """Act on a message received from conn."""
+        if isinstance(msg, SubscribeTopic) and msg.client is not None:
+            self.subscribe_reliable(
+                msg.topic, conn, serializer, msg.client, msg.window or DEFAULT_WINDOW
+            )
+            self.logger.info(
+                "subscribe %s (%s, client %s)", msg.topic, serializer.name, msg.client
+            )
+        elif isinstance(msg, SubscribeTopic):
+            self.subscribe(msg.topic, conn, serializer, msg.last, msg.since)
+            if msg.conflate:
+                self.conflate(msg.topic, conn)
+            self.logger.info("subscribe %s (%s)", msg.topic, serializer.name)
         elif isinstance(msg, PublishMessage):
-            self.put_topic(msg.topic, msg.message)
-            print("2:", msg.topic)
-            topic = msg.topic.split("/")
-            while topic:
-                msg.topic = "/".join(topic)
-                for subscriber, _serializer in self.list_subscriptions(msg.topic):
-                    CDProto.send_msg(
-                        subscriber, Command.PUBLISH, _serializer, msg.topic, msg.message
-                    )
-                topic.pop()
+            self.publish(msg.topic, msg.message)
+            self._messages.debug("publish %s", msg.topic)
+        elif isinstance(msg, PublishBatch):
+            self.publish_batch(msg.topic, msg.messages)
+            self._messages.debug("publish %s (%d)", msg.topic, len(msg.messages))
         elif isinstance(msg, TopicList):
-            CDProto.send_msg(
-                conn, Command.TOPIC_LIST_SUCCESS, serializer, message=self.list_topics()
+            self.send(
+                conn,
+                CDProto.encode_msg(
+                    Command.TOPIC_LIST_SUCCESS,
+                    serializer,
+                    message=self.list_topics(),
+                    compression=self._compression.get(conn, FrameFlag.NONE),
+                ),
             )
+        elif isinstance(msg, Ack):
+            self.ack(conn, msg.topic, msg.message)
         elif isinstance(msg, UnsubscribeTopic):
-            self.unsubscribe(msg.topic, conn)
+            if msg.topic in self._deliveries.get(conn, ()):
+                self.end_session(self._deliveries[conn][msg.topic])
+            else:
+                self.unsubscribe(msg.topic, conn)
+        elif isinstance(msg, Stats):
+            self.send(
+                conn,
+                CDProto.encode_msg(
+                    Command.STATS_SUCCESS,
+                    serializer,
+                    message=self.stats(),
+                    compression=self._compression.get(conn, FrameFlag.NONE),
+                ),
+            )
+        elif isinstance(msg, Hello):
+            self.send(
+                conn,
+                CDProto.encode_msg(
+                    Command.HELLO, serializer, message=self.negotiate(conn, msg)
+                ),
+            )
+
+    def negotiate(self, conn: socket.socket, msg: Hello) -> str:
+        """Picks the first compression of msg supported here, "" if none.
+
+        Frames of at least COMPRESS_THRESHOLD bytes sent to conn from then
+        on are compressed with it, and conn may send frames compressed with
+        it (other compressed frames are rejected).
+        """
+        for name in msg.message.split(","):
+            compression = COMPRESSIONS.get(name.strip())
+            if compression is not None:
+                self._compression[conn] = compression
+                self._accept_compressed(conn, compression)
+                return name.strip()
+        self._compression.pop(conn, None)
+        self._accept_compressed(conn, FrameFlag.NONE)
+        return ""
+
+    def _accept_compressed(self, conn: socket.socket, compression: FrameFlag):
+        reader = self._readers.get(conn)
+        if reader is not None:
+            reader.compressions = compression
+
+    def _compressed(self, frames: dict, serializer: Serializer, conn) -> bytes:
+        """The frame of serializer compressed as conn negotiated, made once."""
+        compression = self._compression[conn]
+        frame = frames.get((serializer, compression))
+        if frame is None:
+            frame = frames[serializer, compression] = CDProto.compress(
+                frames[serializer], compression
+            )
+        return frame
+
+    def publish(self, topic: str, value):
+        """Store value in topic and forward it to the topic's subscribers."""
+        self._fan_out(self.put_topic(topic, value), Command.PUBLISH, value)
+
+    def publish_batch(self, topic: str, values: list):
+        """Publish several values to topic as one unit.
+
+        Only the last value is retained, and each subscriber gets the whole
+        batch in a single frame.
+        """
+        if not values:
+            return
+        self._fan_out(self.put_topic(topic, values[-1]), Command.PUBLISH_BATCH, values)
+
+    def _fan_out(self, node: TopicNode, command: Command, message):
+        """Forward a publish on node to the subscribers of every level.
+
+        Subscribers of every level are grouped by serializer, so each distinct
+        frame is encoded once and the same bytes are sent to the whole group;
+        large frames are likewise compressed once per negotiated compression.
+        Subscribers of matching patterns get the publish under node's topic.
+        With history on, one of those frames is also kept in the level's
+        history (encoded as BINARY if the level has no subscribers).
+        """
+        sent = self.metrics.messages_out
+        fanout = 0
+        for level in node.lineage():
+            history = level.history
+            if history is None and self.history:
+                history = level.history = History(self.history, self.history_bytes)
+            seq = None if history is None else history.seq + 1
+
+            # by serializer, and by (serializer, compression) once compressed
+            frames: dict = {}
+            for subscriber, _serializer in level.subscribers.items():
+                if isinstance(subscriber, Delivery):
+                    self._deliver(subscriber, command, level.name, message)
+                    continue
+                frame = frames.get(_serializer)
+                if frame is None:
+                    frame = frames[_serializer] = CDProto.encode_msg(
+                        command, _serializer, level.name, message, seq=seq
+                    )
+                if len(frame) >= COMPRESS_THRESHOLD and subscriber in self._compression:
+                    frame = self._compressed(frames, _serializer, subscriber)
+                if (
+                    subscriber in self._conflated
+                    and level in self._conflated[subscriber]
+                ):
+                    self._send_latest(subscriber, level, node, frame)
+                else:
+                    self.send(subscriber, frame)
+                sent[_serializer] += 1
+            fanout += len(level.subscribers)
+
+            if history is not None:
+                if frames:
+                    _serializer, frame = next(iter(frames.items()))
+                else:
+                    _serializer = Serializer.BINARY
+                    frame = CDProto.encode_msg(
+                        command, _serializer, level.name, message, seq=seq
+                    )
+                history.append(seq, _serializer, frame)
+
+        matches = self.wildcards.match(node.name)
+        if matches:
+            seq = None if node.history is None else node.history.seq
+            frames = {}
+            for match in matches:
+                for subscriber, _serializer in match.subscribers.items():
+                    if isinstance(subscriber, Delivery):
+                        self._deliver(subscriber, command, node.name, message)
+                        continue
+                    frame = frames.get(_serializer)
+                    if frame is None:
+                        frame = frames[_serializer] = CDProto.encode_msg(
+                            command, _serializer, node.name, message, seq=seq
+                        )
+                    if (
+                        len(frame) >= COMPRESS_THRESHOLD
+                        and subscriber in self._compression
+                    ):
+                        frame = self._compressed(frames, _serializer, subscriber)
+                    if (
+                        subscriber in self._conflated
+                        and match in self._conflated[subscriber]
+                    ):
+                        self._send_latest(subscriber, match, node, frame)
+                    else:
+                        self.send(subscriber, frame)
+                    sent[_serializer] += 1
+                fanout += len(match.subscribers)
+        self.metrics.fanout.record(fanout)
+
+    def stats(self) -> dict:
+        """Returns the metrics of the broker along with its current state."""
+        stats = self.metrics.snapshot()
+        pending = [len(buffer) for buffer in self._outbox.values() if buffer]
+        stats["outbox"] = {
+            "bytes": sum(pending),
+            "max": max(pending, default=0),
+            "replays": len(self._replays),
+        }
+        stats["sessions"] = {
+            "count": len(self._sessions),
+            "unacked": sum(len(delivery) for delivery in self._sessions.values()),
+            "paused": len(self._paused),
+            "dropped": sum(delivery.dropped for delivery in self._sessions.values()),
+        }
+        stats["topics"] = len(self.topics.topics())
+        stats["subscriptions"] = {
+            node.name: len(node.subscribers)
+            for trie in (self.topics, self.wildcards)
+            for node in trie
+            if node.subscribers
+        }
+        return stats
+
+    def _stats_due(self) -> Optional[float]:
+        if self.stats_interval is None:
+            return None
+        return max(0.0, self._stats_at - time.monotonic())
+
+    def publish_stats(self):
+        """Publish stats() on "$SYS/broker/<key>" topics, one per key."""
+        self._stats_at = time.monotonic() + (self.stats_interval or 0)
+        for key, value in self.stats().items():
+            node = self.topics.insert(f"$SYS/broker/{key}")
+            node.value = value
+            node.has_value = True
+            self._fan_out(node, Command.PUBLISH, value)
+
+    def _expiry_due(self) -> Optional[float]:
+        if self.session_expiry is None:
+            return None
+        return max(0.0, self._expiry_at - time.monotonic())
+
+    def expire_sessions(self):
+        """End the reliable subscriptions detached for session_expiry or more."""
+        now = time.monotonic()
+        self._expiry_at = now + min(1.0, self.session_expiry)
+        for delivery in list(self._sessions.values()):
+            if (
+                delivery.detached_at is not None
+                and now - delivery.detached_at >= self.session_expiry
+            ):
+                self.logger.info(
+                    "session of %s on %s expired", delivery.client, delivery.topic
+                )
+                self.end_session(delivery)
+
+    def _timeout(self) -> Optional[float]:
+        """Seconds until the next periodic task, None if there is none."""
+        timeouts = [self._stats_due(), self._expiry_due()]
+        if self.store is not None:
+            timeouts.append(self.store.due())
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        return min(timeouts, default=None)
 
     def list_topics(self) -> List[str]:
         """Returns a list of strings containing all topics containing values."""
-        return list(self.topics.keys())
+        return self.topics.topics()
 
     def get_topic(self, topic) -> Union[str, None]:
         """Returns the currently stored value in topic."""
-        if topic not in self.topics:
+        node = self.topics.find(topic)
+        if node is None or not node.has_value:
             return None
-        return self.topics[topic][1]
+        return node.value
 
-    def put_topic(self, topic: str, value: str):
+    def put_topic(self, topic: str, value: str) -> TopicNode:
         """Store in topic the value."""
-        if topic not in self.topics:
-            self.topics[topic] = ([], value)
-            return
-        self.topics[topic] = self.topics[topic][0], value
+        node = self.topics.insert(topic)
+        node.value = value
+        node.has_value = True
+        if self.store is not None:
+            self.store.put(topic, value)
+        return node
+
+    def _trie(self, topic: str) -> TopicTrie:
+        return self.wildcards if is_pattern(topic) else self.topics
 
-    def list_subscriptions(self, topic: str) -> List[Tuple[socket.socket, Serializer]]:
-        """Provide list of subscribers to a given topic."""
-        if topic not in self.topics:
+    def list_subscriptions(self, topic: str) -> List[subscriber_type]:
+        """Provide list of subscribers to a given topic (or pattern)."""
+        node = self._trie(topic).find(topic)
+        if node is None:
             return []
-        return self.topics[topic][0]
-
-    def subscribe(self, topic: str, address: socket.socket, _format: Serializer = None):
-        """Subscribe to topic by client in address."""
-        if topic not in self.topics:
-            self.topics[topic] = ([], "")
-        self.topics[topic][0].append((address, _format))
-        if self.topics[topic][1] != "":
-            CDProto.send_msg(
-                address, Command.PUBLISH, _format, topic, self.topics[topic][1]
-            )
+        return list(node.subscribers.items())
+
+    def _add_subscriber(
+        self, node: TopicNode, address: socket.socket, _format: Serializer
+    ):
+        node.subscribers[address] = _format
+        self._subscriptions.setdefault(address, set()).add(node)
+
+    def subscribe(
+        self,
+        topic: str,
+        address: socket.socket,
+        _format: Serializer = None,
+        last: Optional[int] = None,
+        since: Optional[int] = None,
+    ):
+        """Subscribe to topic by client in address.
+
+        With last or since, the kept history of topic is replayed first (in
+        place of the retained value) and live publishes follow it.
+
+        topic can be a pattern with "+" and "#" levels (see topic_matches);
+        the client then gets the retained value of every matching topic and
+        the publishes to them, each under its own topic. last and since
+        don't apply to patterns.
+        """
+        if is_pattern(topic):
+            self._add_subscriber(self.wildcards.insert(topic), address, _format)
+            for node in self.topics.expand(topic):
+                if node.has_value:
+                    self._send_retained(node, address, _format)
+            return
+
+        node = self.topics.insert(topic)
+        if node.history is not None and (last is not None or since is not None):
+            start = node.history.seq - last + 1 if since is None else since + 1
+            self._subscriptions.setdefault(address, set()).add(node)
+            self._replays.setdefault(address, deque()).append([node, start, _format])
+            self._schedule_replay(address)
+            return
+
+        self._add_subscriber(node, address, _format)
+        if node.has_value:
+            self._send_retained(node, address, _format)
+
+    def conflate(self, topic: str, address: socket.socket):
+        """Only send address the latest value of topic while it lags behind.
+
+        Publishes to topic (or to the topics it matches) that find earlier
+        output to address still pending replace the one held back for the
+        same topic and subscription, so a slow subscriber costs at most a
+        frame per topic it is sent under.
+        """
+        node = self._trie(topic).find(topic)
+        if node is not None and node in self._subscriptions.get(address, ()):
+            self._conflated.setdefault(address, set()).add(node)
+
+    def _send_retained(
+        self, node: TopicNode, address: socket.socket, _format: Serializer
+    ):
+        seq = None if node.history is None else node.history.seq
+        self.send(
+            address,
+            CDProto.encode_msg(
+                Command.PUBLISH,
+                _format,
+                node.name,
+                node.value,
+                compression=self._compression.get(address, FrameFlag.NONE),
+                seq=seq,
+            ),
+        )
+
+    def _schedule_replay(self, conn: socket.socket):
+        self._dirty.add(conn)
+
+    def _replay(self, conn: socket.socket, out: bytearray):
+        """Move up to REPLAY_CHUNK bytes of the pending history of conn to out.
+
+        A replay that catches up with its topic turns into a subscription, so
+        no publish is missed or sent twice in between.
+        """
+        replays = self._replays[conn]
+        compression = self._compression.get(conn)
+        while replays and len(out) < REPLAY_CHUNK:
+            replay = replays[0]
+            node, seq, _format = replay
+            for seq, serializer, frame in node.history.since(seq):
+                if serializer != _format:
+                    frame = CDProto.transcode(frame, _format)
+                if compression and len(frame) >= COMPRESS_THRESHOLD:
+                    frame = CDProto.compress(frame, compression)
+                out += frame
+                replay[1] = seq + 1
+                if len(out) >= REPLAY_CHUNK:
+                    break
+            if replay[1] > node.history.seq:
+                replays.popleft()
+                self._add_subscriber(node, conn, _format)
+        if not replays:
+            del self._replays[conn]
 
     def unsubscribe(self, topic: str, address: socket.socket):
         """Unsubscribe to topic by client in address."""
-        self.topics[topic] = (
-            [client for client in self.topics[topic][0] if client[0] != address],
-            self.topics[topic][1],
+        node = self._trie(topic).find(topic)
+        if node is None:
+            return
+        replays = self._replays.get(address)
+        if replays:
+            pending = [replay for replay in replays if replay[0] is not node]
+            if len(pending) < len(replays):
+                replays.clear()
+                replays.extend(pending)
+                if not replays:
+                    del self._replays[address]
+                self._discard_subscription(node, address)
+        if address not in node.subscribers:
+            return
+        del node.subscribers[address]
+        self._discard_subscription(node, address)
+
+    def _discard_subscription(self, node: TopicNode, address: socket.socket):
+        conflated = self._conflated.get(address)
+        if conflated is not None:
+            conflated.discard(node)
+            if not conflated:
+                del self._conflated[address]
+        nodes = self._subscriptions[address]
+        nodes.discard(node)
+        if not nodes:
+            del self._subscriptions[address]
+
+    def subscribe_reliable(
+        self,
+        topic: str,
+        address: socket.socket,
+        _format: Serializer,
+        client: str,
+        window: int = DEFAULT_WINDOW,
+    ):
+        """Attach address to the reliable subscription of client to topic.
+
+        A new subscription starts with the retained value of topic (of every
+        topic matching it, for a pattern). An existing one, e.g. of a client
+        that reconnected, sends its unacknowledged messages again, and is
+        taken from the connection it was attached to, if any.
+        """
+        delivery = self._sessions.get((client, topic))
+        if delivery is None:
+            delivery = Delivery(client, topic, _format, window)
+            self._sessions[client, topic] = delivery
+            node = self._trie(topic).insert(topic)
+            nodes = self._retained_nodes(topic, node)
+            self._add_subscriber(node, delivery, _format)
+            for retained in nodes:
+                if retained.has_value:
+                    self._deliver(
+                        delivery, Command.PUBLISH, retained.name, retained.value
+                    )
+        elif delivery.conn is not None:
+            self._detach(delivery.conn, delivery)
+
+        delivery.serializer = _format
+        delivery.window = window
+        self._trie(topic).find(topic).subscribers[delivery] = _format
+        delivery.attach(address)
+        self._deliveries.setdefault(address, {})[topic] = delivery
+        self._pump(delivery)
+
+    def _retained_nodes(self, topic: str, node: TopicNode) -> Iterable[TopicNode]:
+        """Nodes whose values a new reliable subscription to topic starts with."""
+        return self.topics.expand(topic) if is_pattern(topic) else [node]
+
+    def _deliver(self, delivery: Delivery, command: Command, topic: str, message):
+        """Number a publish for a reliable subscription, sending it if it can."""
+        seq = delivery.seq + 1
+        frame = CDProto.encode_msg(
+            command, delivery.serializer, topic, message, seq=seq
         )
+        delivery.append(seq, delivery.serializer, frame)
+        if delivery.conn is None:
+            delivery.trim(self.delivery_limit)
+            return
+        if len(delivery) >= self.delivery_limit:
+            self._lagging.setdefault(delivery, set())
+            self._congested.append(delivery)
+        self._pump(delivery)
+
+    def _pump(self, delivery: Delivery):
+        """Send the messages of delivery its window has room for."""
+        conn = delivery.conn
+        if conn is None:
+            return
+        compression = self._compression.get(conn)
+        sent = self.metrics.messages_out
+        for _, serializer, frame in delivery.sendable():
+            if serializer != delivery.serializer:
+                frame = CDProto.transcode(frame, delivery.serializer)
+            if compression and len(frame) >= COMPRESS_THRESHOLD:
+                frame = CDProto.compress(frame, compression)
+            self._send_credited(conn, frame)
+            sent[delivery.serializer] += 1
+
+    def _send_credited(self, conn: socket.socket, frame: bytes):
+        """Queue a frame of a reliable subscription, never shed.
+
+        The window of the subscription bounds them, not high_water_mark.
+        """
+        buffer = self._outbox.get(conn)
+        if buffer is not None:
+            buffer += frame
+            self._dirty.add(conn)
+
+    def ack(self, conn: socket.socket, topic: str, seq: int):
+        """Acknowledge the messages of a reliable subscription up to seq."""
+        delivery = self._deliveries.get(conn, {}).get(topic)
+        if delivery is None:
+            return
+        delivery.ack(seq)
+        self._pump(delivery)
+        if delivery in self._lagging and len(delivery) <= self.delivery_limit // 2:
+            self._release(delivery)
+
+    def end_session(self, delivery: Delivery):
+        """Drop a reliable subscription, along with its unacked messages."""
+        del self._sessions[delivery.client, delivery.topic]
+        if delivery.conn is not None:
+            self._detach(delivery.conn, delivery)
+        self.unsubscribe(delivery.topic, delivery)
+        self._release(delivery)
+
+    def _detach(self, conn: socket.socket, delivery: Optional[Delivery] = None):
+        """Detach delivery (every reliable subscription if None) from conn.
+
+        The subscriptions keep their messages for the next connection of
+        their client.
+        """
+        deliveries = self._deliveries.get(conn)
+        if deliveries is None:
+            return
+        for topic in [delivery.topic] if delivery else list(deliveries):
+            detached = deliveries.pop(topic)
+            detached.detach()
+            # nobody may catch up with it now: stop holding up its publishers
+            detached.trim(self.delivery_limit)
+            self._release(detached)
+        if not deliveries:
+            del self._deliveries[conn]
+
+    def _hold(self, conn: socket.socket, deliveries: Iterable[Delivery]):
+        """Stop reading conn until every one of deliveries caught up."""
+        paused = conn in self._paused
+        for delivery in deliveries:
+            if delivery in self._lagging:
+                self._lagging[delivery].add(conn)
+                self._paused.setdefault(conn, set()).add(delivery)
+        if not paused and conn in self._paused:
+            self._pause(conn)
+
+    def _release(self, delivery: Delivery):
+        """Read again the connections only delivery held up."""
+        for conn in self._lagging.pop(delivery, ()):
+            waiting = self._paused[conn]
+            waiting.discard(delivery)
+            if not waiting:
+                del self._paused[conn]
+                self._resume(conn)
+
+    def _unpause(self, conn: socket.socket):
+        """Forget that conn was paused, e.g. as it disconnects."""
+        for delivery in self._paused.pop(conn, ()):
+            self._lagging[delivery].discard(conn)
+
+    def _pause(self, conn: socket.socket):
+        self._dirty.add(conn)
+
+    def _resume(self, conn: socket.socket):
+        self._dirty.add(conn)
 
     def run(self):
         """Run until canceled."""
 
         while not self.canceled:
-            events = self.sel.select()
-            for key, _ in events:
-                callback = key.data
-                callback(key.fileobj)
+            # wake up in time for the group commit and the stats
+            events = self.sel.select(self._timeout())
+            for key, mask in events:
+                if mask & selectors.EVENT_READ:
+                    callback = key.data
+                    callback(key.fileobj)
+                if mask & selectors.EVENT_WRITE:
+                    self.write(key.fileobj)
+            if self._stats_due() == 0:
+                self.publish_stats()
+            if self._expiry_due() == 0:
+                self.expire_sessions()
+            self.flush()
+        if self.store is not None:
+            self.store.close()
+        if self.unix_socket is not None:
+            self.unix_socket.close()
+            transport.unlink(self.unix_path, self.unix_socket)
+
+
+class AsyncBroker(Broker):
+    """Broker with the same topic semantics, driven by asyncio streams.
+
+    Connections are identified by their StreamWriter, which takes the place
+    of the socket in subscriptions. Outbound buffering is left to the
+    transport, whose write buffer is checked against high_water_mark; _outbox
+    only marks (with None) the connections that overflowed it, which are
+    closed once the current message is handled.
+    """
+
+    def disconnect(self, conn: asyncio.StreamWriter):
+        """Drop every subscription of conn and close it."""
+        [
+            self.unsubscribe(node.name, conn)
+            for node in list(self._subscriptions.get(conn, ()))
+        ]
+        if self._readers.pop(conn, None) is not None:
+            self.metrics.disconnected()
+        self._replays.pop(conn, None)
+        self._compression.pop(conn, None)
+        self._latest.pop(conn, None)
+        self._outbox.pop(conn, None)
+        self._detach(conn)
+        self._unpause(conn)
+        conn.close()
+
+    def send(self, conn: asyncio.StreamWriter, frame: bytes):
+        """Write an encoded frame to conn, applying backpressure."""
+        if conn not in self._readers:
+            CDProto.send_frame(conn, frame)
+            return
+        if conn in self._outbox:
+            return
+
+        pending = conn.transport.get_write_buffer_size()
+        if pending and pending + len(frame) > self.high_water_mark:
+            if self.backpressure == Backpressure.DISCONNECT:
+                # not right away: a fan-out may be iterating its subscription
+                self._outbox[conn] = None
+                asyncio.get_running_loop().call_soon(self.disconnect, conn)
+            return
+        conn.write(frame)
+        self.metrics.bytes_out += len(frame)
+
+    def _send_credited(self, conn: asyncio.StreamWriter, frame: bytes):
+        if conn in self._readers:
+            conn.write(frame)
+            self.metrics.bytes_out += len(frame)
+
+    def _pause(self, conn: asyncio.StreamWriter):
+        conn.transport.pause_reading()
+
+    def _resume(self, conn: asyncio.StreamWriter):
+        if not conn.transport.is_closing():
+            conn.transport.resume_reading()
+
+    def _send_latest(
+        self,
+        conn: asyncio.StreamWriter,
+        subscription: TopicNode,
+        node: TopicNode,
+        frame: bytes,
+    ):
+        if conn not in self._readers or not conn.transport.get_write_buffer_size():
+            self.send(conn, frame)
+            return
+        if conn not in self._latest:
+            asyncio.get_running_loop().create_task(self._drain_latest(conn))
+        self._latest.setdefault(conn, {})[subscription, node] = frame
+
+    async def _drain_latest(self, conn: asyncio.StreamWriter):
+        """Write the frames held back for conn once its buffer drained."""
+        try:
+            await conn.drain()
+        except ConnectionError:
+            return
+        for frame in self._latest.pop(conn, {}).values():
+            self.send(conn, frame)
+
+    def _schedule_replay(self, conn: asyncio.StreamWriter):
+        if conn in self._readers:
+            asyncio.get_running_loop().create_task(self._stream_replay(conn))
+
+    async def _stream_replay(self, conn: asyncio.StreamWriter):
+        """Write the pending history of conn a chunk at a time."""
+        try:
+            while conn in self._replays and conn in self._readers:
+                chunk = bytearray()
+                self._replay(conn, chunk)
+                conn.write(chunk)
+                await conn.drain()
+        except ConnectionError:
+            pass
+
+    async def serve_client(
+        self, stream: asyncio.StreamReader, conn: asyncio.StreamWriter
+    ):
+        """Handle the frames of one connection until it closes."""
+        reader = self._readers[conn] = FrameReader(compressions=FrameFlag.NONE)
+        self.metrics.connected()
+        try:
+            while conn in self._readers:
+                data = await stream.read(64 * 1024)
+                if not data:
+                    break
+                self.metrics.bytes_in += len(data)
+                reader.feed(data)
+                for serializer, body in reader:
+                    self._handle_frame(conn, serializer, body)
+                    if conn not in self._readers:
+                        return
+        except (CDProtoBadFormat, ConnectionError):
+            pass
+        finally:
+            if conn in self._readers:
+                self.disconnect(conn)
+
+    async def serve(self):
+        """Accept connections until canceled."""
+        async with contextlib.AsyncExitStack() as stack:
+            for sock in self.listening:
+                if sock.family == socket.AF_UNIX:
+                    start = asyncio.start_unix_server
+                else:
+                    start = asyncio.start_server
+                server = await start(self.serve_client, sock=sock)
+                await stack.enter_async_context(server)
+            while not self.canceled:
+                await asyncio.sleep(0.05)
+                if self.store is not None:
+                    self.store.commit()
+                if self._stats_due() == 0:
+                    self.publish_stats()
+                if self._expiry_due() == 0:
+                    self.expire_sessions()
+            for conn in list(self._readers):
+                self.disconnect(conn)
+        if self.store is not None:
+            self.store.close()
+        if self.unix_socket is not None:
+            self.unix_socket.close()
+            transport.unlink(self.unix_path, self.unix_socket)
+
+    def run(self):
+        """Run until canceled."""
+        asyncio.run(self.serve())
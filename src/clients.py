@@ -1,48 +1,109 @@
 """Prototype broker clients: consumer + producer."""
-from src.log import get_logger
+import time
+
+from src.log import MessageLog, get_logger
 from src.middleware import PickleQueue, MiddlewareType
 
 
 class Consumer:
     """Consumer implementation"""
 
-    def __init__(self, topic, queue_type=PickleQueue):
+    def __init__(self, topic, queue_type=PickleQueue, prefetch=0, shared=False):
         """Initialize Queue"""
         self.topic = topic
-        self.queue = queue_type(f"{topic}", _type=MiddlewareType.CONSUMER)
-        self.logger = get_logger(f"Consumer {topic}")
+        self.queue = queue_type(
+            f"{topic}", _type=MiddlewareType.CONSUMER, prefetch=prefetch, shared=shared
+        )
+        self.logger = get_logger(f"consumer.{topic}")
+        self.messages = MessageLog(self.logger)
         self.received = []
 
-    def run(self, events=10):
-        """Consume at most <events> events."""
-        for _ in range(events):
-            topic, data = self.queue.pull()
-            self.logger.info("%s: %s", topic, data)
-            self.received.append(data)
+    def run(self, events=10, batch_size=1, timeout=None):
+        """Consume at most <events> events.
+
+        With batch_size > 1 up to batch_size events already received are
+        taken at once, with a single log line per batch. Stops early once
+        the broker closes the connection or nothing arrives for timeout
+        seconds.
+        """
+        if batch_size <= 1:
+            for _ in range(events):
+                item = self.queue.pull(timeout)
+                if item is None:
+                    return
+                topic, data = item
+                self.messages.info("%s: %s", topic, data)
+                self.received.append(data)
+            return
+
+        remaining = events
+        while remaining > 0:
+            items = self.queue.pull_many(min(batch_size, remaining), timeout)
+            if not items:
+                return
+            self.messages.info("%s: %d events", self.topic, len(items))
+            self.received.extend(data for _, data in items)
+            remaining -= len(items)
 
 
 class Producer:
     """Producer implementation"""
 
-    def __init__(self, topic, value_generator, queue_type=PickleQueue):
-        """Initialize Queue."""
-        self.logger = get_logger(f"Producer {topic}")
+    def __init__(self, topic, value_generator, queue_type=PickleQueue, shared=False):
+        """Initialize Queue.
+
+        With shared, every queue uses the process' single connection to the
+        broker instead of one connection per topic.
+        """
+        self.logger = get_logger(f"producer.{topic}")
+        self.messages = MessageLog(self.logger)
 
         if isinstance(topic, list):
             self.queue = [
-                queue_type(subtopic, _type=MiddlewareType.PRODUCER)
+                queue_type(subtopic, _type=MiddlewareType.PRODUCER, shared=shared)
                 for subtopic in topic
             ]
         else:
-            self.queue = [queue_type(topic, _type=MiddlewareType.PRODUCER)]
+            self.queue = [
+                queue_type(topic, _type=MiddlewareType.PRODUCER, shared=shared)
+            ]
         self.produced = []
         self.gen = value_generator
 
-    def run(self, events=10):
-        """Produce at most <events> events."""
+    def run(self, events=10, batch_size=1, linger=None):
+        """Produce at most <events> events.
+
+        With batch_size > 1 values are buffered per queue and sent with
+        push_many once batch_size values are waiting or, if linger is set,
+        once the oldest one has waited linger seconds.
+        """
+        if batch_size <= 1:
+            for _ in range(events):
+                for queue, value in zip(self.queue, self.gen()):
+                    queue.push(value)
+                    self.messages.info("%s: %s", queue.topic, value)
+
+                    self.produced.append(value)
+            return
+
+        batches = [[] for _ in self.queue]
+        started = time.monotonic()
         for _ in range(events):
-            for queue, value in zip(self.queue, self.gen()):
-                queue.push(value)
-                self.logger.info("%s: %s", queue.topic, value)
+            for queue, batch, value in zip(self.queue, batches, self.gen()):
+                if not batch:
+                    started = time.monotonic()
+                batch.append(value)
+                self.messages.info("%s: %s", queue.topic, value)
 
                 self.produced.append(value)
+
+            lingered = linger is not None and time.monotonic() - started >= linger
+            if lingered or any(len(batch) >= batch_size for batch in batches):
+                self._flush(batches)
+        self._flush(batches)
+
+    def _flush(self, batches):
+        """Send and clear the buffered values of every queue."""
+        for queue, batch in zip(self.queue, batches):
+            queue.push_many(batch)
+            batch.clear()
@@ -1,4 +1,4 @@
-from enum import IntEnum, Enum
+from enum import IntEnum, IntFlag, Enum
 
 
 class MiddlewareType(IntEnum):
@@ -14,6 +14,17 @@ class Serializer(IntEnum):
     JSON = 0
     XML = 1
     PICKLE = 2
+    BINARY = 3
+
+
+class FrameFlag(IntFlag):
+    """Flags carried in the high byte of a frame's serializer field."""
+
+    NONE = 0
+    MORE = 1  # body continues in the next frame
+    ZLIB = 2  # body compressed with zlib
+    LZMA = 4  # body compressed with lzma
+    COMPRESSED = ZLIB | LZMA
 
 
 class Command(Enum):
@@ -24,3 +35,16 @@ class Command(Enum):
     TOPIC_LIST = "topic_list"
     TOPIC_LIST_SUCCESS = "topic_list_success"
     UNSUBSCRIBE = "unsubscribe"
+    PUBLISH_BATCH = "publish_batch"
+    STATS = "stats"
+    STATS_SUCCESS = "stats_success"
+    HELLO = "hello"
+    PEER = "peer"
+    ACK = "ack"
+
+
+class Backpressure(IntEnum):
+    """What the broker does with a subscriber past its high-water mark."""
+
+    SHED = 1
+    DISCONNECT = 2
@@ -0,0 +1,120 @@
+"""Reliable subscriptions: numbered messages kept until acknowledged."""
+
+import itertools
+import socket
+import time
+from collections import deque
+from typing import Iterator, Optional
+
+from src.consts import Serializer
+from src.history import entry_type
+
+# messages a reliable subscription has in flight unless it asks otherwise
+DEFAULT_WINDOW = 100
+
+
+class Delivery:
+    """Messages of one reliable subscription, from publish to acknowledgement.
+
+    A reliable subscription is a session named by a client id and a topic
+    (or pattern). It stands in for the connection among the subscribers of
+    the topic, so it keeps collecting publishes while no connection is
+    attached. Each publish gets the next seq and its frame is kept until the
+    client acknowledges it, or a later one, with a cumulative ACK. At most
+    window of them are in flight (sent and not acknowledged); the rest wait
+    for credit. On attaching to a new connection every unacknowledged
+    message is sent again. A client that stays away too long loses the
+    oldest of them (see trim).
+    """
+
+    __slots__ = (
+        "client",
+        "topic",
+        "serializer",
+        "window",
+        "conn",
+        "seq",
+        "acked",
+        "sent",
+        "entries",
+        "detached_at",
+        "dropped",
+    )
+
+    def __init__(
+        self,
+        client: str,
+        topic: str,
+        serializer: Serializer,
+        window: int = DEFAULT_WINDOW,
+    ):
+        self.client = client
+        self.topic = topic
+        self.serializer = serializer
+        self.window = window
+        # connection the messages are sent to, None while detached
+        self.conn: Optional[socket.socket] = None
+        # seq of the last message appended, acknowledged and sent
+        self.seq = 0
+        self.acked = 0
+        self.sent = 0
+        # unacknowledged messages, oldest first
+        self.entries: deque[entry_type] = deque()
+        # time.monotonic() of the last detach, None while attached
+        self.detached_at: Optional[float] = None
+        # messages forgotten unacknowledged by trim
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def append(self, seq: int, serializer: Serializer, frame: bytes):
+        """Keep frame as the message number seq until it is acknowledged."""
+        self.seq = seq
+        self.entries.append((seq, serializer, frame))
+
+    def ack(self, seq: int):
+        """Forget the messages numbered up to seq."""
+        seq = min(seq, self.seq)
+        while self.entries and self.entries[0][0] <= seq:
+            self.entries.popleft()
+        self.acked = max(self.acked, seq)
+        self.sent = max(self.sent, self.acked)
+
+    def attach(self, conn: socket.socket):
+        """Send to conn from now on, starting over from the first unacked."""
+        self.conn = conn
+        self.sent = self.acked
+        self.detached_at = None
+
+    def detach(self):
+        self.conn = None
+        self.sent = self.acked
+        self.detached_at = time.monotonic()
+
+    def trim(self, limit: int):
+        """Forget the oldest unacknowledged messages past the last limit.
+
+        They count as acknowledged, so the window starts at the first kept.
+        """
+        if len(self.entries) <= limit:
+            return
+        while len(self.entries) > limit:
+            self.entries.popleft()
+            self.dropped += 1
+        self.acked = self.entries[0][0] - 1 if self.entries else self.seq
+        self.sent = max(self.sent, self.acked)
+
+    def sendable(self) -> Iterator[entry_type]:
+        """Yields the messages the window allows to send now, marking them sent."""
+        if self.conn is None or not self.entries:
+            return
+        limit = self.acked + self.window
+        first = self.entries[0][0]
+        for entry in itertools.islice(
+            self.entries, max(0, self.sent + 1 - first), None
+        ):
+            if entry[0] > limit:
+                return
+            self.sent = entry[0]
+            yield entry
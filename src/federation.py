@@ -0,0 +1,312 @@
+"""Brokers that peer with each other and forward publishes by interest."""
+
+import socket
+import uuid
+from typing import Iterable, Optional
+
+from src import transport
+from src.broker import Broker
+from src.consts import Command, Serializer
+from src.delivery import DEFAULT_WINDOW
+from src.protocol import (
+    CDProto,
+    Message,
+    Peer,
+    PublishBatch,
+    PublishMessage,
+    SubscribeTopic,
+    UnsubscribeTopic,
+)
+from src.topics import TopicNode, TopicTrie, is_pattern, is_reserved
+
+# serializer used on the links between peers
+LINK_SERIALIZER = Serializer.PICKLE
+
+
+class FederatedBroker(Broker):
+    """Broker that exchanges publishes with peer brokers.
+
+    Peers are linked by an ordinary connection on which both send a PEER
+    naming themselves. Each broker then subscribes, over the link, to the
+    topics (and patterns) its peer must forward: those its own clients are
+    subscribed to, and those its other peers asked it for. A peer forwards a
+    publish, under its original topic, only to the links whose interest
+    covers it, and sends the retained values covered by a new interest.
+
+    Publishes carry the names of the brokers they went through (via), and
+    are never forwarded back to one of them, so they cannot loop. In a
+    topology with cycles a client may still get a publish once per path;
+    interest relayed around a cycle may also outlive the subscribers it
+    came from, so peers are meant to form a tree, e.g. a star around a
+    central broker. Reserved ($) topics stay local to each broker.
+    """
+
+    def __init__(
+        self,
+        name: Optional[str] = None,
+        peers: Iterable[transport.Address] = (),
+        **kwargs,
+    ):
+        """Initialize broker; kwargs are those of Broker.
+
+        name identifies the broker to its peers (random if None); it must be
+        unique among the federated brokers. The broker links with every
+        address of peers, which must be listening already.
+        """
+        super().__init__(**kwargs)
+        self.name = name or uuid.uuid4().hex[:12]
+
+        # peer links and the names of their brokers (None until it answered)
+        self._peers: dict[socket.socket, Optional[str]] = {}
+        # topics each peer subscribed to, and the same indexed for matching
+        self._peer_topics: dict[socket.socket, set[str]] = {}
+        self._interest = TopicTrie()
+        self._interest_patterns = TopicTrie()
+        # topics we subscribed to on each peer
+        self._advertised: dict[socket.socket, set[str]] = {}
+        # number of local subscriptions (and sessions) to each topic
+        self._local: dict[str, int] = {}
+
+        for address in peers:
+            self.peer(address)
+
+    def peer(self, address: transport.Address) -> socket.socket:
+        """Links with the broker listening on address.
+
+        Call it before run, or from the thread running the broker.
+        """
+        link = transport.connect(address)
+        self.register(link)
+        self._peers[link] = None
+        self._send_link(link, Command.PEER, message=self.name)
+        # the peer answers once it gets this, which may be before we select
+        self.write(link)
+        return link
+
+    def _send_link(
+        self, link: socket.socket, command: Command, topic: str = "", message=None
+    ):
+        self.send(link, CDProto.encode_msg(command, LINK_SERIALIZER, topic, message))
+
+    def send(self, conn: socket.socket, frame: bytes):
+        """Queue frame; links to peers are never shed or dropped."""
+        if conn in self._peers:
+            self._outbox[conn] += frame
+            self._dirty.add(conn)
+            return
+        super().send(conn, frame)
+
+    def handle(self, conn: socket.socket, msg: Message, serializer: Serializer):
+        """Handle links to peers, and publishes with the path they came from."""
+        if isinstance(msg, Peer):
+            self._linked(conn, msg.message)
+        elif isinstance(msg, PublishMessage):
+            self.publish(msg.topic, msg.message, msg.via or ())
+            self._messages.debug("publish %s", msg.topic)
+        elif isinstance(msg, PublishBatch):
+            self.publish_batch(msg.topic, msg.messages, msg.via or ())
+            self._messages.debug("publish %s (%d)", msg.topic, len(msg.messages))
+        elif conn in self._peers and isinstance(msg, SubscribeTopic):
+            self._add_interest(conn, msg.topic)
+            self._update(msg.topic)
+        elif conn in self._peers and isinstance(msg, UnsubscribeTopic):
+            self._remove_interest(conn, msg.topic)
+            self._update(msg.topic)
+        else:
+            super().handle(conn, msg, serializer)
+
+    def _linked(self, conn: socket.socket, name: str):
+        """Record the name of the peer on conn, answering if it called us."""
+        if name == self.name or name in self._peers.values():
+            self.logger.warning("dropping duplicate link to %s", name)
+            self.disconnect(conn)
+            return
+        if conn not in self._peers:
+            self._send_link(conn, Command.PEER, message=self.name)
+        self._peers[conn] = name
+        self._peer_topics[conn] = set()
+        self._advertised[conn] = set()
+        self.logger.info("linked with %s", name)
+        self._advertise(conn)
+
+    def publish(self, topic: str, value, via: Iterable[str] = ()):
+        """Store and fan out value, forwarding it to the interested peers."""
+        node = self.put_topic(topic, value)
+        self._fan_out(node, Command.PUBLISH, value)
+        self._forward(node, Command.PUBLISH, value, via)
+
+    def publish_batch(self, topic: str, values: list, via: Iterable[str] = ()):
+        """As Broker.publish_batch, forwarding the batch to interested peers."""
+        if not values:
+            return
+        node = self.put_topic(topic, values[-1])
+        self._fan_out(node, Command.PUBLISH_BATCH, values)
+        self._forward(node, Command.PUBLISH_BATCH, values, via)
+
+    def _forward(self, node: TopicNode, command: Command, message, via: Iterable):
+        """Send a publish on node once to every interested peer not in via."""
+        links = self._interested(node)
+        if not links:
+            return
+        via = list(via) + [self.name]
+        frame = None
+        for link in links:
+            if self._peers[link] in via:
+                continue
+            if frame is None:
+                frame = CDProto.encode_msg(
+                    command, LINK_SERIALIZER, node.name, message, via=via
+                )
+            self.send(link, frame)
+
+    def _interested(self, node: TopicNode) -> set[socket.socket]:
+        """Links to the peers whose interest covers the topic of node."""
+        links = set()
+        if not self._peer_topics:
+            return links
+        for level in node.lineage():
+            interest = self._interest.find(level.name)
+            if interest is not None:
+                links.update(interest.subscribers)
+        for match in self._interest_patterns.match(node.name):
+            links.update(match.subscribers)
+        return links
+
+    def _add_interest(self, link: socket.socket, topic: str):
+        """Forward publishes to topic to link, starting with its values."""
+        if link not in self._peer_topics or topic in self._peer_topics[link]:
+            return
+        if is_reserved(topic):
+            return
+        self._peer_topics[link].add(topic)
+        trie = self._interest_patterns if is_pattern(topic) else self._interest
+        trie.insert(topic).subscribers[link] = LINK_SERIALIZER
+
+        nodes = self.topics.expand(topic if is_pattern(topic) else f"{topic}/#")
+        for node in nodes:
+            if node.has_value:
+                frame = CDProto.encode_msg(
+                    Command.PUBLISH,
+                    LINK_SERIALIZER,
+                    node.name,
+                    node.value,
+                    via=[self.name],
+                )
+                self.send(link, frame)
+
+    def _remove_interest(self, link: socket.socket, topic: str):
+        """Stop forwarding publishes to topic to link."""
+        topics = self._peer_topics.get(link)
+        if not topics or topic not in topics:
+            return
+        topics.discard(topic)
+        trie = self._interest_patterns if is_pattern(topic) else self._interest
+        node = trie.find(topic)
+        if node is not None:
+            node.subscribers.pop(link, None)
+
+    def _wanted(self, link: socket.socket, topic: str) -> bool:
+        """Whether the peer on link must forward topic to us.
+
+        It must for the topics of our own subscribers and for those the
+        other peers asked us for, never for its own.
+        """
+        if topic in self._local:
+            return True
+        trie = self._interest_patterns if is_pattern(topic) else self._interest
+        node = trie.find(topic)
+        return node is not None and any(other is not link for other in node.subscribers)
+
+    def _advertise(self, link: socket.socket):
+        """Subscribe on a new link to everything its peer must forward."""
+        topics = set(self._local)
+        for other, relayed in self._peer_topics.items():
+            if other is not link:
+                topics |= relayed
+        for topic in sorted(topics):
+            self._send_link(link, Command.SUBSCRIBE, topic)
+        self._advertised[link] = topics
+
+    def _update(self, topic: str):
+        """Subscribe or unsubscribe topic on the peers whose interest changed."""
+        for link, advertised in self._advertised.items():
+            wanted = self._wanted(link, topic)
+            if wanted and topic not in advertised:
+                advertised.add(topic)
+                self._send_link(link, Command.SUBSCRIBE, topic)
+            elif not wanted and topic in advertised:
+                advertised.discard(topic)
+                self._send_link(link, Command.UNSUBSCRIBE, topic)
+
+    def _subscribed(self, topic: str, address) -> bool:
+        node = self._trie(topic).find(topic)
+        return node is not None and node in self._subscriptions.get(address, ())
+
+    def _add_local(self, topic: str):
+        if is_reserved(topic):
+            return
+        self._local[topic] = self._local.get(topic, 0) + 1
+        if self._local[topic] == 1:
+            self._update(topic)
+
+    def _remove_local(self, topic: str):
+        if topic not in self._local:
+            return
+        self._local[topic] -= 1
+        if not self._local[topic]:
+            del self._local[topic]
+            self._update(topic)
+
+    def subscribe(
+        self,
+        topic: str,
+        address: socket.socket,
+        _format: Serializer = None,
+        last: Optional[int] = None,
+        since: Optional[int] = None,
+    ):
+        """Subscribe as Broker.subscribe, then ask the peers for topic."""
+        subscribed = self._subscribed(topic, address)
+        super().subscribe(topic, address, _format, last, since)
+        if not subscribed:
+            self._add_local(topic)
+
+    def subscribe_reliable(
+        self,
+        topic: str,
+        address: socket.socket,
+        _format: Serializer,
+        client: str,
+        window: int = DEFAULT_WINDOW,
+    ):
+        """As Broker.subscribe_reliable, then ask the peers for topic."""
+        new = (client, topic) not in self._sessions
+        super().subscribe_reliable(topic, address, _format, client, window)
+        if new:
+            self._add_local(topic)
+
+    def unsubscribe(self, topic: str, address: socket.socket):
+        """Unsubscribe as Broker.unsubscribe, then update the peers.
+
+        Ending a session and dropping a client unsubscribe through here too.
+        """
+        subscribed = self._subscribed(topic, address)
+        super().unsubscribe(topic, address)
+        if subscribed:
+            self._remove_local(topic)
+
+    def disconnect(self, conn: socket.socket):
+        """Drop a client, or a peer together with everything it asked for."""
+        relayed = ()
+        if conn in self._peers:
+            relayed = list(self._peer_topics.get(conn, ()))
+            for topic in relayed:
+                self._remove_interest(conn, topic)
+            self._peer_topics.pop(conn, None)
+            self._advertised.pop(conn, None)
+            name = self._peers.pop(conn)
+            if name is not None:
+                self.logger.info("unlinked from %s", name)
+        super().disconnect(conn)
+        for topic in relayed:
+            self._update(topic)
@@ -0,0 +1,50 @@
+"""Bounded history of the messages published to a topic."""
+
+import itertools
+from collections import deque
+from typing import Iterator
+
+from src.consts import Serializer
+
+# (seq, serializer of frame, frame)
+entry_type = tuple[int, Serializer, bytes]
+
+
+class History:
+    """Ring buffer of the last encoded frames fanned out at one topic level.
+
+    Frames are kept as they were sent, so replaying them to a subscriber of
+    the same serializer costs no encoding. Entries are numbered by seq, one
+    per publish, and the oldest ones are dropped once there are more than
+    capacity of them or their frames take more than budget bytes (the newest
+    entry is always kept).
+    """
+
+    __slots__ = ("capacity", "budget", "size", "seq", "entries")
+
+    def __init__(self, capacity: int, budget: int):
+        self.capacity = capacity
+        self.budget = budget
+        self.size = 0
+        # seq of the last message appended
+        self.seq = 0
+        self.entries: deque[entry_type] = deque()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def append(self, seq: int, serializer: Serializer, frame: bytes):
+        """Keep frame as the message number seq, evicting old ones."""
+        self.seq = seq
+        self.entries.append((seq, serializer, frame))
+        self.size += len(frame)
+        while len(self.entries) > 1 and (
+            len(self.entries) > self.capacity or self.size > self.budget
+        ):
+            self.size -= len(self.entries.popleft()[2])
+
+    def since(self, seq: int) -> Iterator[entry_type]:
+        """Yields the kept entries numbered seq or above, oldest first."""
+        if not self.entries:
+            return iter(())
+        return itertools.islice(self.entries, max(0, seq - self.entries[0][0]), None)
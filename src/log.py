@@ -1,13 +1,201 @@
-"""Common logging configuration."""
+"""Common logging configuration.
+
+Records are put on a queue by a QueueHandler and written to stderr by a
+QueueListener thread, so logging costs the caller little more than building
+the record. Levels are read from the CD_LOG environment variable, e.g.
+
+    CD_LOG="INFO,broker=DEBUG,consumer=WARNING"
+
+sets the root level to INFO and overrides it for the named loggers and
+their children. Logs written for every message go through MessageLog,
+which lets at most CD_LOG_RATE of them through per second (10 by default,
+0 lets every one through).
+"""
+
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from typing import Optional
+
+FORMAT = "%(asctime)s %(name)-12s %(levelname)-8s %(message)s"
+DATEFMT = "%m-%d %H:%M:%S"
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the writer thread.
+
+    The stock one formats every record before queueing it, so it can be
+    pickled; records here never leave the process.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    """QueueListener that writes the records every interval seconds.
+
+    Waking up for each record would make the writer thread compete for the
+    GIL with the threads logging; batching keeps it off their way. Stopping
+    it wakes it up at once, so flush doesn't wait for the interval.
+    """
+
+    interval = 0.05
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wake = threading.Event()
+
+    def start(self):
+        self._wake.clear()
+        super().start()
+
+    def enqueue_sentinel(self):
+        super().enqueue_sentinel()
+        self._wake.set()
+
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        while True:
+            try:
+                return self.queue.get_nowait()
+            except queue.Empty:
+                if not block:
+                    raise
+                self._wake.wait(self.interval)
+
+
+class _StderrHandler(logging.StreamHandler):
+    """Writes to what sys.stderr is when the record is written.
+
+    Records are written later, by another thread, so the stream of when
+    logging was configured may have been replaced (and closed) by then.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+
+    @property
+    def stream(self):
+        return sys.stderr
+
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s %(name)-12s %(levelname)-8s %(message)s",
-    datefmt="%m-%d %H:%M:%S",
-)
+_handler: Optional[_QueueHandler] = None
+_listener: Optional[_QueueListener] = None
+_levels: dict[str, str] = {}
+
+
+def parse_levels(spec: str) -> dict[str, str]:
+    """Maps logger names ("" for the root) to the levels set in spec."""
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.strip().rpartition("=")
+        if level:
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure(spec: Optional[str] = None):
+    """Set levels from spec (CD_LOG if None) and start the writer thread."""
+    global _levels
+
+    if spec is None:
+        spec = os.environ.get("CD_LOG", "DEBUG")
+    for name in _levels:
+        logging.getLogger(name or None).setLevel(logging.NOTSET)
+    _levels = parse_levels(spec)
+    for name, level in _levels.items():
+        logging.getLogger(name or None).setLevel(level)
+
+    _restart()
+
+
+def _restart():
+    """(Re)start the queue pipeline, e.g. in a forked child without the thread.
+
+    The previous writer thread, if still running, is stopped once it has
+    written the records queued before the switch.
+    """
+    global _handler, _listener
+
+    root = logging.getLogger()
+    if _handler is not None:
+        root.removeHandler(_handler)
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    _handler = _QueueHandler(records)
+    root.addHandler(_handler)
+
+    previous = _listener
+    writer = _StderrHandler()
+    writer.setFormatter(logging.Formatter(FORMAT, DATEFMT))
+    _listener = _QueueListener(records, writer)
+    _listener.start()
+    # in a forked child the previous thread is gone, with nothing to write
+    thread = previous and previous._thread
+    if thread is not None and thread.is_alive():
+        previous.stop()
+
+
+def flush():
+    """Write the queued records and keep logging (e.g. before a process exits)."""
+    if _listener is not None:
+        _listener.stop()
+        _listener.start()
 
 
 def get_logger(module):
     """Get Logger for module."""
     return logging.getLogger(module)
+
+
+class MessageLog:
+    """Rate limited logging of a logger's per-message records.
+
+    Whether a record goes through is decided before it is built, so records
+    dropped by the limit or the logger's level cost a couple of comparisons.
+    The number of records dropped is added to the next one logged.
+    """
+
+    __slots__ = ("logger", "rate", "allowance", "checked", "dropped")
+
+    def __init__(self, logger: logging.Logger, rate: Optional[float] = None):
+        if rate is None:
+            rate = float(os.environ.get("CD_LOG_RATE", 10))
+        self.logger = logger
+        self.rate = rate
+        self.allowance = max(rate, 1)
+        self.checked = time.monotonic()
+        self.dropped = 0
+
+    def log(self, level: int, msg: str, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        if self.rate > 0:
+            now = time.monotonic()
+            self.allowance = min(
+                max(self.rate, 1), self.allowance + (now - self.checked) * self.rate
+            )
+            self.checked = now
+            if self.allowance < 1:
+                self.dropped += 1
+                return
+            self.allowance -= 1
+        if self.dropped:
+            msg = f"{msg} (+{self.dropped} not logged)"
+            self.dropped = 0
+        self.logger.log(level, msg, *args)
+
+    def debug(self, msg: str, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg: str, *args):
+        self.log(logging.INFO, msg, *args)
+
+
+configure()
+atexit.register(lambda: _listener.stop())
+os.register_at_fork(after_in_child=_restart)
@@ -0,0 +1,108 @@
+"""Counters and histograms the broker keeps about itself."""
+
+import time
+
+from src.consts import Serializer
+
+
+class Histogram:
+    """Counts of values in power-of-two buckets.
+
+    Recording is a bit_length and a list increment, cheap enough for every
+    message; percentiles are approximated by the upper bound of the bucket
+    they fall in.
+    """
+
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value: int):
+        self.buckets[min(value.bit_length(), 63)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction: float) -> int:
+        """Returns an upper bound of the value below which fraction of them lie."""
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return min(2**bucket - 1, self.max)
+        return self.max
+
+    def snapshot(self, scale: float = 1) -> dict:
+        """Summary of the recorded values, each divided by scale."""
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count / scale, 2),
+            "p50": round(self.percentile(0.5) / scale, 2),
+            "p99": round(self.percentile(0.99) / scale, 2),
+            "max": round(self.max / scale, 2),
+        }
+
+
+class Metrics:
+    """Running totals of what a broker received, sent and how long it took.
+
+    Per serializer counters are lists indexed by the serializer's value, and
+    handling times are kept in nanoseconds, so updating them on the message
+    path costs a few integer operations.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.connections = 0
+        self.connections_total = 0
+        self.messages_in = [0] * len(Serializer)
+        self.messages_out = [0] * len(Serializer)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # subscribers reached by each publish
+        self.fanout = Histogram()
+        # command value -> time spent handling it, in ns
+        self.handling: dict[str, Histogram] = {}
+
+    def connected(self):
+        self.connections += 1
+        self.connections_total += 1
+
+    def disconnected(self):
+        self.connections -= 1
+
+    def handled(self, command: str, serializer: Serializer, elapsed: int):
+        """Count a message received and the ns it took to handle it."""
+        self.messages_in[serializer] += 1
+        histogram = self.handling.get(command)
+        if histogram is None:
+            histogram = self.handling[command] = Histogram()
+        histogram.record(elapsed)
+
+    def snapshot(self) -> dict:
+        """The counters as a dict of plain values (see Broker.stats)."""
+        return {
+            "uptime": round(time.monotonic() - self.started, 3),
+            "connections": {
+                "current": self.connections,
+                "total": self.connections_total,
+            },
+            "messages": {
+                "in": {s.name: self.messages_in[s] for s in Serializer},
+                "out": {s.name: self.messages_out[s] for s in Serializer},
+            },
+            "bytes": {"in": self.bytes_in, "out": self.bytes_out},
+            "fanout": self.fanout.snapshot(),
+            "handling_us": {
+                command: histogram.snapshot(1000)
+                for command, histogram in self.handling.items()
+            },
+        }
@@ -1,64 +1,646 @@
 """Middleware to communicate with PubSub Message Broker."""
 
+import asyncio
+import queue
 import socket
-from collections.abc import Callable
-from typing import Any, Tuple
+import threading
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from typing import Any, Optional, Tuple
 
-from src.consts import MiddlewareType, Serializer, Command
-from src.protocol import CDProto, PublishMessage
+from src.consts import FrameFlag, MiddlewareType, Serializer, Command
+from src.delivery import DEFAULT_WINDOW
+from src.protocol import (
+    COMPRESSIONS,
+    CDProto,
+    CDProtoBadFormat,
+    FrameReader,
+    Hello,
+    Message,
+    PublishBatch,
+    PublishMessage,
+    StatsSuccess,
+    TopicListSuccess,
+)
+from src import transport
+from src.topics import is_pattern
+
+
+def _publishes(msg: Message) -> list[Tuple[str, Any]]:
+    """Returns the (topic, data) pairs carried by a received message."""
+    if isinstance(msg, PublishMessage):
+        return [(msg.topic, msg.message)]
+    if isinstance(msg, PublishBatch):
+        return [(msg.topic, value) for value in msg.messages]
+    return []
+
+
+class SharedConnection:
+    """One connection to a broker, shared by the shared Queues of the process.
+
+    Subscriptions are reference counted per topic: the broker is asked to
+    subscribe when the first queue of a topic joins and to unsubscribe when
+    the last one leaves. A single reader thread hands every publish to the
+    queues of its topic, which the broker addresses it with. Publishes to a
+    pattern come under their own topic instead, so they couldn't be told
+    from those of an exact topic, or of another pattern, covering the same
+    topic: each pattern gets a connection of its own, whose publishes all
+    go to the queues of that pattern. A queue joining a topic that is
+    already subscribed gets the last value the connection received for it,
+    in place of the retained value the broker only sends on the first
+    subscribe. Sends from several threads are serialized.
+    """
+
+    _instances: dict[Tuple[transport.Address, Optional[str]], "SharedConnection"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, address: transport.Address, pattern: Optional[str] = None):
+        self.address = address
+        # the only topic subscribed on the connection, if it is a pattern
+        self.pattern = pattern
+        self.closed = False
+        self.sock = transport.connect(address)
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        # topic (or pattern) -> consumer queues subscribed to it
+        self._consumers: dict[str, list["Queue"]] = {}
+        # topic (or pattern) -> last value received for each matching topic
+        self._last: dict[str, dict[str, Any]] = {}
+        threading.Thread(target=self._run, daemon=True).start()
+
+    @classmethod
+    def get(
+        cls, address: transport.Address, pattern: Optional[str] = None
+    ) -> "SharedConnection":
+        """Returns the open connection to address, opening one if needed.
+
+        The connection is the one for the queues of pattern if given.
+        """
+        with cls._instances_lock:
+            key = (address, pattern)
+            connection = cls._instances.get(key)
+            if connection is None or connection.closed:
+                connection = cls._instances[key] = cls(address, pattern)
+            return connection
+
+    def send(self, frame: bytes):
+        """Writes a whole frame, so frames of different queues never mix."""
+        with self._send_lock:
+            self.sock.sendall(frame)
+        return len(frame)
+
+    def subscribe(self, consumer: "Queue", **options):
+        """Deliver the publishes of consumer's topic to it.
+
+        options (last, since, conflate) only apply if the topic isn't
+        subscribed yet; otherwise consumer starts with the last value
+        received for the topic (or for each topic matching the pattern).
+        """
+        with self._lock:
+            consumers = self._consumers.setdefault(consumer.topic, [])
+            consumers.append(consumer)
+            for item in self._last.get(consumer.topic, {}).items():
+                try:
+                    consumer._prefetched.put_nowait(item)
+                except queue.Full:
+                    break
+            if len(consumers) == 1:
+                CDProto.send_msg(
+                    self,
+                    Command.SUBSCRIBE,
+                    consumer.serializer,
+                    consumer.topic,
+                    **options,
+                )
+
+    def unsubscribe(self, consumer: "Queue"):
+        """Stop delivering to consumer, unsubscribing the topic if it was last."""
+        with self._lock:
+            consumers = self._consumers.get(consumer.topic, [])
+            if consumer not in consumers:
+                return
+            consumers.remove(consumer)
+            if not consumers:
+                del self._consumers[consumer.topic]
+                self._last.pop(consumer.topic, None)
+                CDProto.send_msg(
+                    self, Command.UNSUBSCRIBE, consumer.serializer, consumer.topic
+                )
+
+    def _run(self):
+        reader = FrameReader()
+        try:
+            while reader.recv(self.sock):
+                for frame in reader:
+                    self._dispatch(CDProto.decode_msg(*frame))
+        except (OSError, CDProtoBadFormat):
+            pass
+
+        self.closed = True
+        with self._lock:
+            consumers = [c for cs in self._consumers.values() for c in cs]
+        for consumer in consumers:
+            consumer._prefetched.put(None)
+
+    def _dispatch(self, msg: Message):
+        items = _publishes(msg)
+        with self._lock:
+            if isinstance(msg, (TopicListSuccess, StatsSuccess)):
+                consumers = [c for cs in self._consumers.values() for c in cs]
+            else:
+                topic = getattr(msg, "topic", None)
+                subscription = self.pattern or topic
+                consumers = list(self._consumers.get(subscription, ()))
+                if items and consumers:
+                    self._last.setdefault(subscription, {})[topic] = items[-1][1]
+
+        seq = getattr(msg, "seq", None)
+        for consumer in consumers:
+            if isinstance(msg, TopicListSuccess):
+                consumer.topics = msg.message
+            elif isinstance(msg, StatsSuccess):
+                consumer.stats = msg.message
+            consumer.seq = seq or consumer.seq
+            for item in items:
+                consumer._prefetched.put(item)
 
 
 class Queue:
     """Representation of Queue interface for both Consumers and Producers."""
 
-    def __init__(self, topic, serializer: Serializer, _type=MiddlewareType.CONSUMER):
-        """Create Queue."""
+    # broker to connect to: a (host, port) or a URL (see src/transport.py)
+    address: transport.Address = ("localhost", 5000)
+
+    def __init__(
+        self,
+        topic,
+        serializer: Serializer,
+        _type=MiddlewareType.CONSUMER,
+        last: Optional[int] = None,
+        since: Optional[int] = None,
+        prefetch: int = 0,
+        shared: bool = False,
+        compression: Optional[list[str]] = None,
+        conflate: bool = False,
+        address: Optional[transport.Address] = None,
+        client: Optional[str] = None,
+        window: int = DEFAULT_WINDOW,
+    ):
+        """Create Queue.
+
+        A consumer can ask the broker to replay the last messages of topic,
+        or the ones after sequence number since (e.g. the seq of a previous
+        queue), before the live ones.
+
+        With prefetch > 0 a background thread reads from the broker while the
+        consumer is busy, keeping up to prefetch (topic, data) pairs ready.
+
+        With shared, the queue uses the process' SharedConnection to its
+        broker (the one of its pattern, for a pattern) instead of a
+        connection of its own. Its publishes are kept
+        for pull as they arrive (up to prefetch of them if set, in which
+        case a slow queue holds up the others on the connection).
+
+        compression lists the compressions the queue accepts, best first
+        (e.g. ["lzma", "zlib"]); the broker picks one when connecting and
+        large frames are then compressed both ways. Shared queues don't
+        negotiate it.
+
+        With conflate, the broker only keeps the latest value of the topic
+        (of each topic, for a pattern) for the consumer while it lags behind.
+
+        address is the broker to connect to in place of Queue.address, e.g.
+        "unix:///tmp/broker.sock" for a broker on the same host.
+
+        With client, a consumer's subscription is reliable: the broker
+        numbers its messages (see seq) and keeps them until acknowledged,
+        sending at most window of them ahead. pull acknowledges a message
+        once the next one is pulled, so it is handled at least once: a queue
+        of the same client and topic gets the unacknowledged ones again,
+        e.g. after a crash. Call ack() once the last one pulled is handled,
+        and cancel() to end the subscription. Such queues can't be shared
+        or prefetch.
+        """
+        if client is not None and (shared or prefetch):
+            raise ValueError("Reliable queues can't be shared or prefetch")
+        if address is not None:
+            self.address = address
         self.topic = topic
         self.type = _type
         self.serializer = serializer
+        # sequence number of the last message received, if the broker sends them
+        self.seq: Optional[int] = None
+        # last answer of the broker to list_topics
+        self.topics: Optional[list[str]] = None
+        # last answer of the broker to request_stats
+        self.stats: Optional[dict] = None
+
+        self.client = client
+        self.window = window
+        # seq of each pending value (None but for the last one of a batch),
+        # of the last value pulled, and of the last handled and acknowledged
+        self._seqs: deque[Optional[int]] = deque()
+        self._pulled: Optional[int] = None
+        self._handled = 0
+        self._acked = 0
+
+        self._reader = FrameReader()
+        # values of a received batch not yet handed out by pull
+        self._pending: deque[Tuple[str, Any]] = deque()
+        self._prefetched: Optional[queue.Queue] = None
+
+        # compression picked by the broker for this queue's connection
+        self.compression = FrameFlag.NONE
 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect(("localhost", 5000))
+        self._shared: Optional[SharedConnection] = None
+        if shared:
+            consumer = self.type == MiddlewareType.CONSUMER
+            pattern = self.topic if consumer and is_pattern(self.topic) else None
+            self._shared = self.sock = SharedConnection.get(self.address, pattern)
+            self._prefetched = queue.Queue(prefetch)
+            if self.type == MiddlewareType.CONSUMER:
+                self._shared.subscribe(
+                    self, last=last, since=since, conflate=conflate or None
+                )
+            return
+
+        self.sock = transport.connect(self.address)
+        if compression:
+            self._negotiate(compression)
 
         if self.type == MiddlewareType.CONSUMER:
-            CDProto.send_msg(self.sock, Command.SUBSCRIBE, self.serializer, self.topic)
+            CDProto.send_msg(
+                self.sock,
+                Command.SUBSCRIBE,
+                self.serializer,
+                self.topic,
+                last=last,
+                since=since,
+                conflate=conflate or None,
+                client=client,
+                window=window if client is not None else None,
+            )
+
+        if prefetch > 0:
+            self._prefetched = queue.Queue(prefetch)
+            threading.Thread(target=self._prefetch, daemon=True).start()
+
+    def _negotiate(self, compression: list[str]):
+        """Offers compression to the broker and waits for its pick."""
+        CDProto.send_msg(
+            self.sock,
+            Command.HELLO,
+            self.serializer,
+            message=",".join(compression),
+        )
+        while True:
+            frame = self._reader.next_frame()
+            if frame is None:
+                if not self._reader.recv(self.sock):
+                    raise CDProtoBadFormat("Broker closed the connection")
+                continue
+            msg = CDProto.decode_msg(*frame)
+            if isinstance(msg, Hello):
+                self.compression = COMPRESSIONS.get(msg.message, FrameFlag.NONE)
+                return
 
     def push(self, value):
         """Sends data to broker."""
-        CDProto.send_msg(self.sock, Command.PUBLISH, self.serializer, self.topic, value)
+        CDProto.send_msg(
+            self.sock,
+            Command.PUBLISH,
+            self.serializer,
+            self.topic,
+            value,
+            self.compression,
+        )
+
+    def push_many(self, values: Iterable):
+        """Sends several values to the broker in a single batch."""
+        values = list(values)
+        if values:
+            CDProto.send_msg(
+                self.sock,
+                Command.PUBLISH_BATCH,
+                self.serializer,
+                self.topic,
+                values,
+                self.compression,
+            )
+
+    def _receive(self, block: bool = True) -> bool:
+        """Reads frames until a publish is pending; False once the broker left.
+
+        Other messages update the queue's state (e.g. topics) and are never
+        handed out. Without block, only the frames already read are used.
+        """
+        while not self._pending:
+            frame = self._reader.next_frame()
+            if frame is None:
+                if not block:
+                    return True
+                if not self._reader.recv(self.sock):
+                    return False
+                continue
+
+            msg = CDProto.decode_msg(*frame)
+            self.seq = getattr(msg, "seq", None) or self.seq
+            if isinstance(msg, TopicListSuccess):
+                self.topics = msg.message
+            elif isinstance(msg, StatsSuccess):
+                self.stats = msg.message
+            items = _publishes(msg)
+            self._pending.extend(items)
+            if self.client is not None and items:
+                self._seqs.extend([None] * (len(items) - 1) + [msg.seq])
+        return True
+
+    def _next(self) -> Tuple[str, Any]:
+        """Hands out the next pending value, noting its seq if reliable."""
+        if self.client is not None:
+            seq = self._seqs.popleft()
+            if seq is not None:
+                self._pulled = seq
+        return self._pending.popleft()
+
+    def _settle(self):
+        """Counts the values pulled so far as handled."""
+        if self._pulled is not None:
+            self._handled = self._pulled
+            self._pulled = None
+
+    def _send_ack(self):
+        if self._handled > self._acked:
+            CDProto.send_msg(
+                self.sock, Command.ACK, self.serializer, self.topic, self._handled
+            )
+            self._acked = self._handled
+
+    def ack(self):
+        """Acknowledges the values pulled so far (reliable queues only)."""
+        if self.client is not None:
+            self._settle()
+            self._send_ack()
+
+    def _prefetch(self):
+        try:
+            while self._receive():
+                while self._pending:
+                    self._prefetched.put(self._pending.popleft())
+        except (OSError, CDProtoBadFormat):
+            pass
+        self._prefetched.put(None)
+
+    def pull(self, timeout: Optional[float] = None) -> Optional[Tuple[str, Any]]:
+        """Receives (topic, data) from broker. Should BLOCK the consumer!
+
+        Returns None once the broker closes the connection or, with a
+        timeout, if nothing arrives in time.
+        """
+        if self._prefetched is not None:
+            try:
+                item = self._prefetched.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if item is None:
+                # keep the end of the stream visible to the next pull
+                self._prefetched.put(None)
+            return item
+
+        if self.client is not None:
+            # the caller is back, so it handled the value pulled last; ack
+            # every half window, and before waiting for more
+            self._settle()
+            if not self._pending or self._handled - self._acked >= self.window // 2:
+                self._send_ack()
+        if self._pending:
+            return self._next()
+        self.sock.settimeout(timeout)
+        try:
+            if not self._receive():
+                return None
+        except socket.timeout:
+            return None
+        finally:
+            self.sock.settimeout(None)
+        return self._next()
 
-    def pull(self) -> Tuple[str, Any]:
-        """Receives (topic, data) from broker. Should BLOCK the consumer!"""
-        msg, _ = CDProto.recv_msg(self.sock)
-        if isinstance(msg, PublishMessage):
-            return msg.topic, msg.message
+    def pull_many(
+        self, max_n: int, timeout: Optional[float] = None
+    ) -> list[Tuple[str, Any]]:
+        """Receives up to max_n (topic, data) pairs.
+
+        Waits (up to timeout) for the first one like pull, then adds the ones
+        that are already available without waiting. An empty list means the
+        timeout expired or the broker closed the connection.
+        """
+        first = self.pull(timeout)
+        if first is None:
+            return []
+        items = [first]
+        if self._prefetched is not None:
+            while len(items) < max_n:
+                try:
+                    item = self._prefetched.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._prefetched.put(None)
+                    break
+                items.append(item)
+            return items
+
+        while len(items) < max_n:
+            if not self._pending:
+                self._receive(block=False)
+                if not self._pending:
+                    break
+            items.append(self._next())
+        return items
+
+    def __iter__(self) -> Iterator[Tuple[str, Any]]:
+        """Yields (topic, data) pairs until the broker closes the connection."""
+        return iter(self.pull, None)
 
     def list_topics(self, callback: Callable):
         """Lists all topics available in the broker."""
         CDProto.send_msg(self.sock, Command.TOPIC_LIST, self.serializer, self.topic)
         callback()
 
+    def request_stats(self):
+        """Asks the broker for its stats, stored in .stats once they arrive."""
+        CDProto.send_msg(self.sock, Command.STATS, self.serializer, self.topic)
+
     def cancel(self):
         """Cancel subscription."""
+        if self._shared is not None:
+            self._shared.unsubscribe(self)
+            return
         CDProto.send_msg(self.sock, Command.UNSUBSCRIBE, self.serializer, self.topic)
 
+    def close(self):
+        """Stop using the connection to the broker.
+
+        A shared connection is left open for the other queues.
+        """
+        if self._shared is not None:
+            self._shared.unsubscribe(self)
+            self._prefetched.put(None)
+            return
+        self.sock.close()
+
 
 class JSONQueue(Queue):
     """Queue implementation with JSON based serialization."""
 
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        super().__init__(topic, Serializer.JSON, _type)
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **options):
+        super().__init__(topic, Serializer.JSON, _type, **options)
 
 
 class XMLQueue(Queue):
     """Queue implementation with XML based serialization."""
 
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        super().__init__(topic, Serializer.XML, _type)
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **options):
+        super().__init__(topic, Serializer.XML, _type, **options)
 
 
 class PickleQueue(Queue):
     """Queue implementation with Pickle based serialization."""
 
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        super().__init__(topic, Serializer.PICKLE, _type)
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **options):
+        super().__init__(topic, Serializer.PICKLE, _type, **options)
+
+
+class BinaryQueue(Queue):
+    """Queue implementation with compact binary serialization."""
+
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **options):
+        super().__init__(topic, Serializer.BINARY, _type, **options)
+
+
+class AsyncQueue:
+    """Queue interface for asyncio code: push and pull are awaitables.
+
+    The connection is opened by connect(), or lazily by the first push/pull.
+    Consumers can also iterate with `async for topic, data in queue`.
+    """
+
+    address = Queue.address
+
+    def __init__(
+        self,
+        topic,
+        serializer: Serializer,
+        _type=MiddlewareType.CONSUMER,
+        last: Optional[int] = None,
+        since: Optional[int] = None,
+        conflate: bool = False,
+        address: Optional[transport.Address] = None,
+    ):
+        """Create Queue; the options are as in Queue."""
+        if address is not None:
+            self.address = address
+        self.topic = topic
+        self.type = _type
+        self.serializer = serializer
+        self.seq: Optional[int] = None
+        self._replay = {"last": last, "since": since, "conflate": conflate or None}
+
+        self._stream: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader = FrameReader()
+        self._pending: deque[Tuple[str, Any]] = deque()
+
+    async def connect(self):
+        """Open the connection to the broker and subscribe if consuming."""
+        if self._writer is not None:
+            return
+        family, target = transport.parse(self.address)
+        if family == socket.AF_UNIX:
+            connection = asyncio.open_unix_connection(target)
+        else:
+            connection = asyncio.open_connection(*target)
+        self._stream, self._writer = await connection
+        if self.type == MiddlewareType.CONSUMER:
+            await self._send(Command.SUBSCRIBE, **self._replay)
+
+    async def _send(self, command: Command, message=None, **options):
+        await self.connect()
+        self._writer.write(
+            CDProto.encode_msg(command, self.serializer, self.topic, message, **options)
+        )
+        await self._writer.drain()
+
+    async def push(self, value):
+        """Sends data to broker."""
+        await self._send(Command.PUBLISH, value)
+
+    async def push_many(self, values: Iterable):
+        """Sends several values to the broker in a single batch."""
+        values = list(values)
+        if values:
+            await self._send(Command.PUBLISH_BATCH, values)
+
+    async def pull(self) -> Optional[Tuple[str, Any]]:
+        """Receives (topic, data) from broker, or None once it disconnects."""
+        await self.connect()
+        while not self._pending:
+            frame = self._reader.next_frame()
+            if frame is None:
+                data = await self._stream.read(64 * 1024)
+                if not data:
+                    return None
+                self._reader.feed(data)
+                continue
+            msg = CDProto.decode_msg(*frame)
+            self.seq = getattr(msg, "seq", None) or self.seq
+            self._pending.extend(_publishes(msg))
+        return self._pending.popleft()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Tuple[str, Any]:
+        item = await self.pull()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+    async def cancel(self):
+        """Cancel subscription."""
+        await self._send(Command.UNSUBSCRIBE)
+
+    async def close(self):
+        """Close the connection to the broker."""
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+
+
+class JSONAsyncQueue(AsyncQueue):
+    """AsyncQueue implementation with JSON based serialization."""
+
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **options):
+        super().__init__(topic, Serializer.JSON, _type, **options)
+
+
+class XMLAsyncQueue(AsyncQueue):
+    """AsyncQueue implementation with XML based serialization."""
+
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **options):
+        super().__init__(topic, Serializer.XML, _type, **options)
+
+
+class PickleAsyncQueue(AsyncQueue):
+    """AsyncQueue implementation with Pickle based serialization."""
+
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **options):
+        super().__init__(topic, Serializer.PICKLE, _type, **options)
+
+
+class BinaryAsyncQueue(AsyncQueue):
+    """AsyncQueue implementation with compact binary serialization."""
+
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **options):
+        super().__init__(topic, Serializer.BINARY, _type, **options)
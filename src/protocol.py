@@ -1,56 +1,345 @@
-from enum import Enum
+import zlib
 from socket import socket
-from typing import Union, Optional
-
-from src.consts import Serializer, Command
-from src.utils import encoder_map
+from typing import Any, Callable, Union, Optional
+
+try:
+    import lzma
+except ImportError:  # Python built without liblzma
+    lzma = None
+
+from src.consts import FrameFlag, Serializer, Command
+from src.utils import BinaryUtils, XmlUtils, encoder_map
+
+# A 2 byte length of 0xFFFF announces a 4 byte length right after it, so
+# frames that fit the original header keep their compact form.
+EXTENDED_LENGTH = 0xFFFF
+MAX_COMPACT_BODY = EXTENDED_LENGTH - 3
+# Bodies larger than this are split into several MORE-flagged frames.
+CHUNK_SIZE = 1024 * 1024
+# Longest frame a peer may send (a chunk and its serializer field), and the
+# largest message its chunks may add up to; longer ones are rejected.
+MAX_FRAME_LENGTH = CHUNK_SIZE + 2
+MAX_MESSAGE_SIZE = 256 * 1024 * 1024
+# Smaller bodies are never compressed, it would not pay off.
+COMPRESS_THRESHOLD = 1024
+
+# (compress, decompressor factory) of every FrameFlag compression; the
+# decompressors take a max_length, so a small body can't expand unbounded
+_compressors: dict[FrameFlag, tuple[Callable, Callable]] = {
+    FrameFlag.ZLIB: (zlib.compress, zlib.decompressobj),
+}
+if lzma is not None:
+    _compressors[FrameFlag.LZMA] = (
+        lambda body: lzma.compress(body, preset=1),
+        lzma.LZMADecompressor,
+    )
+# compressions this side supports, by the names used to negotiate them
+COMPRESSIONS: dict[str, FrameFlag] = {flag.name.lower(): flag for flag in _compressors}
+
+
+# every flag a frame may carry
+KNOWN_FLAGS = FrameFlag.MORE | FrameFlag.COMPRESSED
+
+
+def _split_field(field: int) -> tuple[Serializer, FrameFlag]:
+    """Returns the serializer and flags of a frame's serializer field."""
+    try:
+        serializer = Serializer(field & 0xFF)
+    except ValueError:
+        raise CDProtoBadFormat(f"Unknown serializer: {field & 0xFF}") from None
+    flags = field >> 8
+    if flags & ~int(KNOWN_FLAGS):
+        raise CDProtoBadFormat(f"Unknown frame flags: {flags:#x}")
+    return serializer, FrameFlag(flags)
 
 
 class Message:
-    """Message Type."""
+    """Message Type.
+
+    Messages are slotted: the command is a class attribute and `fields` lists
+    the attributes that go on the wire, in the order __init__ takes them.
+    `optional` lists attributes that start as None and only go on the wire
+    once set, so peers that don't use them see the same messages as before.
+    `types` gives the type a received field must have (optional ones when
+    set); fields left out of it may hold anything.
+    """
+
+    __slots__ = ()
+    command: Command = None
+    fields: tuple[str, ...] = ()
+    optional: tuple[str, ...] = ()
+    types: dict[str, Union[type, tuple[type, ...]]] = {}
+    # "command" followed by the fields, e.g. the attribute names of XML
+    keys: tuple[str, ...] = ("command",)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.keys = ("command",) + cls.fields
 
-    def __init__(self, command: Command):
-        self.command = command
+    @classmethod
+    def from_dict(cls, dictionary: dict) -> "Message":
+        msg = cls(*[dictionary[field] for field in cls.fields])
+        for field in cls.optional:
+            if field in dictionary:
+                setattr(msg, field, dictionary[field])
+        return msg
+
+    def validate(self) -> "Message":
+        """Returns self, raising ValueError if a field has the wrong type."""
+        for field, kind in self.types.items():
+            value = getattr(self, field)
+            if value is None and field in self.optional:
+                continue
+            if not isinstance(value, kind):
+                raise ValueError(f"Invalid {field}: {value!r}")
+        return self
+
+    def items(self) -> tuple[tuple[str, ...], list]:
+        """Returns the keys on the wire and their values, the command's as str."""
+        keys = self.keys
+        values = [self.command.value] + [getattr(self, field) for field in self.fields]
+        for field in self.optional:
+            value = getattr(self, field)
+            if value is not None:
+                keys += (field,)
+                values.append(value)
+        return keys, values
+
+    def extra(self) -> Optional[dict]:
+        """Returns the optional fields that are set, or None."""
+        extra = None
+        for field in self.optional:
+            value = getattr(self, field)
+            if value is not None:
+                extra = extra or {}
+                extra[field] = value
+        return extra
 
     def to_dict(self) -> dict[str, str]:
-        return {
-            k: (v.value if isinstance(v, Enum) else v) for k, v in self.__dict__.items()
-        }
+        return dict(zip(*self.items()))
 
     def __str__(self):
         return str(self.to_dict())
 
 
 class SubscribeTopic(Message):
+    """Subscription to topic, optionally replaying its history first.
+
+    last asks for the last N messages kept in the topic's history and since
+    for every kept message with a sequence number greater than it. With
+    conflate, only the latest value of each topic is kept for the subscriber
+    while its earlier messages are still waiting to be sent.
+
+    With client, the subscription is reliable: the session of client and
+    topic numbers its messages and keeps them until acknowledged (see Ack),
+    with up to window of them in flight, and outlives the connection.
+    """
+
+    fields = ("topic",)
+    optional = ("last", "since", "conflate", "client", "window")
+    __slots__ = fields + optional
+    command = Command.SUBSCRIBE
+    types = {
+        "topic": str,
+        "last": int,
+        "since": int,
+        "conflate": bool,
+        "client": str,
+        "window": int,
+    }
+
     def __init__(self, topic: str):
-        super().__init__(Command.SUBSCRIBE)
         self.topic = topic
+        self.last: Optional[int] = None
+        self.since: Optional[int] = None
+        self.conflate: Optional[bool] = None
+        self.client: Optional[str] = None
+        self.window: Optional[int] = None
 
 
 class PublishMessage(Message):
+    """A value published to topic; seq is its number in the topic's history.
+
+    via lists the federated brokers the publish went through, its origin
+    first.
+    """
+
+    fields = ("topic", "message")
+    optional = ("seq", "via")
+    __slots__ = fields + optional
+    command = Command.PUBLISH
+    types = {"topic": str, "seq": int, "via": list}
+
     def __init__(self, topic: str, message: str):
-        super().__init__(Command.PUBLISH)
         self.topic = topic
         self.message = message
+        self.seq: Optional[int] = None
+        self.via: Optional[list[str]] = None
+
+
+class PublishBatch(Message):
+    fields = ("topic", "messages")
+    optional = ("seq", "via")
+    __slots__ = fields + optional
+    command = Command.PUBLISH_BATCH
+    types = {"topic": str, "messages": list, "seq": int, "via": list}
+
+    def __init__(self, topic: str, messages: list):
+        self.topic = topic
+        self.messages = messages
+        self.seq: Optional[int] = None
+        self.via: Optional[list[str]] = None
 
 
 class TopicList(Message):
-    def __init__(self):
-        super().__init__(Command.TOPIC_LIST)
+    __slots__ = fields = ()
+    command = Command.TOPIC_LIST
 
 
 class TopicListSuccess(Message):
+    __slots__ = fields = ("message",)
+    command = Command.TOPIC_LIST_SUCCESS
+    types = {"message": list}
+
     def __init__(self, message: list[str]):
-        super().__init__(Command.TOPIC_LIST_SUCCESS)
         self.message = message
 
 
 class UnsubscribeTopic(Message):
+    __slots__ = fields = ("topic",)
+    command = Command.UNSUBSCRIBE
+    types = {"topic": str}
+
     def __init__(self, topic: str):
-        super().__init__(Command.UNSUBSCRIBE)
         self.topic = topic
 
 
+class Stats(Message):
+    __slots__ = fields = ()
+    command = Command.STATS
+
+
+class StatsSuccess(Message):
+    __slots__ = fields = ("message",)
+    command = Command.STATS_SUCCESS
+    types = {"message": dict}
+
+    def __init__(self, message: dict):
+        self.message = message
+
+
+class Hello(Message):
+    """Compressions a client accepts, best first (e.g. "lzma,zlib").
+
+    The broker answers with a Hello naming the one it picked, or none.
+    """
+
+    __slots__ = fields = ("message",)
+    command = Command.HELLO
+    types = {"message": str}
+
+    def __init__(self, message: str):
+        self.message = message
+
+
+class Peer(Message):
+    """Opens a link between federated brokers, naming the sender."""
+
+    __slots__ = fields = ("message",)
+    command = Command.PEER
+    types = {"message": str}
+
+    def __init__(self, message: str):
+        self.message = message
+
+
+class Ack(Message):
+    """Cumulative acknowledgement of a reliable subscription.
+
+    Acknowledges every message of the subscription to topic numbered up to
+    message (a seq).
+    """
+
+    __slots__ = fields = ("topic", "message")
+    command = Command.ACK
+    types = {"topic": str, "message": int}
+
+    def __init__(self, topic: str, message: int):
+        self.topic = topic
+        self.message = message
+
+
+# message class of every command, by the command's wire value
+message_types: dict[str, type[Message]] = {
+    kind.command.value: kind
+    for kind in (
+        SubscribeTopic,
+        PublishMessage,
+        PublishBatch,
+        TopicList,
+        TopicListSuccess,
+        UnsubscribeTopic,
+        Stats,
+        StatsSuccess,
+        Hello,
+        Peer,
+        Ack,
+    )
+}
+
+# builds the message of a command from the (topic, message) of encode_msg
+_builders: dict[Command, Callable[[str, Any], Message]] = {
+    Command.SUBSCRIBE: lambda topic, message: SubscribeTopic(topic),
+    Command.PUBLISH: PublishMessage,
+    Command.PUBLISH_BATCH: PublishBatch,
+    Command.TOPIC_LIST: lambda topic, message: TopicList(),
+    Command.TOPIC_LIST_SUCCESS: lambda topic, message: TopicListSuccess(message),
+    Command.UNSUBSCRIBE: lambda topic, message: UnsubscribeTopic(topic),
+    Command.STATS: lambda topic, message: Stats(),
+    Command.STATS_SUCCESS: lambda topic, message: StatsSuccess(message),
+    Command.HELLO: lambda topic, message: Hello(message),
+    Command.PEER: lambda topic, message: Peer(message),
+    Command.ACK: Ack,
+}
+_commands = {command.value: command for command in Command}
+
+
+def _encode_xml(msg: Message) -> bytes:
+    return XmlUtils.encode_items(*msg.items())
+
+
+def _encode_binary(msg: Message) -> bytes:
+    command = msg.command
+    value_key = "messages" if command == Command.PUBLISH_BATCH else "message"
+    return BinaryUtils.encode_parts(
+        command.value,
+        getattr(msg, "topic", ""),
+        getattr(msg, value_key, None),
+        msg.extra(),
+    )
+
+
+def _decode_binary(body: bytes) -> Message:
+    command, topic, value, extra = BinaryUtils.decode_parts(body)
+    msg = _builders[_commands[command]](topic, value)
+    if extra:
+        for field in msg.optional:
+            if field in extra:
+                setattr(msg, field, extra[field])
+    return msg
+
+
+# serializers whose layout is read and written straight from the message
+# fields; the others go through encoder_map with a dict
+_encoders: dict[Serializer, Callable[[Message], bytes]] = {
+    Serializer.XML: _encode_xml,
+    Serializer.BINARY: _encode_binary,
+}
+_decoders: dict[Serializer, Callable[[bytes], Message]] = {
+    Serializer.BINARY: _decode_binary,
+}
+
+
 class CDProto:
     """Computação Distribuida Protocol."""
 
@@ -64,6 +353,11 @@ class CDProto:
         """Creates a PublishMessage object."""
         return PublishMessage(topic, message)
 
+    @classmethod
+    def publish_batch(cls, topic: str, messages: list) -> PublishBatch:
+        """Creates a PublishBatch object."""
+        return PublishBatch(topic, messages)
+
     @classmethod
     def topic_list(cls, _list: list[str] = None) -> Union[TopicList, TopicListSuccess]:
         """Creates a TopicListMessage object."""
@@ -76,6 +370,149 @@ class CDProto:
         """Creates a UnsubscribeTopic object."""
         return UnsubscribeTopic(topic)
 
+    @classmethod
+    def stats(cls, snapshot: dict = None) -> Union[Stats, StatsSuccess]:
+        """Creates a Stats request, or its answer if given the snapshot."""
+        if snapshot is not None:
+            return StatsSuccess(snapshot)
+        return Stats()
+
+    @classmethod
+    def hello(cls, compressions: list[str]) -> Hello:
+        """Creates a Hello offering compressions (names of COMPRESSIONS)."""
+        return Hello(",".join(compressions))
+
+    @classmethod
+    def ack(cls, topic: str, seq: int) -> Ack:
+        """Creates an Ack of the messages of topic numbered up to seq."""
+        return Ack(topic, seq)
+
+    @classmethod
+    def encode_msg(
+        cls,
+        command: Command,
+        _type: Serializer = None,
+        topic: str = "",
+        message: Union[str, list[str]] = None,
+        compression: FrameFlag = FrameFlag.NONE,
+        **options,
+    ) -> bytes:
+        """Builds the wire frame (header + serializer + body) of a message.
+
+        options set optional fields of the message (e.g. seq=3); the ones
+        that are None are left out. With compression, bodies of at least
+        COMPRESS_THRESHOLD bytes are compressed.
+        """
+        builder = _builders.get(command)
+        if builder is None:
+            raise ValueError(f"Unsupported command: {command}")
+        msg = builder(topic, message)
+        for field, value in options.items():
+            setattr(msg, field, value)
+        return cls.frame(_type, cls.encode_body(_type, msg), compression)
+
+    @classmethod
+    def encode_body(cls, _type: Serializer, msg: Message) -> bytes:
+        """Serializes msg into the body of a frame."""
+        encoder = _encoders.get(_type)
+        if encoder is not None:
+            return encoder(msg)
+        return encoder_map[_type].encode(msg.to_dict())
+
+    @classmethod
+    def header(cls, _type: Serializer, size: int, flags: FrameFlag = 0) -> bytes:
+        """Builds the header of a frame with a body of size bytes."""
+        if size <= MAX_COMPACT_BODY:
+            header = (size + 2).to_bytes(2, byteorder="big")
+        else:
+            header = EXTENDED_LENGTH.to_bytes(2, byteorder="big") + (size + 2).to_bytes(
+                4, byteorder="big"
+            )
+        return header + (flags << 8 | _type.value).to_bytes(2, byteorder="big")
+
+    @classmethod
+    def frame(
+        cls, _type: Serializer, body: bytes, compression: FrameFlag = FrameFlag.NONE
+    ) -> bytes:
+        """Wraps an encoded body in one frame, or in chunks if it is large.
+
+        With compression, a body of at least COMPRESS_THRESHOLD bytes is
+        compressed, and flagged as such, if that makes it smaller.
+
+        Chunks only bound what a reader buffers per frame: they are not
+        streamed, the whole chunked frame is built in memory next to body.
+        """
+        flags = FrameFlag.NONE
+        if compression and len(body) >= COMPRESS_THRESHOLD:
+            packed = _compressors[compression][0](body)
+            if len(packed) < len(body):
+                body, flags = packed, compression
+
+        if len(body) <= MAX_COMPACT_BODY:
+            return cls.header(_type, len(body), flags) + body
+
+        view = memoryview(body)
+        parts = []
+        for start in range(0, len(body), CHUNK_SIZE):
+            chunk = view[start : start + CHUNK_SIZE]
+            more = start + CHUNK_SIZE < len(body)
+            parts.append(
+                cls.header(_type, len(chunk), flags | FrameFlag.MORE if more else flags)
+            )
+            parts.append(chunk)
+        return b"".join(parts)
+
+    @classmethod
+    def compress(cls, frame: bytes, compression: FrameFlag) -> bytes:
+        """Re-frames a whole encoded frame with its body compressed."""
+        reader = FrameReader(len(frame), max_message=max(len(frame), MAX_MESSAGE_SIZE))
+        reader.feed(frame)
+        serializer, body = reader.next_frame()
+        return cls.frame(serializer, body, compression)
+
+    @classmethod
+    def decompress(
+        cls, flags: FrameFlag, body: bytes, max_size: int = MAX_MESSAGE_SIZE
+    ) -> bytes:
+        """Returns the original body of a frame flagged with a compression.
+
+        Bodies that would decompress to more than max_size bytes are
+        rejected before that much is produced.
+        """
+        compression = flags & FrameFlag.COMPRESSED
+        if compression not in _compressors:
+            raise CDProtoBadFormat(f"Unsupported compression: {compression!r}")
+        try:
+            decompressor = _compressors[compression][1]()
+            data = decompressor.decompress(body, max_size + 1)
+        except Exception as e:
+            raise CDProtoBadFormat(f"Error decompressing message: {e}")
+        if len(data) > max_size:
+            raise CDProtoBadFormat("Message too large")
+        if not decompressor.eof:
+            raise CDProtoBadFormat("Error decompressing message: truncated")
+        return data
+
+    @classmethod
+    def transcode(cls, frame: bytes, _type: Serializer) -> bytes:
+        """Re-encodes a whole encoded frame with another serializer."""
+        reader = FrameReader(len(frame), max_message=max(len(frame), MAX_MESSAGE_SIZE))
+        reader.feed(frame)
+        serializer, body = reader.next_frame()
+        if serializer == _type:
+            return frame
+        return cls.frame(
+            _type, cls.encode_body(_type, cls.decode_msg(serializer, body))
+        )
+
+    @classmethod
+    def send_frame(cls, connection: socket, frame: bytes) -> None:
+        """Sends an already encoded frame, so it can be reused across sockets."""
+        try:
+            connection.send(frame)
+        except Exception as e:
+            raise CDProtoBadFormat(f"Error sending message: {e}")
+
     @classmethod
     def send_msg(
         cls,
@@ -84,61 +521,195 @@ class CDProto:
         _type: Serializer = None,
         topic: str = "",
         message: Union[str, list[str]] = None,
+        compression: FrameFlag = FrameFlag.NONE,
+        **options,
     ) -> None:
         """Sends a message to the broker based on the command type."""
         try:
-            if command == Command.SUBSCRIBE:
-                msg = cls.subscribe_topic(topic)
-            elif command == Command.PUBLISH:
-                msg = cls.publish_message(topic, message)
-            elif command == Command.TOPIC_LIST:
-                msg = cls.topic_list(message)
-            elif command == Command.UNSUBSCRIBE:
-                msg = cls.unsubscribe_topic(topic)
-            else:
-                raise ValueError(f"Unsupported command: {command}")
-
-            msg = encoder_map[_type].encode(msg.to_dict())
-
-            header = (len(msg) + 2).to_bytes(2, byteorder="big")
-            serializer = _type.value.to_bytes(2, byteorder="big")
-            connection.send(header + serializer + msg)
+            connection.send(
+                cls.encode_msg(command, _type, topic, message, compression, **options)
+            )
         except Exception as e:
             raise CDProtoBadFormat(f"Error sending message: {e}")
 
     @classmethod
-    def recv_msg(cls, connection: socket) -> Optional[tuple[Message, Serializer]]:
-        """Receives through a connection a Message object."""
+    def decode_msg(cls, serializer: Serializer, body: bytes) -> Message:
+        """Decodes the body of a frame into a Message object."""
         try:
-            # Receive the message length header
-            h = int.from_bytes(connection.recv(2), "big")
+            decoder = _decoders.get(serializer)
+            if decoder is not None:
+                return decoder(body).validate()
 
-            if h == 0:
-                return None
-
-            serializer = Serializer(int.from_bytes(connection.recv(2), "big"))
-
-            message = connection.recv(h - 2)
-            dictionary = encoder_map[serializer].decode(message)
-            command = Command(dictionary["command"])
-
-            if command == Command.SUBSCRIBE:
-                return CDProto.subscribe_topic(dictionary["topic"]), serializer
-            elif command == Command.PUBLISH:
-                return (
-                    CDProto.publish_message(dictionary["topic"], dictionary["message"]),
-                    serializer,
-                )
-            elif command == Command.TOPIC_LIST:
-                return CDProto.topic_list(dictionary["message"]), serializer
-            elif command == Command.UNSUBSCRIBE:
-                return CDProto.unsubscribe_topic(dictionary["topic"]), serializer
-            else:
+            dictionary = encoder_map[serializer].decode(body)
+            kind = message_types.get(dictionary["command"])
+            if kind is None:
                 raise ValueError(f"Unsupported command: {dictionary['command']}")
+            return kind.from_dict(dictionary).validate()
+        except Exception as e:
+            raise CDProtoBadFormat(f"Error decoding message: {e}")
+
+    @classmethod
+    def _recv_exact(cls, connection: socket, size: int) -> bytes:
+        """Receives exactly size bytes, or fewer if the peer closed."""
+        data = connection.recv(size)
+        while data and len(data) < size:
+            chunk = connection.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    @classmethod
+    def recv_msg(cls, connection: socket) -> Optional[tuple[Message, Serializer]]:
+        """Receives through a connection a Message object.
+
+        The chunks of a large message are joined in memory before decoding,
+        up to MAX_MESSAGE_SIZE bytes.
+        """
+        try:
+            body = bytearray()
+            flags = FrameFlag.MORE
+            while flags & FrameFlag.MORE:
+                # Receive the message length header
+                h = int.from_bytes(cls._recv_exact(connection, 2), "big")
+
+                if h == 0:
+                    return None
+                if h == EXTENDED_LENGTH:
+                    h = int.from_bytes(cls._recv_exact(connection, 4), "big")
+                if not 2 <= h <= MAX_FRAME_LENGTH:
+                    raise CDProtoBadFormat(f"Invalid frame length: {h}")
+                if len(body) + h - 2 > MAX_MESSAGE_SIZE:
+                    raise CDProtoBadFormat("Message too large")
+
+                field = int.from_bytes(cls._recv_exact(connection, 2), "big")
+                serializer, flags = _split_field(field)
+
+                body += cls._recv_exact(connection, h - 2)
+            if flags & FrameFlag.COMPRESSED:
+                body = cls.decompress(flags, body)
+            return cls.decode_msg(serializer, body), serializer
+        except CDProtoBadFormat:
+            raise
         except Exception as e:
             raise CDProtoBadFormat(f"Error receiving message: {e}")
 
 
+class FrameReader:
+    """Incremental parser of CDProto frames read from a stream.
+
+    Bytes are received with a single recv_into into a reusable buffer and
+    every complete frame in it is handed out as a memoryview, so a burst of
+    small messages costs one syscall. Partial frames stay buffered until the
+    next read. Frames must be consumed before calling recv/feed again.
+
+    Chunked messages are joined as their frames arrive, so the receive
+    buffer never holds more than one chunk of a large message. Only that
+    buffer is bounded by the chunking: the joined message (up to
+    max_message bytes) is a separate copy, and it coexists with its
+    decompressed and decoded forms until the caller drops it.
+
+    Frames longer than MAX_FRAME_LENGTH and messages over max_message bytes
+    are rejected with CDProtoBadFormat before anything is buffered for
+    them; so are compressed ones that would decompress past max_message,
+    and those compressed with anything but compressions (e.g.
+    FrameFlag.NONE until negotiated).
+    """
+
+    def __init__(
+        self,
+        size: int = 64 * 1024,
+        max_message: int = MAX_MESSAGE_SIZE,
+        compressions: FrameFlag = FrameFlag.COMPRESSED,
+    ):
+        self.max_message = max_message
+        self.compressions = compressions
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._chunks: Optional[bytearray] = None
+
+    def _reserve(self, size: int):
+        """Makes room for at least size more bytes after the buffered ones."""
+        pending = self._end - self._start
+        if self._start and len(self._buffer) - self._end < size:
+            self._buffer[:pending] = self._buffer[self._start : self._end]
+            self._start, self._end = 0, pending
+        if len(self._buffer) - self._end < size:
+            buffer = bytearray(max(2 * len(self._buffer), pending + size))
+            buffer[:pending] = self._view[self._start : self._end]
+            self._buffer, self._view = buffer, memoryview(buffer)
+            self._start, self._end = 0, pending
+
+    def recv(self, connection: socket) -> int:
+        """Reads what is available from connection; returns 0 once it closes."""
+        if self._end == len(self._buffer):
+            self._reserve(len(self._buffer) // 2)
+        size = connection.recv_into(self._view[self._end :])
+        self._end += size
+        return size
+
+    def feed(self, data: bytes):
+        """Appends data read from elsewhere (e.g. an asyncio stream)."""
+        self._reserve(len(data))
+        self._view[self._end : self._end + len(data)] = data
+        self._end += len(data)
+
+    def next_frame(self) -> Optional[tuple[Serializer, memoryview]]:
+        """Returns the next complete (serializer, body), or None if incomplete."""
+        while True:
+            available = self._end - self._start
+            if available < 4:
+                return None
+
+            start = self._start
+            h = int.from_bytes(self._view[start : start + 2], "big")
+            offset = 2
+            if h == EXTENDED_LENGTH:
+                if available < 8:
+                    return None
+                h = int.from_bytes(self._view[start + 2 : start + 6], "big")
+                offset = 6
+            if not 2 <= h <= MAX_FRAME_LENGTH:
+                raise CDProtoBadFormat(f"Invalid frame length: {h}")
+            joined = 0 if self._chunks is None else len(self._chunks)
+            if joined + h - 2 > self.max_message:
+                raise CDProtoBadFormat("Message too large")
+            if available < offset + h:
+                self._reserve(offset + h - available)
+                return None
+
+            field = int.from_bytes(
+                self._view[start + offset : start + offset + 2], "big"
+            )
+            serializer, flags = _split_field(field)
+            if flags & FrameFlag.COMPRESSED & ~int(self.compressions):
+                raise CDProtoBadFormat(f"Compression not accepted: {flags!r}")
+            body = self._view[start + offset + 2 : start + offset + h]
+            self._start += offset + h
+            if self._start == self._end:
+                self._start = self._end = 0
+
+            if flags & FrameFlag.MORE:
+                if self._chunks is None:
+                    self._chunks = bytearray()
+                self._chunks += body
+                continue
+            if self._chunks is not None:
+                self._chunks += body
+                body, self._chunks = memoryview(self._chunks), None
+            if flags & FrameFlag.COMPRESSED:
+                body = memoryview(CDProto.decompress(flags, body, self.max_message))
+            return serializer, body
+
+    def __iter__(self):
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+
 class CDProtoBadFormat(Exception):
     """Exception when the source message is not CDProto."""
 
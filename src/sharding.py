@@ -0,0 +1,337 @@
+"""Multi-process broker where each worker owns part of the topic space."""
+
+import multiprocessing
+import socket
+import zlib
+from typing import Iterable, Optional
+
+from src.broker import Broker
+from src.consts import Command, Serializer
+from src.delivery import DEFAULT_WINDOW
+from src.protocol import (
+    CDProto,
+    Message,
+    PublishBatch,
+    PublishMessage,
+    TopicListSuccess,
+)
+from src.topics import TopicNode, TopicTrie, is_pattern
+
+# serializer used on the links between workers
+LINK_SERIALIZER = Serializer.PICKLE
+
+
+def root_of(topic: str) -> str:
+    """Returns the first segment of topic ("weather2" for "/weather2/humidity")."""
+    return topic.lstrip("/").split("/", 1)[0]
+
+
+def shard_of(topic: str, shards: int) -> int:
+    """Returns the index of the worker that owns topic."""
+    return zlib.crc32(root_of(topic).encode("utf-8")) % shards
+
+
+class ShardWorker(Broker):
+    """Broker process owning the topics whose root hashes to its index.
+
+    Clients connect to any worker. The owner of a topic keeps its retained
+    value and receives every publish to it, forwarded by the worker the
+    producer is connected to. Workers holding local subscribers of a topic
+    register interest with its owner over a link (a socketpair speaking
+    CDProto), and the owner sends them each publish once, under the original
+    topic, so they fan it out to their own subscribers. Topics under the
+    empty root ("" itself) span every shard, so interest in them is
+    registered with all workers, and so are wildcard patterns whose root is
+    "+" or "#".
+    """
+
+    def __init__(
+        self, index: int, shards: int, links: dict[int, socket.socket], **kwargs
+    ):
+        if kwargs.get("store_path") is not None:
+            # every worker keeps the values of its own topics
+            kwargs["store_path"] = f"{kwargs['store_path']}.{index}"
+        super().__init__(**kwargs)
+        self.index = index
+        self.shards = shards
+        self.socket.setblocking(False)
+
+        self._links = links
+        self._peers = {link: i for i, link in links.items()}
+        for link in links.values():
+            self.register(link)
+
+        # remote topic -> number of local subscribers (owner knows we care)
+        self._remote_interest: dict[str, int] = {}
+        # topic -> links of workers interested in it
+        self._peer_interest: dict[str, set[socket.socket]] = {}
+        # wildcard patterns other workers subscribed to, with their links
+        self._peer_patterns = TopicTrie()
+        # topics announced by other workers
+        self._announced: set[str] = set()
+
+        restored = [node.name for node in self.topics if node.has_value]
+        restored = [topic for topic in restored if self._owned(topic)]
+        if restored:
+            for link in self._links.values():
+                self._send_link(link, Command.TOPIC_LIST_SUCCESS, "", restored)
+
+    def _owned(self, topic: str) -> bool:
+        return shard_of(topic, self.shards) == self.index
+
+    def _interested_links(self, topic: str) -> list[socket.socket]:
+        """Links to the workers that must know about local interest in topic."""
+        if not root_of(topic) or is_pattern(root_of(topic)):
+            return list(self._links.values())
+        owner = shard_of(topic, self.shards)
+        return [] if owner == self.index else [self._links[owner]]
+
+    def _send_link(
+        self, link: socket.socket, command: Command, topic: str, message=None
+    ):
+        self.send(link, CDProto.encode_msg(command, LINK_SERIALIZER, topic, message))
+
+    def send(self, conn: socket.socket, frame: bytes):
+        """Queue frame; links between workers are never shed or dropped."""
+        if conn in self._peers:
+            self._outbox[conn] += frame
+            self._dirty.add(conn)
+            return
+        super().send(conn, frame)
+
+    def handle(self, conn: socket.socket, msg: Message, serializer: Serializer):
+        """Route publishes to their owner; deliver the ones coming from it."""
+        if isinstance(msg, (PublishMessage, PublishBatch)) and not self._owned(
+            msg.topic
+        ):
+            if conn in self._peers:
+                # a publish forwarded by its owner, for our local subscribers
+                super().handle(conn, msg, serializer)
+            else:
+                owner = self._links[shard_of(msg.topic, self.shards)]
+                if isinstance(msg, PublishBatch):
+                    self._send_link(owner, msg.command, msg.topic, msg.messages)
+                else:
+                    self._send_link(owner, msg.command, msg.topic, msg.message)
+            return
+        if isinstance(msg, TopicListSuccess) and conn in self._peers:
+            self._announced.update(msg.message)
+            return
+        super().handle(conn, msg, serializer)
+
+    def list_topics(self) -> list[str]:
+        """Returns the topics with values on any worker."""
+        topics = super().list_topics()
+        return topics + [topic for topic in self._announced if topic not in topics]
+
+    def put_topic(self, topic: str, value) -> TopicNode:
+        """Store value in topic, announcing topics new to the other workers."""
+        new = topic not in self.topics or not self.topics.find(topic).has_value
+        node = super().put_topic(topic, value)
+        if new and self._owned(topic):
+            for link in self._links.values():
+                self._send_link(link, Command.TOPIC_LIST_SUCCESS, "", [topic])
+        return node
+
+    def _fan_out(self, node: TopicNode, command: Command, message):
+        """Fan out locally, then once to every interested worker if we own it."""
+        super()._fan_out(node, command, message)
+        if not self._owned(node.name):
+            return
+
+        links: set[socket.socket] = set()
+        for level in node.lineage():
+            links.update(self._peer_interest.get(level.name, ()))
+        for match in self._peer_patterns.match(node.name):
+            links.update(match.subscribers)
+        if links:
+            frame = CDProto.encode_msg(command, LINK_SERIALIZER, node.name, message)
+            for link in links:
+                self.send(link, frame)
+
+    def subscribe(
+        self,
+        topic: str,
+        address: socket.socket,
+        _format: Serializer = None,
+        last: Optional[int] = None,
+        since: Optional[int] = None,
+    ):
+        """Subscribe to topic, registering interest with its owner if needed.
+
+        History is replayed from this worker's own history of topic.
+        """
+        if address in self._peers:
+            if is_pattern(topic):
+                self._peer_patterns.insert(topic).subscribers[address] = LINK_SERIALIZER
+                nodes = list(self.topics.expand(topic))
+            else:
+                self._peer_interest.setdefault(topic, set()).add(address)
+                nodes = [self.topics.find(topic)]
+            for node in nodes:
+                if node is not None and node.has_value and self._owned(node.name):
+                    self._send_link(address, Command.PUBLISH, node.name, node.value)
+            return
+
+        links = self._interested_links(topic)
+        if not links:
+            super().subscribe(topic, address, _format, last, since)
+            return
+
+        if is_pattern(topic):
+            if topic in self._remote_interest:
+                super().subscribe(topic, address, _format)
+            else:
+                # the other workers answer the registration with their values
+                self._add_subscriber(self.wildcards.insert(topic), address, _format)
+                for node in self.topics.expand(topic):
+                    if node.has_value and self._owned(node.name):
+                        self._send_retained(node, address, _format)
+            self._register_interest(topic, links)
+            return
+
+        node = self.topics.insert(topic)
+        covered = any(level.name in self._remote_interest for level in node.lineage())
+        if covered or self._owned(topic):
+            # every publish to topic already reaches us: the value is current
+            super().subscribe(topic, address, _format, last, since)
+        else:
+            # the owner answers the registration with the retained value
+            self._add_subscriber(node, address, _format)
+        self._register_interest(topic, links)
+
+    def subscribe_reliable(
+        self,
+        topic: str,
+        address: socket.socket,
+        _format: Serializer,
+        client: str,
+        window: int = DEFAULT_WINDOW,
+    ):
+        """As Broker.subscribe_reliable, registering interest with the owner.
+
+        The session lives on this worker; its interest stays registered until
+        it ends, so it keeps collecting publishes while detached.
+        """
+        new = (client, topic) not in self._sessions
+        super().subscribe_reliable(topic, address, _format, client, window)
+        links = self._interested_links(topic)
+        if new and links:
+            self._register_interest(topic, links)
+
+    def _retained_nodes(self, topic: str, node: TopicNode) -> Iterable[TopicNode]:
+        """Only the values kept current here, as with subscribe.
+
+        The other workers answer the registration of interest with theirs.
+        """
+        nodes = super()._retained_nodes(topic, node)
+        if not self._interested_links(topic) or topic in self._remote_interest:
+            return nodes
+        if is_pattern(topic):
+            return [retained for retained in nodes if self._owned(retained.name)]
+        covered = any(level.name in self._remote_interest for level in node.lineage())
+        return nodes if covered or self._owned(topic) else []
+
+    def _register_interest(self, topic: str, links: list[socket.socket]):
+        self._remote_interest[topic] = self._remote_interest.get(topic, 0) + 1
+        if self._remote_interest[topic] == 1:
+            for link in links:
+                self._send_link(link, Command.SUBSCRIBE, topic)
+
+    def unsubscribe(self, topic: str, address: socket.socket):
+        """Unsubscribe, withdrawing interest once the last local subscriber left."""
+        if address in self._peers:
+            if is_pattern(topic):
+                node = self._peer_patterns.find(topic)
+                if node is not None:
+                    node.subscribers.pop(address, None)
+            else:
+                self._peer_interest.get(topic, set()).discard(address)
+            return
+
+        node = self._trie(topic).find(topic)
+        subscribed = node is not None and node in self._subscriptions.get(address, ())
+        super().unsubscribe(topic, address)
+        if not subscribed or topic not in self._remote_interest:
+            return
+
+        self._remote_interest[topic] -= 1
+        if not self._remote_interest[topic]:
+            del self._remote_interest[topic]
+            for link in self._interested_links(topic):
+                self._send_link(link, Command.UNSUBSCRIBE, topic)
+
+    def disconnect(self, conn: socket.socket):
+        """Drop a client, or every interest registered through a dead link."""
+        if conn in self._peers:
+            for links in self._peer_interest.values():
+                links.discard(conn)
+            for node in self._peer_patterns:
+                node.subscribers.pop(conn, None)
+            del self._links[self._peers.pop(conn)]
+        super().disconnect(conn)
+
+
+def _run_worker(index: int, links: list[dict[int, socket.socket]], kwargs):
+    # only keep this worker's ends, so a dead peer is seen as a closed link
+    for i, worker_links in enumerate(links):
+        if i != index:
+            [link.close() for link in worker_links.values()]
+    ShardWorker(index, len(links), links[index], **kwargs).run()
+
+
+class ShardedBroker:
+    """Runs <workers> ShardWorker processes accepting on the same socket."""
+
+    def __init__(
+        self, workers: int, host: str = "localhost", port: int = 5000, **kwargs
+    ):
+        """Bind the shared listening socket."""
+        self.workers = workers
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(100)
+        self._kwargs = kwargs
+        self._processes: list[multiprocessing.Process] = []
+
+    def start(self):
+        """Fork the workers, each with a link to every other one."""
+        links: list[dict[int, socket.socket]] = [{} for _ in range(self.workers)]
+        for i in range(self.workers):
+            for j in range(i + 1, self.workers):
+                links[i][j], links[j][i] = socket.socketpair()
+
+        context = multiprocessing.get_context("fork")
+        for index in range(self.workers):
+            kwargs = dict(self._kwargs, sock=self.socket)
+            process = context.Process(
+                target=_run_worker,
+                args=(index, links, kwargs),
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+
+        # the workers own their copies now
+        for worker_links in links:
+            for link in worker_links.values():
+                link.close()
+
+    def stop(self):
+        """Terminate the workers and close the listening socket."""
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            process.join()
+        self._processes.clear()
+        self.socket.close()
+
+    def run(self, timeout: Optional[float] = None):
+        """Run the workers until they exit (or until interrupted)."""
+        self.start()
+        try:
+            for process in self._processes:
+                process.join(timeout)
+        finally:
+            self.stop()
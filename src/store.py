@@ -0,0 +1,191 @@
+"""Durable store of the retained value of every topic."""
+
+import mmap
+import os
+import pickle
+import struct
+import time
+import zlib
+from typing import Any, Iterator, Optional
+
+MAGIC = b"CDR1"
+
+
+class RetainedStore:
+    """Append-only, memory-mapped log of (topic, value) records.
+
+    record = size:u32 crc32:u32 topic_len:u16 topic:utf8 value:pickle
+
+    Every put appends a record to the mapped file; the latest record of a
+    topic wins. The log is only msync'ed by commit, at most once every
+    sync_interval seconds, so a burst of publishes shares one sync (group
+    commit) and a crash loses at most that window. Once the log holds more
+    than compact_ratio times the bytes of the live records, commit rewrites
+    it with only those, so opening it reads about as much as there are live
+    topics regardless of how many values were ever published.
+
+    The file is grown ahead of the records and the unused tail is zero, so
+    a size of 0 (or a record with a bad checksum, torn by a crash) marks the
+    end of the log.
+    """
+
+    _record = struct.Struct(">II")
+    _u16 = struct.Struct(">H")
+
+    def __init__(
+        self,
+        path: str,
+        sync_interval: float = 0.05,
+        compact_ratio: float = 2.0,
+        min_compact_size: int = 1024 * 1024,
+    ):
+        """Open (or create) the log at path and index its records."""
+        self.path = path
+        self.sync_interval = sync_interval
+        self.compact_ratio = compact_ratio
+        self.min_compact_size = min_compact_size
+
+        # topic -> (offset, size) of its latest record
+        self._index: dict[str, tuple[int, int]] = {}
+        self._live = 0
+        self._end = len(MAGIC)
+        self._dirty = False
+        self._synced = time.monotonic()
+
+        if not os.path.exists(path) or not os.path.getsize(path):
+            with open(path, "wb") as file:
+                file.write(MAGIC)
+        self._file = open(path, "r+b")
+        self._map: Optional[mmap.mmap] = None
+        self._remap(max(os.fstat(self._file.fileno()).st_size, 64 * 1024))
+        if self._map[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a retained value log")
+        self._scan()
+
+    def _remap(self, size: int):
+        if self._map is not None:
+            self._map.close()
+        if os.fstat(self._file.fileno()).st_size < size:
+            self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def _scan(self):
+        """Index the records of the log, stopping at its end or a torn one."""
+        view = self._map
+        offset = len(MAGIC)
+        while offset + self._record.size <= len(view):
+            size, crc = self._record.unpack_from(view, offset)
+            start = offset + self._record.size
+            if not size or start + size > len(view):
+                break
+            if zlib.crc32(view[start : start + size]) != crc:
+                break
+            (length,) = self._u16.unpack_from(view, start)
+            topic = str(view[start + 2 : start + 2 + length], "utf-8")
+            self._put_index(topic, offset, self._record.size + size)
+            offset = start + size
+        self._end = offset
+        # clear whatever a crash left after the last good record
+        view[offset : offset + self._record.size] = bytes(
+            min(self._record.size, len(view) - offset)
+        )
+
+    def _put_index(self, topic: str, offset: int, size: int):
+        previous = self._index.get(topic)
+        if previous is not None:
+            self._live -= previous[1]
+        self._index[topic] = (offset, size)
+        self._live += size
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, topic: str) -> bool:
+        return topic in self._index
+
+    def get(self, topic: str) -> Any:
+        """Returns the stored value of topic, or None."""
+        location = self._index.get(topic)
+        if location is None:
+            return None
+        offset, _ = location
+        size, _ = self._record.unpack_from(self._map, offset)
+        start = offset + self._record.size
+        (length,) = self._u16.unpack_from(self._map, start)
+        return pickle.loads(self._map[start + 2 + length : start + size])
+
+    def items(self) -> Iterator[tuple[str, Any]]:
+        """Yields the (topic, value) of every stored topic."""
+        for topic in self._index:
+            yield topic, self.get(topic)
+
+    def put(self, topic: str, value: Any):
+        """Append the new value of topic; it is durable after the next commit."""
+        data = topic.encode("utf-8")
+        payload = self._u16.pack(len(data)) + data + pickle.dumps(value)
+        size = self._record.size + len(payload)
+
+        # keep room for the zero size that marks the end of the log
+        needed = self._end + size + self._record.size
+        if needed > len(self._map):
+            self._remap(max(2 * len(self._map), needed))
+
+        offset = self._end
+        self._record.pack_into(self._map, offset, len(payload), zlib.crc32(payload))
+        self._map[offset + self._record.size : offset + size] = payload
+        self._end += size
+        self._put_index(topic, offset, size)
+        self._dirty = True
+
+    def due(self) -> Optional[float]:
+        """Seconds until pending records must be committed, None if none are."""
+        if not self._dirty:
+            return None
+        return max(0.0, self._synced + self.sync_interval - time.monotonic())
+
+    def commit(self, force: bool = False):
+        """Sync the records appended since the last commit, if it is time to."""
+        if not self._dirty or (not force and self.due()):
+            return
+        if self._end > self.min_compact_size and (
+            self._end > self.compact_ratio * self._live
+        ):
+            self.compact()
+        else:
+            self._map.flush()
+        self._dirty = False
+        self._synced = time.monotonic()
+
+    def compact(self):
+        """Rewrite the log with only the latest record of every topic."""
+        log = bytearray(MAGIC)
+        index = {}
+        for topic, (offset, size) in self._index.items():
+            index[topic] = (len(log), size)
+            log += self._map[offset : offset + size]
+
+        path = f"{self.path}.compact"
+        with open(path, "wb") as file:
+            file.write(log)
+            file.truncate(max(2 * len(log), 64 * 1024))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path, self.path)
+
+        self._map.close()
+        self._map = None
+        self._file.close()
+        self._file = open(self.path, "r+b")
+        self._remap(os.fstat(self._file.fileno()).st_size)
+        self._index = index
+        self._end = len(log)
+        self._live = len(log) - len(MAGIC)
+
+    def close(self):
+        """Commit pending records and release the file."""
+        if self._map is None:
+            return
+        self.commit(force=True)
+        self._map.close()
+        self._map = None
+        self._file.close()
@@ -0,0 +1,190 @@
+"""Hierarchical topic index shared by the broker."""
+
+from socket import socket
+from typing import Any, Iterator, Optional
+
+from src.consts import Serializer
+from src.history import History
+
+subscriber_type = tuple[socket, Serializer]
+
+SINGLE_LEVEL = "+"
+MULTI_LEVEL = "#"
+
+
+def is_pattern(topic: str) -> bool:
+    """Returns whether topic has a "+" or "#" level (MQTT style wildcards)."""
+    return any(part in (SINGLE_LEVEL, MULTI_LEVEL) for part in topic.split("/"))
+
+
+def is_reserved(topic: str) -> bool:
+    """Returns whether topic is one of the broker's own ("$SYS/...")."""
+    return topic.startswith("$")
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    """Returns whether topic is matched by pattern.
+
+    "+" matches exactly one level and "#", only valid as the last level,
+    matches the rest of the topic, including no levels at all ("a/#" matches
+    "a"). A pattern with "#" anywhere else matches nothing. As in MQTT,
+    reserved topics are only matched by patterns that name their first level.
+    """
+    parts = topic.split("/")
+    levels = pattern.split("/")
+    if is_reserved(topic) and levels[0] in (SINGLE_LEVEL, MULTI_LEVEL):
+        return False
+    for i, level in enumerate(levels):
+        if level == MULTI_LEVEL:
+            return i == len(levels) - 1
+        if i >= len(parts) or (level != SINGLE_LEVEL and level != parts[i]):
+            return False
+    return len(parts) == len(levels)
+
+
+class TopicNode:
+    """A single level of the topic hierarchy.
+
+    `name` is the full topic string of this level (e.g. "/weather2/temperature"),
+    so the publish path never has to rebuild prefixes with "/".join.
+    """
+
+    __slots__ = (
+        "name",
+        "parent",
+        "children",
+        "subscribers",
+        "value",
+        "has_value",
+        "history",
+    )
+
+    def __init__(self, name: Optional[str], parent: Optional["TopicNode"] = None):
+        self.name = name
+        self.parent = parent
+        self.children: dict[str, TopicNode] = {}
+        self.subscribers: dict[socket, Serializer] = {}
+        self.value: Any = None
+        self.has_value = False
+        # recent frames fanned out at this level, if the broker keeps any
+        self.history: Optional[History] = None
+
+    def lineage(self) -> Iterator["TopicNode"]:
+        """Yields this node and every ancestor up to (excluding) the root."""
+        node = self
+        while node.parent is not None:
+            yield node
+            node = node.parent
+
+
+class TopicTrie:
+    """Trie of topics split on "/", with an index from full name to node.
+
+    Looking a topic up is a single dict access; walking to the ancestors uses
+    the parent links, so a publish costs O(depth) regardless of how many
+    topics exist.
+    """
+
+    def __init__(self):
+        self.root = TopicNode(None)
+        self._index: dict[str, TopicNode] = {}
+
+    def __contains__(self, topic: str) -> bool:
+        return topic in self._index
+
+    def __iter__(self) -> Iterator[TopicNode]:
+        return iter(self._index.values())
+
+    def find(self, topic: str) -> Optional[TopicNode]:
+        """Returns the node of topic, or None if it was never created."""
+        return self._index.get(topic)
+
+    def insert(self, topic: str) -> TopicNode:
+        """Returns the node of topic, creating it and its ancestors if needed."""
+        node = self._index.get(topic)
+        if node is not None:
+            return node
+
+        node = self.root
+        for i, part in enumerate(topic.split("/")):
+            child = node.children.get(part)
+            if child is None:
+                name = part if node is self.root else f"{node.name}/{part}"
+                child = TopicNode(name, node)
+                node.children[part] = child
+                self._index[name] = child
+            node = child
+        return node
+
+    def match(self, topic: str) -> list[TopicNode]:
+        """Returns the nodes of the patterns matching topic that have subscribers.
+
+        For a trie of wildcard subscriptions: only the "+" and exact branches
+        along topic are walked, so the cost depends on the depth of topic and
+        on how many patterns match it, not on how many patterns there are.
+        """
+        matches = []
+        level = [self.root]
+        parts = topic.split("/")
+        if is_reserved(parts[0]):
+            # wildcards in the first level don't reach reserved topics
+            child = self.root.children.get(parts[0])
+            level = [] if child is None else [child]
+            parts = parts[1:]
+        for part in parts:
+            if not level:
+                break
+            below = []
+            for node in level:
+                multi = node.children.get(MULTI_LEVEL)
+                if multi is not None:
+                    matches.append(multi)
+                for key in (part, SINGLE_LEVEL):
+                    child = node.children.get(key)
+                    if child is not None:
+                        below.append(child)
+            level = below
+        for node in level:
+            matches.append(node)
+            multi = node.children.get(MULTI_LEVEL)
+            if multi is not None:
+                matches.append(multi)
+        return [node for node in matches if node.subscribers]
+
+    def _children(self, node: TopicNode) -> Iterator[TopicNode]:
+        """Children a wildcard level can reach (no reserved topics at the root)."""
+        if node is not self.root:
+            return iter(node.children.values())
+        return (c for part, c in node.children.items() if not is_reserved(part))
+
+    def expand(self, pattern: str) -> Iterator[TopicNode]:
+        """Yields the nodes of the topics matched by pattern."""
+        parts = pattern.split("/")
+        level = [self.root]
+        for i, part in enumerate(parts):
+            if part == MULTI_LEVEL:
+                if i != len(parts) - 1:
+                    return
+                stack = list(level)
+                while stack:
+                    node = stack.pop()
+                    if node is not self.root:
+                        yield node
+                    stack.extend(self._children(node))
+                return
+            if part == SINGLE_LEVEL:
+                level = [child for node in level for child in self._children(node)]
+            else:
+                level = [node.children[part] for node in level if part in node.children]
+        yield from level
+
+    def topics(self) -> list[str]:
+        """Returns the names of all topics that currently hold a value.
+
+        Reserved topics are left out.
+        """
+        return [
+            node.name
+            for node in self._index.values()
+            if node.has_value and not is_reserved(node.name)
+        ]
@@ -0,0 +1,111 @@
+"""Transports a broker is reached by: TCP or a Unix domain socket.
+
+Addresses are (host, port) tuples or URLs, "tcp://host:port" or
+"unix:///path/to/socket". Frames are the same on both; a Unix socket
+skips the TCP/IP stack, which pays off for clients on the broker's host.
+"""
+
+import errno
+import os
+import socket
+import stat
+import weakref
+from typing import Tuple, Union
+from urllib.parse import urlsplit
+
+Address = Union[str, Tuple[str, int]]
+
+# (device, inode, change time) of the file each Unix socket from listen was
+# bound to; inodes get reused
+_bound: "weakref.WeakKeyDictionary[socket.socket, Tuple[int, int, int]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def parse(address: Address) -> Tuple[int, Union[str, Tuple[str, int]]]:
+    """Returns the (socket family, socket address) of address."""
+    if isinstance(address, tuple):
+        return socket.AF_INET, address
+
+    url = urlsplit(address)
+    if url.scheme == "tcp":
+        if url.hostname is None or url.port is None:
+            raise ValueError(f"Expected tcp://host:port, got {address}")
+        return socket.AF_INET, (url.hostname, url.port)
+    if url.scheme == "unix":
+        path = url.netloc + url.path
+        if not path:
+            raise ValueError(f"Expected unix:///path, got {address}")
+        return socket.AF_UNIX, path
+    raise ValueError(f"Unsupported transport: {address}")
+
+
+def connect(address: Address) -> socket.socket:
+    """Opens a connection to address."""
+    family, target = parse(address)
+    if family == socket.AF_INET:
+        return socket.create_connection(target)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect(target)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def listen(address: Address, backlog: int = 100) -> socket.socket:
+    """Returns a socket listening on address.
+
+    A Unix socket left at the path by a broker that didn't exit cleanly
+    (nothing accepts connections on it) is removed first; anything else
+    there, a live socket or another kind of file, raises OSError.
+    """
+    family, target = parse(address)
+    if family != socket.AF_INET:
+        _remove_stale(target)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(target)
+        sock.listen(backlog)
+    except OSError:
+        sock.close()
+        raise
+    if family != socket.AF_INET:
+        info = os.stat(target)
+        _bound[sock] = (info.st_dev, info.st_ino, info.st_ctime_ns)
+    return sock
+
+
+def _remove_stale(path: str):
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(errno.EEXIST, "Not a socket", path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise OSError(errno.EADDRINUSE, "Already listened on", path)
+
+
+def unlink(path: str, sock: socket.socket):
+    """Removes the file at path if it is still the one sock was bound to.
+
+    A file that replaced it since (e.g. another broker's socket) is kept.
+    """
+    bound = _bound.pop(sock, None)
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return
+    if (info.st_dev, info.st_ino, info.st_ctime_ns) == bound:
+        os.unlink(path)
@@ -1,9 +1,11 @@
+import html
 import json
 import pickle
-import xml.etree.ElementTree as ET
-from typing import Type, Union
+import re
+import struct
+from typing import Any, Iterable, Optional, Type, Union
 
-from src.consts import Serializer
+from src.consts import Command, Serializer
 
 
 class JsonUtils:
@@ -13,20 +15,93 @@ class JsonUtils:
 
     @classmethod
     def decode(cls, message: bytes) -> dict:
-        return json.loads(message.decode("utf-8"))
+        return json.loads(str(message, "utf-8"))
 
 
 class XmlUtils:
+    """Flat <message key="value" ... /> documents.
+
+    Messages are written through a template cached per set of keys and read
+    back with a regular expression, without building an element tree. Values
+    that aren't strings are listed in an extra "types" attribute
+    (e.g. types="message:int"), so they are decoded to the same type; peers
+    that don't know it just see one more attribute.
+    """
+
+    _escape = str.maketrans(
+        {
+            "&": "&amp;",
+            "<": "&lt;",
+            ">": "&gt;",
+            '"': "&quot;",
+            "\n": "&#10;",
+            "\r": "&#13;",
+            "\t": "&#09;",
+        }
+    )
+    _attribute = re.compile(r"""(\w+)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+    _templates: dict[tuple[str, ...], str] = {}
+
+    _types = {int: "int", float: "float", bool: "bool", type(None): "none"}
+    _parsers = {
+        "int": int,
+        "float": float,
+        "bool": lambda value: value == "True",
+        "none": lambda value: None,
+        "json": json.loads,
+        "bytes": bytes.fromhex,
+    }
+
+    @classmethod
+    def _template(cls, keys: tuple[str, ...]) -> str:
+        template = cls._templates.get(keys)
+        if template is None:
+            attributes = " ".join(f'{key}="{{}}"' for key in keys)
+            template = cls._templates[keys] = f"<message {attributes} />"
+        return template
+
     @classmethod
     def encode(cls, message: dict) -> bytes:
-        for key in message:
-            message[key] = str(message[key])
+        return cls.encode_items(tuple(message), message.values())
+
+    @classmethod
+    def encode_items(cls, keys: tuple[str, ...], values: Iterable[Any]) -> bytes:
+        """Encodes the attributes keys with values, without building a dict."""
+        texts = []
+        types = []
+        for key, value in zip(keys, values):
+            if not isinstance(value, str):
+                _type = cls._types.get(type(value))
+                if _type is not None:
+                    value = str(value)
+                elif isinstance(value, (bytes, bytearray)):
+                    _type, value = "bytes", value.hex()
+                else:
+                    _type, value = "json", json.dumps(value)
+                types.append(f"{key}:{_type}")
+            texts.append(value.translate(cls._escape))
 
-        return ET.tostring(ET.Element("message", message))
+        if types:
+            keys += ("types",)
+            texts.append(" ".join(types))
+        return cls._template(keys).format(*texts).encode("utf-8")
 
     @classmethod
     def decode(cls, message: bytes) -> dict:
-        return ET.XML(message.decode("utf-8")).attrib
+        text = str(message, "utf-8")
+        start = text.find("<message")
+        if start < 0:
+            raise ValueError("Not a CDProto XML message")
+
+        result = {}
+        for key, double, single in cls._attribute.findall(text, start):
+            value = double or single
+            result[key] = html.unescape(value) if "&" in value else value
+
+        for field in result.pop("types", "").split():
+            key, _type = field.split(":", 1)
+            result[key] = cls._parsers[_type](result[key])
+        return result
 
 
 class PickleUtils:
@@ -39,8 +114,172 @@ class PickleUtils:
         return pickle.loads(message)
 
 
-encoder_map: dict[Serializer, Type[Union[JsonUtils, XmlUtils, PickleUtils]]] = {
+class BinaryUtils:
+    """Fixed binary layout: no field names, no text conversion.
+
+    body   = command:u8 topic_len:u16 topic:utf8 value [extra]
+    value  = tag:u8 payload, with the payload depending on the tag:
+             N (none), T/F (bool), I (i64), f (f64), S (u32 len + utf8),
+             B (u32 len + bytes), L (u32 count + values),
+             i (u32 count + u8 width + packed ints, for lists of ints),
+             D (u32 count + (u16 len + utf8 key, value) pairs)
+    extra  = optional D value with any other fields of the message
+
+    The value is the message's "messages" field for PUBLISH_BATCH and its
+    "message" field otherwise. Decoding reads straight from the memoryview
+    of the frame with struct.unpack_from.
+    """
+
+    commands = [command.value for command in Command]
+    command_codes = {command: code for code, command in enumerate(commands)}
+
+    _u8 = struct.Struct(">B")
+    _u16 = struct.Struct(">H")
+    _u32 = struct.Struct(">I")
+    _i64 = struct.Struct(">q")
+    _f64 = struct.Struct(">d")
+    _int_widths = ((1, "b"), (2, "h"), (4, "i"), (8, "q"))
+    _int_formats = dict(_int_widths)
+
+    @classmethod
+    def _value_key(cls, command: str) -> str:
+        return "messages" if command == Command.PUBLISH_BATCH.value else "message"
+
+    @classmethod
+    def _encode_value(cls, value: Any, out: bytearray):
+        if value is None:
+            out += b"N"
+        elif value is True:
+            out += b"T"
+        elif value is False:
+            out += b"F"
+        elif isinstance(value, int) and -(2**63) <= value < 2**63:
+            out += b"I" + cls._i64.pack(value)
+        elif isinstance(value, float):
+            out += b"f" + cls._f64.pack(value)
+        elif isinstance(value, str):
+            data = value.encode("utf-8")
+            out += b"S" + cls._u32.pack(len(data)) + data
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            out += b"B" + cls._u32.pack(len(value))
+            out += value
+        elif isinstance(value, (list, tuple)):
+            if value and all(type(item) is int for item in value):
+                low, high = min(value), max(value)
+                for width, fmt in cls._int_widths:
+                    if -(2 ** (8 * width - 1)) <= low and high < 2 ** (8 * width - 1):
+                        out += b"i" + cls._u32.pack(len(value)) + bytes([width])
+                        out += struct.pack(f">{len(value)}{fmt}", *value)
+                        return
+            out += b"L" + cls._u32.pack(len(value))
+            for item in value:
+                cls._encode_value(item, out)
+        elif isinstance(value, dict):
+            out += b"D" + cls._u32.pack(len(value))
+            for key, item in value.items():
+                data = str(key).encode("utf-8")
+                out += cls._u16.pack(len(data)) + data
+                cls._encode_value(item, out)
+        else:
+            raise TypeError(f"Unsupported binary value: {type(value).__name__}")
+
+    @classmethod
+    def _decode_value(cls, view: memoryview, offset: int) -> tuple[Any, int]:
+        tag = view[offset]
+        offset += 1
+        if tag == 0x4E:  # N
+            return None, offset
+        if tag == 0x54:  # T
+            return True, offset
+        if tag == 0x46:  # F
+            return False, offset
+        if tag == 0x49:  # I
+            return cls._i64.unpack_from(view, offset)[0], offset + 8
+        if tag == 0x66:  # f
+            return cls._f64.unpack_from(view, offset)[0], offset + 8
+        if tag in (0x53, 0x42):  # S, B
+            (size,) = cls._u32.unpack_from(view, offset)
+            offset += 4
+            data = view[offset : offset + size]
+            return (str(data, "utf-8") if tag == 0x53 else bytes(data)), offset + size
+        if tag == 0x4C:  # L
+            (count,) = cls._u32.unpack_from(view, offset)
+            offset += 4
+            items = []
+            for _ in range(count):
+                item, offset = cls._decode_value(view, offset)
+                items.append(item)
+            return items, offset
+        if tag == 0x69:  # i
+            (count,) = cls._u32.unpack_from(view, offset)
+            width = view[offset + 4]
+            fmt = f">{count}{cls._int_formats[width]}"
+            return list(struct.unpack_from(fmt, view, offset + 5)), (
+                offset + 5 + count * width
+            )
+        if tag == 0x44:  # D
+            (count,) = cls._u32.unpack_from(view, offset)
+            offset += 4
+            items = {}
+            for _ in range(count):
+                (size,) = cls._u16.unpack_from(view, offset)
+                key = str(view[offset + 2 : offset + 2 + size], "utf-8")
+                items[key], offset = cls._decode_value(view, offset + 2 + size)
+            return items, offset
+        raise ValueError(f"Unknown binary value tag: {tag}")
+
+    @classmethod
+    def encode(cls, message: dict) -> bytes:
+        command = message["command"]
+        value_key = cls._value_key(command)
+        extra = {
+            k: v for k, v in message.items() if k not in ("command", "topic", value_key)
+        }
+        return cls.encode_parts(
+            command, message.get("topic", ""), message.get(value_key), extra
+        )
+
+    @classmethod
+    def encode_parts(
+        cls, command: str, topic: str, value: Any, extra: Optional[dict] = None
+    ) -> bytearray:
+        """Encodes the fields of a message without building a dict."""
+        data = topic.encode("utf-8")
+        out = bytearray(cls._u8.pack(cls.command_codes[command]))
+        out += cls._u16.pack(len(data)) + data
+        cls._encode_value(value, out)
+        if extra:
+            cls._encode_value(extra, out)
+        return out
+
+    @classmethod
+    def decode(cls, message: bytes) -> dict:
+        command, topic, value, extra = cls.decode_parts(message)
+        result = {"command": command, "topic": topic, cls._value_key(command): value}
+        if extra:
+            result.update(extra)
+        return result
+
+    @classmethod
+    def decode_parts(cls, message: bytes) -> tuple[str, str, Any, Optional[dict]]:
+        """Returns the (command, topic, value, extra fields) of a body."""
+        view = memoryview(message)
+        command = cls.commands[view[0]]
+        (size,) = cls._u16.unpack_from(view, 1)
+        topic = str(view[3 : 3 + size], "utf-8")
+
+        value, offset = cls._decode_value(view, 3 + size)
+        extra = None
+        if offset < len(view):
+            extra, _ = cls._decode_value(view, offset)
+        return command, topic, value, extra
+
+
+encoder_map: dict[
+    Serializer, Type[Union[JsonUtils, XmlUtils, PickleUtils, BinaryUtils]]
+] = {
     Serializer.JSON: JsonUtils,
     Serializer.XML: XmlUtils,
     Serializer.PICKLE: PickleUtils,
+    Serializer.BINARY: BinaryUtils,
 }
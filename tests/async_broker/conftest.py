@@ -0,0 +1,23 @@
+import threading
+import time
+
+import pytest
+
+from src.broker import AsyncBroker
+from src.middleware import AsyncQueue, Queue
+
+
+@pytest.fixture(scope="package")
+def broker():
+    broker = AsyncBroker(port=0)
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(Queue, "address", broker.socket.getsockname())
+        mp.setattr(AsyncQueue, "address", broker.socket.getsockname())
+
+        thread = threading.Thread(target=broker.run, daemon=True)
+        thread.start()
+        time.sleep(1)
+        yield broker
+        broker.canceled = True
+        thread.join(timeout=5)
@@ -0,0 +1,36 @@
+"""Test AsyncBroker dropping subscribers past the high-water mark."""
+
+import socket
+
+from src.broker import AsyncBroker
+from src.consts import Command, MiddlewareType, Serializer
+from src.middleware import PickleQueue
+from src.protocol import CDProto
+
+PAYLOAD = "x" * 100_000
+COUNT = 100
+
+
+def test_slow_subscriber_disconnected(serve_broker, wait_until):
+    broker = serve_broker(AsyncBroker(port=0, high_water_mark=64 * 1024), default=False)
+    address = broker.socket.getsockname()
+
+    # never reads, so the broker's write buffer for it only grows
+    slow = socket.socket()
+    slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    slow.connect(address)
+    CDProto.send_msg(slow, Command.SUBSCRIBE, Serializer.PICKLE, "/async/slow")
+    consumer = PickleQueue("/async/slow", address=address, prefetch=COUNT)
+    wait_until(lambda: len(broker.list_subscriptions("/async/slow")) == 2)
+
+    producer = PickleQueue("/async/slow", MiddlewareType.PRODUCER, address=address)
+    for i in range(COUNT):
+        producer.push((i, PAYLOAD))
+
+    assert [consumer.pull(5)[1][0] for _ in range(COUNT)] == list(range(COUNT))
+    wait_until(lambda: len(broker.list_subscriptions("/async/slow")) == 1)
+    # the publisher's connection survived the fan-out that dropped slow
+    assert broker.metrics.connections == 2
+    for queue in (consumer, producer):
+        queue.close()
+    slow.close()
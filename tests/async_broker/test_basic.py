@@ -0,0 +1,3 @@
+"""Run tests/test_basic.py against AsyncBroker."""
+
+from tests.test_basic import *  # noqa: F401,F403
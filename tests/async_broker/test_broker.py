@@ -0,0 +1,3 @@
+"""Run tests/test_broker.py against AsyncBroker."""
+
+from tests.test_broker import *  # noqa: F401,F403
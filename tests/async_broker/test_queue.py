@@ -0,0 +1,33 @@
+"""Test AsyncQueue clients sharing one event loop."""
+
+import asyncio
+
+from src.middleware import JSONAsyncQueue, PickleAsyncQueue, XMLAsyncQueue
+from src.consts import MiddlewareType
+
+
+def test_async_queues_single_loop(broker):
+    async def scenario():
+        consumers = [
+            queue_type("/async/topic")
+            for queue_type in (JSONAsyncQueue, XMLAsyncQueue, PickleAsyncQueue)
+            for _ in range(100)
+        ]
+        for consumer in consumers:
+            await consumer.connect()
+        await asyncio.sleep(0.1)
+
+        producer = PickleAsyncQueue("/async/topic/leaf", MiddlewareType.PRODUCER)
+        await producer.push(1)
+        await producer.push_many([2, 3])
+
+        received = []
+        for consumer in consumers:
+            received.append([int((await consumer.pull())[1]) for _ in range(3)])
+
+        for queue in consumers + [producer]:
+            await queue.close()
+        return received
+
+    received = asyncio.run(asyncio.wait_for(scenario(), 10))
+    assert received == [[1, 2, 3]] * 300
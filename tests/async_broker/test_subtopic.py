@@ -0,0 +1,3 @@
+"""Run tests/test_subtopic.py against AsyncBroker."""
+
+from tests.test_subtopic import *  # noqa: F401,F403
@@ -0,0 +1,3 @@
+"""Run tests/test_wire.py against AsyncBroker."""
+
+from tests.test_wire import *  # noqa: F401,F403
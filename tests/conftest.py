@@ -3,7 +3,9 @@ import time
 
 import pytest
 
+from src import log
 from src.broker import Broker
+from src.middleware import Queue
 
 
 @pytest.fixture(scope="session")
@@ -16,3 +18,53 @@ def broker():
     yield broker
     broker.canceled = True
     thread.join(timeout=5)
+
+
+@pytest.fixture(autouse=True)
+def flush_logs():
+    """Writes the records of each test while its output is still captured."""
+    yield
+    log.flush()
+
+
+@pytest.fixture(scope="module")
+def serve_broker():
+    """Runs brokers for the tests of a module, stopping them at its end.
+
+    serve_broker(broker) starts broker (a Broker in a thread of its own, or
+    anything with start and stop, e.g. a ShardedBroker) and returns it.
+    Unless default is False, queues connect to it instead of the session
+    broker while the module runs.
+    """
+    started = []
+    with pytest.MonkeyPatch.context() as mp:
+
+        def serve(broker, default=True):
+            if default:
+                mp.setattr(Queue, "address", broker.socket.getsockname())
+            if hasattr(broker, "start"):
+                broker.start()
+            else:
+                threading.Thread(target=broker.run, daemon=True).start()
+            started.append(broker)
+            return broker
+
+        yield serve
+        for broker in started:
+            if hasattr(broker, "stop"):
+                broker.stop()
+            else:
+                broker.canceled = True
+
+
+@pytest.fixture(scope="session")
+def wait_until():
+    """Returns a function polling condition until it holds, failing after timeout."""
+
+    def wait(condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            assert time.monotonic() < deadline, "condition not met in time"
+            time.sleep(0.02)
+
+    return wait
@@ -0,0 +1,58 @@
+"""Test outbound buffering and backpressure in the broker."""
+import socket
+
+import pytest
+
+from src.broker import Broker, Serializer
+from src.consts import Backpressure
+
+
+@pytest.fixture
+def slow_broker():
+    broker = Broker(port=0, high_water_mark=64 * 1024)
+    client = socket.create_connection(broker.socket.getsockname())
+    broker.accept(broker.socket)
+    (conn,) = broker._outbox
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    yield broker, client, conn
+    client.close()
+    conn.close()
+    broker.socket.close()
+
+
+def test_frames_coalesced_per_tick(slow_broker):
+    broker, client, conn = slow_broker
+    broker.subscribe("/coalesce", conn, Serializer.JSON)
+
+    for i in range(10):
+        broker.publish("/coalesce", i)
+    assert len(broker._outbox[conn]) > 0
+
+    broker.flush()
+    assert len(broker._outbox[conn]) == 0
+    assert client.recv(65536).count(b"/coalesce") == 10
+
+
+def test_slow_consumer_disconnected(slow_broker):
+    broker, client, conn = slow_broker
+    broker.subscribe("/slow", conn, Serializer.PICKLE)
+
+    for _ in range(5000):
+        broker.publish("/slow", "x" * 1000)
+        broker.flush()
+
+    assert broker.list_subscriptions("/slow") == []
+    assert conn not in broker._outbox
+
+
+def test_slow_consumer_shed(slow_broker):
+    broker, client, conn = slow_broker
+    broker.backpressure = Backpressure.SHED
+    broker.subscribe("/shed", conn, Serializer.PICKLE)
+
+    for _ in range(5000):
+        broker.publish("/shed", "x" * 1000)
+        broker.flush()
+
+    assert broker.list_subscriptions("/shed") == [(conn, Serializer.PICKLE)]
+    assert len(broker._outbox[conn]) <= broker.high_water_mark
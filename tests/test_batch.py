@@ -0,0 +1,46 @@
+"""Test batched publishing."""
+import random
+import string
+import threading
+import time
+
+import pytest
+
+from src.clients import Consumer, Producer
+from src.middleware import JSONQueue, PickleQueue, XMLQueue
+
+TOPIC = "/" + "".join(random.sample(string.ascii_lowercase, 6))
+
+
+def gen():
+    while True:
+        yield random.randint(0, 100)
+
+
+@pytest.fixture
+def consumer_Pickle():
+    consumer = Consumer(TOPIC, PickleQueue)
+
+    thread = threading.Thread(target=consumer.run, args=(20,), daemon=True)
+    thread.start()
+    return consumer
+
+
+@pytest.fixture
+def consumer_XML():
+    consumer = Consumer(TOPIC, XMLQueue)
+
+    thread = threading.Thread(target=consumer.run, args=(20,), daemon=True)
+    thread.start()
+    return consumer
+
+
+def test_batched_producer(consumer_Pickle, consumer_XML, broker):
+    producer = Producer(TOPIC, gen, JSONQueue)
+
+    producer.run(20, batch_size=8)
+    time.sleep(0.1)
+
+    assert consumer_Pickle.received == producer.produced
+    assert [int(v) for v in consumer_XML.received] == producer.produced
+    assert broker.get_topic(TOPIC) == producer.produced[-1]
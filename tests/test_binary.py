@@ -0,0 +1,38 @@
+"""Test the binary serializer and its interoperability with the others."""
+
+import random
+import string
+import time
+
+import pytest
+
+from src.consts import Command, MiddlewareType, Serializer
+from src.middleware import BinaryQueue, JSONQueue
+from src.protocol import CDProto
+
+TOPIC = "/" + "".join(random.sample(string.ascii_lowercase, 6))
+
+
+@pytest.mark.parametrize(
+    "value",
+    [42, -1.5, "Ó mar salgado", b"\x00\xff", None, [1, "a", [2.0, None]], [1, -300]],
+)
+def test_roundtrip(value):
+    frame = CDProto.encode_msg(Command.PUBLISH, Serializer.BINARY, "/bin", value)
+    msg = CDProto.decode_msg(Serializer.BINARY, memoryview(frame)[4:])
+
+    assert (msg.topic, msg.message) == ("/bin", value)
+
+
+def test_interoperability(broker):
+    binary_consumer = BinaryQueue(TOPIC)
+    json_consumer = JSONQueue(TOPIC)
+    time.sleep(0.1)
+
+    BinaryQueue(TOPIC, MiddlewareType.PRODUCER).push([1, 2.5, "x"])
+    JSONQueue(TOPIC, MiddlewareType.PRODUCER).push(7)
+
+    assert binary_consumer.pull() == (TOPIC, [1, 2.5, "x"])
+    assert binary_consumer.pull() == (TOPIC, 7)
+    assert json_consumer.pull() == (TOPIC, [1, 2.5, "x"])
+    assert json_consumer.pull() == (TOPIC, 7)
@@ -0,0 +1,147 @@
+"""Test negotiated compression of large frames."""
+
+import os
+import socket
+import time
+
+import pytest
+
+from src.broker import Broker
+from src.consts import Command, FrameFlag, MiddlewareType, Serializer
+from src.middleware import JSONQueue, PickleQueue, XMLQueue
+from src.protocol import (
+    COMPRESS_THRESHOLD,
+    COMPRESSIONS,
+    CDProto,
+    CDProtoBadFormat,
+    FrameReader,
+)
+
+TEXT = "Ó mar salgado, quanto do teu sal são lágrimas de Portugal! " * 100
+
+
+@pytest.fixture(scope="module")
+def compression_broker(serve_broker):
+    return serve_broker(Broker(port=0))
+
+
+def _field(frame: bytes) -> int:
+    return int.from_bytes(frame[2:4], "big")
+
+
+def test_small_frames_untouched():
+    frame = CDProto.encode_msg(
+        Command.PUBLISH, Serializer.JSON, "/temp", 21, compression=FrameFlag.ZLIB
+    )
+    assert frame == CDProto.encode_msg(Command.PUBLISH, Serializer.JSON, "/temp", 21)
+    assert _field(frame) == Serializer.JSON
+
+
+@pytest.mark.parametrize("serializer", list(Serializer))
+def test_large_frames_compressed(serializer):
+    plain = CDProto.encode_msg(Command.PUBLISH, serializer, "/quotes", TEXT)
+    frame = CDProto.encode_msg(
+        Command.PUBLISH, serializer, "/quotes", TEXT, compression=FrameFlag.ZLIB
+    )
+    assert len(plain) > COMPRESS_THRESHOLD
+    assert len(frame) < len(plain) / 10
+    assert _field(frame) == FrameFlag.ZLIB << 8 | serializer
+
+    reader = FrameReader()
+    reader.feed(frame)
+    msg = CDProto.decode_msg(*reader.next_frame())
+    assert (msg.topic, msg.message) == ("/quotes", TEXT)
+    assert CDProto.compress(plain, FrameFlag.ZLIB) == frame
+
+
+def test_chunked_compressed_frames():
+    # random bytes don't compress, so the body stays over CHUNK_SIZE
+    value = os.urandom(3 * 1024 * 1024)
+    frame = CDProto.encode_msg(
+        Command.PUBLISH, Serializer.PICKLE, "/blob", value, compression=FrameFlag.ZLIB
+    )
+    reader = FrameReader()
+    reader.feed(frame)
+    msg = CDProto.decode_msg(*reader.next_frame())
+    assert msg.message == value
+
+
+@pytest.mark.parametrize("compression", list(COMPRESSIONS.values()))
+def test_decompression_bounded(compression):
+    # a few KB that would expand to 8 MiB
+    frame = CDProto.frame(
+        Serializer.BINARY, b"\0" * (8 * 1024 * 1024), compression=compression
+    )
+    assert len(frame) < 64 * 1024
+
+    reader = FrameReader(max_message=1024 * 1024)
+    reader.feed(frame)
+    with pytest.raises(CDProtoBadFormat, match="too large"):
+        reader.next_frame()
+    reader = FrameReader(compressions=FrameFlag.NONE)
+    reader.feed(frame)
+    with pytest.raises(CDProtoBadFormat, match="not accepted"):
+        reader.next_frame()
+    reader = FrameReader()
+    reader.feed(frame)
+    assert len(reader.next_frame()[1]) == 8 * 1024 * 1024
+
+
+def test_broker_drops_compressed_without_hello(compression_broker):
+    frame = CDProto.encode_msg(
+        Command.PUBLISH, Serializer.JSON, "/zipped", TEXT, compression=FrameFlag.ZLIB
+    )
+    sock = socket.create_connection(compression_broker.socket.getsockname())
+    with sock:
+        sock.sendall(frame)
+        sock.settimeout(5)
+        assert sock.recv(1) == b""
+    assert "/zipped" not in compression_broker.topics
+
+
+def test_negotiated_queues(compression_broker):
+    consumer = JSONQueue(
+        "/compression/quotes", MiddlewareType.CONSUMER, compression=["lzma", "zlib"]
+    )
+    plain = XMLQueue("/compression/quotes", MiddlewareType.CONSUMER)
+    producer = PickleQueue(
+        "/compression/quotes", MiddlewareType.PRODUCER, compression=["zlib"]
+    )
+    assert consumer.compression in (FrameFlag.LZMA, FrameFlag.ZLIB)
+    assert plain.compression == FrameFlag.NONE
+    assert producer.compression == FrameFlag.ZLIB
+    time.sleep(0.1)
+
+    producer.push(TEXT)
+    producer.push(21)
+    assert consumer.pull(1) == ("/compression/quotes", TEXT)
+    assert consumer.pull(1) == ("/compression/quotes", 21)
+    assert plain.pull(1) == ("/compression/quotes", TEXT)
+    assert int(plain.pull(1)[1]) == 21  # XML only transfers strings
+
+    for queue in (consumer, plain, producer):
+        queue.close()
+
+
+def test_fan_out_compresses_once(compression_broker, monkeypatch):
+    consumers = [
+        JSONQueue("/compression/fanout", MiddlewareType.CONSUMER, compression=["zlib"])
+        for _ in range(3)
+    ]
+    producer = JSONQueue("/compression/fanout", MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+
+    calls = []
+    compress = CDProto.compress
+    monkeypatch.setattr(
+        CDProto, "compress", lambda *args: calls.append(args) or compress(*args)
+    )
+    producer.push(TEXT)
+    producer.push("short")
+
+    for consumer in consumers:
+        assert consumer.pull(1) == ("/compression/fanout", TEXT)
+        assert consumer.pull(1) == ("/compression/fanout", "short")
+        consumer.close()
+    producer.close()
+    assert len(calls) == 1
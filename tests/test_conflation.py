@@ -0,0 +1,112 @@
+"""Test conflating subscriptions, which only get the latest value when lagging."""
+
+import socket
+import time
+
+import pytest
+
+from src.broker import Broker
+from src.consts import MiddlewareType, Serializer
+from src.middleware import PickleQueue
+from src.protocol import CDProto, FrameReader
+
+PAYLOAD = "x" * 20_000
+COUNT = 1000
+
+
+@pytest.fixture(scope="module")
+def conflation_broker(serve_broker):
+    return serve_broker(Broker(port=0))
+
+
+def _publish(broker, topics):
+    producers = [PickleQueue(topic, MiddlewareType.PRODUCER) for topic in topics]
+    for i in range(COUNT):
+        for queue in producers:
+            queue.push((i, PAYLOAD))
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        nodes = [broker.topics.find(topic) for topic in topics]
+        if all(node is not None and node.value[0] == COUNT - 1 for node in nodes):
+            break
+        time.sleep(0.05)
+    for queue in producers:
+        queue.close()
+
+
+def _drain(consumer) -> dict:
+    received = {}
+    item = consumer.pull(1)
+    while item is not None:
+        topic, (i, _) = item
+        received.setdefault(topic, []).append(i)
+        item = consumer.pull(1)
+    return received
+
+
+@pytest.mark.parametrize("pattern", [False, True])
+def test_slow_subscriber_gets_latest(conflation_broker, pattern):
+    topics = [f"/conflate{int(pattern)}/temp", f"/conflate{int(pattern)}/pressure"]
+    subscriptions = [f"/conflate{int(pattern)}/+"] if pattern else topics
+    consumers = [
+        PickleQueue(topic, MiddlewareType.CONSUMER, conflate=True)
+        for topic in subscriptions
+    ]
+    time.sleep(0.1)
+
+    _publish(conflation_broker, topics)
+    held = [len(latest) for latest in conflation_broker._latest.values()]
+    assert held and max(held) <= len(topics) // len(consumers)
+
+    received = {}
+    for consumer in consumers:
+        received.update(_drain(consumer))
+        consumer.close()
+
+    assert sorted(received) == sorted(topics)
+    for values in received.values():
+        assert values == sorted(values)
+        assert values[-1] == COUNT - 1
+        assert len(values) < COUNT
+
+
+def test_plain_subscriber_gets_everything(conflation_broker):
+    consumer = PickleQueue("/plain/temp", MiddlewareType.CONSUMER)
+    time.sleep(0.1)
+
+    producer = PickleQueue("/plain/temp", MiddlewareType.PRODUCER)
+    for i in range(100):
+        producer.push((i, "small"))
+
+    assert _drain(consumer) == {"/plain/temp": list(range(100))}
+    consumer.close()
+    producer.close()
+
+
+def test_levels_hold_their_own_latest():
+    broker = Broker(port=0)
+    client, conn = socket.socketpair()
+    broker.register(conn)
+    for topic in ("/levels/a", "/levels/a/b", "/levels/+/b"):
+        broker.subscribe(topic, conn, Serializer.JSON)
+        broker.conflate(topic, conn)
+    # output still pending, so publishes are held back
+    broker._outbox[conn] += b"pending"
+    broker.publish("/levels/a/b", 1)
+    broker.publish("/levels/a/b", 2)
+
+    reader = FrameReader()
+    for frame in broker._latest[conn].values():
+        reader.feed(frame)
+    msgs = [CDProto.decode_msg(*reader.next_frame()) for _ in broker._latest[conn]]
+    assert sorted(msg.topic for msg in msgs) == [
+        "/levels/a",
+        "/levels/a/b",
+        "/levels/a/b",
+    ]
+    assert {msg.message for msg in msgs} == {2}
+
+    broker.disconnect(conn)
+    broker.socket.close()
+    client.close()
@@ -0,0 +1,205 @@
+"""Test reliable subscriptions: numbered, acknowledged and redelivered messages."""
+
+import time
+
+import pytest
+
+from src.broker import Broker
+from src.consts import MiddlewareType, Serializer
+from src.delivery import Delivery
+from src.middleware import JSONQueue, PickleQueue
+
+LIMIT = 50
+
+
+@pytest.fixture(scope="module")
+def reliable_broker(serve_broker):
+    return serve_broker(Broker(port=0, delivery_limit=LIMIT))
+
+
+def test_window():
+    delivery = Delivery("client", "/temp", Serializer.JSON, window=2)
+    for seq in range(1, 6):
+        delivery.append(seq, Serializer.JSON, b"%d" % seq)
+    assert list(delivery.sendable()) == []
+
+    delivery.attach("conn")
+    assert [entry[0] for entry in delivery.sendable()] == [1, 2]
+    assert list(delivery.sendable()) == []
+    delivery.ack(1)
+    assert [entry[0] for entry in delivery.sendable()] == [3]
+    assert len(delivery) == 4
+
+    # a new connection gets everything unacknowledged again
+    delivery.detach()
+    delivery.attach("other")
+    assert [entry[0] for entry in delivery.sendable()] == [2, 3]
+    delivery.ack(10)
+    assert (delivery.acked, len(delivery)) == (5, 0)
+
+    for seq in range(6, 10):
+        delivery.append(seq, Serializer.JSON, b"%d" % seq)
+    delivery.trim(2)
+    assert ([entry[0] for entry in delivery.entries], delivery.dropped) == ([8, 9], 2)
+
+
+def test_window_after_trim():
+    delivery = Delivery("client", "/temp", Serializer.JSON, window=5)
+    delivery.attach("conn")
+    delivery.detach()
+    for seq in range(1, 41):
+        delivery.append(seq, Serializer.JSON, b"%d" % seq)
+    delivery.trim(20)
+    assert delivery.acked == 20
+
+    delivery.attach("other")
+    assert [entry[0] for entry in delivery.sendable()] == [21, 22, 23, 24, 25]
+    delivery.ack(25)
+    assert [entry[0] for entry in delivery.sendable()] == [26, 27, 28, 29, 30]
+
+
+def test_numbered_in_window(reliable_broker, wait_until):
+    consumer = PickleQueue("/reliable/window", client="window", window=10)
+    producer = PickleQueue("/reliable/window", MiddlewareType.PRODUCER)
+    wait_until(lambda: ("window", "/reliable/window") in reliable_broker._sessions)
+    delivery = reliable_broker._sessions["window", "/reliable/window"]
+
+    for i in range(30):
+        producer.push(i)
+    wait_until(lambda: len(delivery) == 30)
+    assert delivery.sent == 10
+
+    received = []
+    for _ in range(30):
+        received.append(consumer.pull(1)[1])
+        assert consumer.seq == len(received)
+    assert received == list(range(30))
+    consumer.ack()
+    wait_until(lambda: len(delivery) == 0)
+
+    consumer.cancel()
+    wait_until(lambda: ("window", "/reliable/window") not in reliable_broker._sessions)
+    consumer.close()
+    producer.close()
+
+
+def test_redelivery_after_reconnect(reliable_broker):
+    consumer = JSONQueue("/reliable/redeliver", client="redeliver")
+    producer = JSONQueue("/reliable/redeliver", MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+    producer.push_many([0, 1, 2])
+    for i in range(3, 10):
+        producer.push(i)
+
+    assert [consumer.pull(1)[1] for _ in range(5)] == [0, 1, 2, 3, 4]
+    consumer.ack()
+    # pulled, but not handled when the consumer goes away
+    assert consumer.pull(1)[1] == 5
+    consumer.close()
+    producer.push(10)
+
+    consumer = JSONQueue("/reliable/redeliver", client="redeliver")
+    assert [consumer.pull(1)[1] for _ in range(6)] == list(range(5, 11))
+    assert consumer.seq == 9  # the batch took a single seq
+    consumer.cancel()
+    consumer.close()
+    producer.close()
+
+
+def test_retained_value_and_pattern(reliable_broker, wait_until):
+    producer = JSONQueue("/reliable/kept/temp", MiddlewareType.PRODUCER)
+    producer.push("kept")
+    wait_until(lambda: reliable_broker.get_topic("/reliable/kept/temp") == "kept")
+
+    consumer = JSONQueue("/reliable/kept/+", client="pattern")
+    assert consumer.pull(1) == ("/reliable/kept/temp", "kept")
+    producer.push("live")
+    assert consumer.pull(1) == ("/reliable/kept/temp", "live")
+    assert consumer.seq == 2
+    consumer.cancel()
+    consumer.close()
+    producer.close()
+
+
+def test_fast_producer_paused(reliable_broker, wait_until):
+    # attached, but not reading yet
+    consumer = PickleQueue("/reliable/flow", client="flow", window=20)
+    wait_until(lambda: ("flow", "/reliable/flow") in reliable_broker._sessions)
+    delivery = reliable_broker._sessions["flow", "/reliable/flow"]
+
+    payload = "x" * 4096
+    producer = PickleQueue("/reliable/flow", MiddlewareType.PRODUCER)
+    for i in range(500):
+        producer.push((i, payload))
+    wait_until(lambda: reliable_broker._paused)
+    time.sleep(0.1)
+    # the broker stopped reading the producer instead of keeping all 500
+    assert LIMIT <= len(delivery) < 500
+    assert reliable_broker.stats()["sessions"]["paused"] == 1
+
+    assert [consumer.pull(1)[1][0] for _ in range(500)] == list(range(500))
+    consumer.ack()
+    wait_until(lambda: len(delivery) == 0)
+    assert not reliable_broker._paused
+    consumer.cancel()
+    consumer.close()
+    producer.close()
+
+
+def test_lagging_session_only_holds_up_its_producers(reliable_broker, wait_until):
+    topics = ["/reliable/held/a", "/reliable/held/b"]
+    consumers = [PickleQueue(topic, client="held", window=10) for topic in topics]
+    producers = [PickleQueue(topic, MiddlewareType.PRODUCER) for topic in topics]
+    wait_until(lambda: all(("held", t) in reliable_broker._sessions for t in topics))
+
+    for producer in producers:
+        for i in range(200):
+            producer.push(i)
+    wait_until(lambda: len(reliable_broker._paused) == 2)
+
+    # the first catching up resumes its producer while the second still lags
+    assert [consumers[0].pull(1)[1] for _ in range(200)] == list(range(200))
+    consumers[0].ack()
+    assert len(reliable_broker._paused) == 1
+    assert [consumers[1].pull(1)[1] for _ in range(200)] == list(range(200))
+    consumers[1].ack()
+    wait_until(lambda: not reliable_broker._paused)
+    for queue in consumers:
+        queue.cancel()
+    for queue in consumers + producers:
+        queue.close()
+
+
+def test_abandoned_session(reliable_broker, wait_until, monkeypatch):
+    key = ("gone", "/reliable/abandoned")
+    consumer = PickleQueue(key[1], client=key[0])
+    wait_until(lambda: key in reliable_broker._sessions)
+    delivery = reliable_broker._sessions[key]
+    consumer.close()
+    wait_until(lambda: delivery.conn is None)
+
+    producer = PickleQueue(key[1], MiddlewareType.PRODUCER)
+    for i in range(500):
+        producer.push(i)
+    # the producer was never held up; only the latest LIMIT are kept
+    wait_until(lambda: delivery.seq == 500)
+    assert not reliable_broker._paused
+    assert [entry[0] for entry in delivery.entries] == list(range(451, 501))
+    assert reliable_broker.stats()["sessions"]["dropped"] >= 450
+
+    # a client coming back gets the ones kept, with a window as before
+    consumer = PickleQueue(key[1], client=key[0], window=5)
+    assert [consumer.pull(1)[1] for _ in range(LIMIT)] == list(range(450, 500))
+    consumer.ack()
+    wait_until(lambda: len(delivery) == 0)
+    consumer.close()
+
+    monkeypatch.setattr(reliable_broker, "session_expiry", 0.2)
+    wait_until(lambda: key not in reliable_broker._sessions)
+    assert reliable_broker.list_subscriptions(key[1]) == []
+    producer.close()
+
+
+def test_not_shared():
+    with pytest.raises(ValueError):
+        JSONQueue("/reliable", client="shared", shared=True)
@@ -0,0 +1,24 @@
+"""Test that the broker encodes each published frame once per serializer."""
+import json
+from unittest.mock import MagicMock, patch
+
+from src.broker import Serializer
+
+
+def test_encode_once_per_serializer(broker):
+    json_subscribers = [MagicMock() for _ in range(5)]
+    pickle_subscriber = MagicMock()
+
+    for subscriber in json_subscribers:
+        broker.subscribe("/fanout", subscriber, Serializer.JSON)
+    broker.subscribe("/fanout", pickle_subscriber, Serializer.PICKLE)
+
+    with patch("json.dumps", MagicMock(side_effect=json.dumps)) as json_dump:
+        broker.publish("/fanout/leaf", 42)
+
+        assert json_dump.call_count == 1
+
+    frames = [subscriber.send.call_args[0][0] for subscriber in json_subscribers]
+    assert all(frame is frames[0] for frame in frames)
+    assert b"/fanout" in frames[0]
+    assert pickle_subscriber.send.call_args[0][0] != frames[0]
@@ -0,0 +1,179 @@
+"""Test federated brokers forwarding publishes to the peers interested in them."""
+
+import time
+
+import pytest
+
+from src.consts import Command, MiddlewareType, Serializer
+from src.federation import FederatedBroker
+from src.middleware import JSONQueue, PickleQueue
+
+
+@pytest.fixture
+def federate(serve_broker):
+    """Starts FederatedBrokers, each linked with the ones given by index."""
+    brokers = []
+
+    def start(name, peers=()):
+        broker = FederatedBroker(
+            name=name,
+            port=0,
+            peers=[brokers[i].socket.getsockname() for i in peers],
+        )
+        brokers.append(serve_broker(broker, default=False))
+        return broker
+
+    return start
+
+
+def _address(broker):
+    return "tcp://%s:%d" % broker.socket.getsockname()
+
+
+def _interested(broker, topic):
+    return any(topic in topics for topics in broker._peer_topics.values())
+
+
+def test_chain(federate, wait_until):
+    a = federate("a")
+    b = federate("b", [0])
+    c = federate("c", [1])
+    wait_until(lambda: len(b._advertised) == 2)
+
+    consumer = JSONQueue("/fed/weather", address=_address(c))
+    wait_until(lambda: _interested(a, "/fed/weather"))
+    assert _interested(b, "/fed/weather")
+
+    producer = PickleQueue(
+        "/fed/weather/temp", MiddlewareType.PRODUCER, address=_address(a)
+    )
+    producer.push(21)
+    producer.push_many([22, 23])
+    assert [consumer.pull(1) for _ in range(3)] == [
+        ("/fed/weather", v) for v in (21, 22, 23)
+    ]
+    # b relayed the publishes, so it holds their value too
+    assert b.get_topic("/fed/weather/temp") == 23
+
+    consumer.close()
+    wait_until(lambda: not _interested(a, "/fed/weather"))
+    producer.close()
+
+
+def test_retained_values(federate, wait_until):
+    a = federate("a")
+    b = federate("b", [0])
+    wait_until(lambda: len(a._advertised) == 1)
+
+    producer = JSONQueue(
+        "/fed/stock/apple", MiddlewareType.PRODUCER, address=_address(a)
+    )
+    producer.push(170)
+    wait_until(lambda: a.get_topic("/fed/stock/apple") == 170)
+
+    exact = JSONQueue("/fed/stock/apple", address=_address(b))
+    pattern = JSONQueue("/fed/+/apple", address=_address(b))
+    assert exact.pull(1) == ("/fed/stock/apple", 170)
+    assert pattern.pull(1) == ("/fed/stock/apple", 170)
+
+    for queue in (producer, exact, pattern):
+        queue.close()
+
+
+def test_no_interest_no_forwarding(federate, wait_until):
+    a = federate("a")
+    b = federate("b", [0])
+    wait_until(lambda: len(a._advertised) == 1)
+
+    producer = JSONQueue("/fed/local", MiddlewareType.PRODUCER, address=_address(a))
+    producer.push("here")
+    wait_until(lambda: a.get_topic("/fed/local") == "here")
+    time.sleep(0.1)
+    assert "/fed/local" not in b.topics
+    producer.close()
+
+
+def test_reserved_topics_stay_local(federate, wait_until):
+    a = federate("a")
+    b = federate("b", [0])
+    wait_until(lambda: len(a._advertised) == 1)
+
+    consumer = JSONQueue("$SYS/#", address=_address(b))
+    time.sleep(0.1)
+    assert not _interested(a, "$SYS/#")
+    consumer.close()
+
+
+def test_cycle_does_not_loop(federate, wait_until):
+    a = federate("a")
+    b = federate("b", [0])
+    c = federate("c", [0, 1])
+    wait_until(lambda: all(len(x._advertised) == 2 for x in (a, b, c)))
+
+    consumer = JSONQueue("/fed/cycle", address=_address(c))
+    wait_until(lambda: _interested(a, "/fed/cycle") and _interested(b, "/fed/cycle"))
+
+    producer = JSONQueue("/fed/cycle", MiddlewareType.PRODUCER, address=_address(a))
+    producer.push(1)
+    received = []
+    item = consumer.pull(1)
+    while item is not None:
+        received.append(item)
+        item = consumer.pull(0.5)
+
+    # once straight from a, and at most once more through b
+    assert 1 <= len(received) <= 2
+    assert set(received) == {("/fed/cycle", 1)}
+    # b and c got it from a and from each other, and nothing came back to a
+    assert [x.metrics.handling["publish"].count for x in (a, b, c)] == [1, 2, 2]
+    consumer.close()
+    producer.close()
+
+
+def test_duplicate_link_dropped(federate, wait_until):
+    a = federate("a")
+    b = federate("b", [0, 0])
+    # a drops the second link and b sees it closed
+    wait_until(lambda: len(b._peers) == 1 and len(a._peers) == 1)
+    assert list(a._peers.values()) == ["b"]
+
+
+def test_only_changes_advertised():
+    broker = FederatedBroker(name="solo", port=0)
+    link = object()
+    broker._peer_topics[link] = set()
+    broker._advertised[link] = set()
+    sent = []
+    broker._send_link = lambda link, command, topic="": sent.append((command, topic))
+
+    clients = [object() for _ in range(3)]
+    for client in clients + clients[:1]:
+        broker.subscribe("/fed/many", client, Serializer.JSON)
+    broker.subscribe("$SYS/fed", clients[0], Serializer.JSON)
+    assert sent == [(Command.SUBSCRIBE, "/fed/many")]
+
+    for client in clients[:1] + clients:
+        broker.unsubscribe("/fed/many", client)
+    assert sent == [
+        (Command.SUBSCRIBE, "/fed/many"),
+        (Command.UNSUBSCRIBE, "/fed/many"),
+    ]
+    assert broker._local == {} and broker._advertised[link] == set()
+    broker.socket.close()
+
+
+def test_relayed_interest(federate, wait_until):
+    a = federate("a")
+    b = federate("b", [0])
+    c = federate("c", [1])
+    wait_until(lambda: len(b._advertised) == 2)
+
+    first = JSONQueue("/fed/relay", address=_address(c))
+    second = JSONQueue("/fed/relay", address=_address(b))
+    wait_until(lambda: _interested(a, "/fed/relay"))
+    first.close()
+    time.sleep(0.1)
+    # b still has a subscriber of its own
+    assert _interested(a, "/fed/relay")
+    second.close()
+    wait_until(lambda: not _interested(a, "/fed/relay"))
@@ -0,0 +1,150 @@
+"""Test incremental frame parsing over partial and batched reads."""
+
+import socket
+import threading
+
+import pytest
+
+from src.broker import Broker
+from src.consts import Command, MiddlewareType, Serializer
+from src.middleware import JSONQueue
+from src.protocol import CHUNK_SIZE, CDProto, CDProtoBadFormat, FrameReader
+
+
+def test_many_frames_per_recv():
+    frames = b"".join(
+        CDProto.encode_msg(Command.PUBLISH, Serializer.JSON, "/batch", i)
+        for i in range(50)
+    )
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(frames)
+        reader = FrameReader()
+        assert reader.recv(b) == len(frames)
+
+        messages = [CDProto.decode_msg(*frame) for frame in reader]
+        assert [msg.message for msg in messages] == list(range(50))
+
+
+def test_partial_frames_carried_over():
+    frame = CDProto.encode_msg(Command.PUBLISH, Serializer.PICKLE, "/t", "x" * 1000)
+    reader = FrameReader(size=16)
+
+    for i in range(0, len(frame), 7):
+        assert reader.next_frame() is None
+        reader.feed(frame[i : i + 7])
+
+    serializer, body = reader.next_frame()
+    assert serializer == Serializer.PICKLE
+    assert CDProto.decode_msg(serializer, body).message == "x" * 1000
+    assert reader.next_frame() is None
+
+
+def test_small_frames_keep_compact_header():
+    frame = CDProto.encode_msg(Command.PUBLISH, Serializer.JSON, "/t", 1)
+    assert int.from_bytes(frame[:2], "big") == len(frame) - 2
+
+
+def test_large_message_streamed_in_chunks():
+    payload = list(range(2_000_000))  # ~10 MiB once pickled
+    frame = CDProto.encode_msg(Command.PUBLISH, Serializer.PICKLE, "/big", payload)
+    assert len(frame) > CHUNK_SIZE
+
+    reader = FrameReader()
+    for i in range(0, len(frame), 100_000):
+        assert reader.next_frame() is None
+        reader.feed(frame[i : i + 100_000])
+        assert len(reader._buffer) <= 3 * CHUNK_SIZE
+    serializer, body = reader.next_frame()
+
+    assert CDProto.decode_msg(serializer, body).message == payload
+
+
+def test_recv_msg_large_message():
+    payload = "x" * (3 * CHUNK_SIZE)
+    frame = CDProto.encode_msg(Command.PUBLISH, Serializer.JSON, "/big", payload)
+    a, b = socket.socketpair()
+    with a, b:
+        sender = threading.Thread(target=a.sendall, args=(frame,))
+        sender.start()
+        received, _ = CDProto.recv_msg(b)
+        sender.join()
+
+        assert received.message == payload
+
+
+@pytest.mark.parametrize("field", [9, 0x8000])
+def test_unknown_serializer_or_flags(field):
+    reader = FrameReader()
+    reader.feed(b"\x00\x04" + field.to_bytes(2, "big") + b"{}")
+    with pytest.raises(CDProtoBadFormat):
+        reader.next_frame()
+
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(b"\x00\x04" + field.to_bytes(2, "big") + b"{}")
+        with pytest.raises(CDProtoBadFormat):
+            CDProto.recv_msg(b)
+
+
+def test_broker_drops_bad_serializer(serve_broker):
+    broker = serve_broker(Broker(port=0), default=False)
+    address = broker.socket.getsockname()
+    consumer = JSONQueue("/framing/bad", address=address)
+
+    bad = socket.create_connection(address)
+    with bad:
+        bad.sendall(b"\x00\x04\x00\x09{}")
+        bad.settimeout(5)
+        # the broker closes the connection and keeps serving the others
+        assert bad.recv(1) == b""
+
+    JSONQueue("/framing/bad", MiddlewareType.PRODUCER, address=address).push(1)
+    assert consumer.pull(5) == ("/framing/bad", 1)
+    consumer.close()
+
+
+@pytest.mark.parametrize(
+    "command, options",
+    [
+        (Command.PUBLISH_BATCH, {"message": 5}),
+        (Command.HELLO, {"message": None}),
+        (Command.ACK, {"message": "1"}),
+        (Command.SUBSCRIBE, {"last": "3"}),
+        (Command.PUBLISH, {"message": 1, "via": "a"}),
+    ],
+)
+@pytest.mark.parametrize("serializer", [Serializer.JSON, Serializer.BINARY])
+def test_broker_drops_bad_field_types(serve_broker, serializer, command, options):
+    broker = serve_broker(Broker(port=0), default=False)
+    address = broker.socket.getsockname()
+    frame = CDProto.encode_msg(command, serializer, "/framing/types", **options)
+    with pytest.raises(CDProtoBadFormat):
+        CDProto.decode_msg(serializer, memoryview(frame)[4:])
+
+    bad = socket.create_connection(address)
+    with bad:
+        bad.sendall(frame)
+        bad.settimeout(5)
+        assert bad.recv(1) == b""
+
+    consumer = JSONQueue("/framing/types", address=address)
+    JSONQueue("/framing/types", MiddlewareType.PRODUCER, address=address).push(1)
+    assert consumer.pull(5) == ("/framing/types", 1)
+    consumer.close()
+
+
+def test_oversized_lengths_rejected():
+    reader = FrameReader()
+    # an extended length far beyond a chunk, announced by a 6 byte header
+    reader.feed(b"\xff\xff\x7f\xff\xff\xff\x00\x00")
+    with pytest.raises(CDProtoBadFormat):
+        reader.next_frame()
+    assert len(reader._buffer) == 64 * 1024
+
+    payload = "x" * (3 * CHUNK_SIZE)
+    frame = CDProto.encode_msg(Command.PUBLISH, Serializer.JSON, "/big", payload)
+    reader = FrameReader(max_message=CHUNK_SIZE + 1024)
+    reader.feed(frame[: 2 * CHUNK_SIZE])
+    with pytest.raises(CDProtoBadFormat):
+        list(reader)
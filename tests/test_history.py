@@ -0,0 +1,59 @@
+"""Test per-topic history and replay on subscribe."""
+
+import time
+
+import pytest
+
+from src.broker import Broker
+from src.consts import MiddlewareType, Serializer
+from src.history import History
+from src.middleware import JSONQueue, PickleQueue
+
+
+@pytest.fixture(scope="module")
+def history_broker(serve_broker):
+    return serve_broker(Broker(port=0, history=200, history_bytes=512 * 1024))
+
+
+def test_history_bounds():
+    history = History(capacity=3, budget=10)
+    for seq in range(1, 6):
+        history.append(seq, Serializer.JSON, b"abc")
+
+    assert [entry[0] for entry in history.since(0)] == [3, 4, 5]
+    assert [entry[0] for entry in history.since(5)] == [5]
+
+    history.append(6, Serializer.JSON, b"x" * 20)
+    assert [entry[0] for entry in history.since(0)] == [6]
+
+
+def test_last_and_since(history_broker):
+    producer = JSONQueue("/history/a", MiddlewareType.PRODUCER)
+    for i in range(10):
+        producer.push(i)
+    time.sleep(0.1)
+
+    consumer = PickleQueue("/history/a", last=3)
+    assert [consumer.pull()[1] for _ in range(3)] == [7, 8, 9]
+    assert consumer.seq == 10
+
+    producer.push(10)
+    resumed = JSONQueue("/history/a", since=8)
+    assert [resumed.pull()[1] for _ in range(3)] == [8, 9, 10]
+    assert consumer.pull() == ("/history/a", 10)
+    assert resumed.seq == consumer.seq == 11
+
+
+def test_replay_then_live(history_broker):
+    producer = PickleQueue("/history/b", MiddlewareType.PRODUCER)
+    for i in range(100):
+        producer.push("x" * 1000 + str(i))
+    time.sleep(0.1)
+
+    # more than one replay chunk, interleaved with new publishes
+    consumer = JSONQueue("/history/b", since=0)
+    for i in range(100, 120):
+        producer.push("x" * 1000 + str(i))
+
+    values = [consumer.pull()[1] for _ in range(120)]
+    assert values == ["x" * 1000 + str(i) for i in range(120)]
@@ -0,0 +1,69 @@
+"""Test the logging configuration and rate limited message logs."""
+
+import logging
+
+from src import log
+from src.log import MessageLog, parse_levels
+
+
+def test_parse_levels():
+    assert parse_levels("INFO, broker=debug,consumer=WARNING") == {
+        "": "INFO",
+        "broker": "DEBUG",
+        "consumer": "WARNING",
+    }
+    assert parse_levels("") == {}
+
+
+def test_configure_levels():
+    try:
+        log.configure("WARNING,broker=DEBUG,consumer./a=ERROR")
+        assert logging.getLogger().level == logging.WARNING
+        assert logging.getLogger("broker").isEnabledFor(logging.DEBUG)
+        assert not logging.getLogger("consumer./a").isEnabledFor(logging.WARNING)
+        assert logging.getLogger("consumer./b").isEnabledFor(logging.WARNING)
+
+        log.configure("INFO")
+        assert logging.getLogger("broker").level == logging.NOTSET
+        assert logging.getLogger("consumer./a").isEnabledFor(logging.INFO)
+    finally:
+        log.configure("DEBUG")
+
+
+def test_configure_stops_previous_writer():
+    try:
+        log.configure("DEBUG")
+        previous = log._listener
+        thread = previous._thread
+        log.configure("DEBUG")
+        assert previous._thread is None and not thread.is_alive()
+        assert log._listener._thread.is_alive()
+    finally:
+        log.configure("DEBUG")
+
+
+def test_message_log_rate(caplog, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(log.time, "monotonic", lambda: now[0])
+    messages = MessageLog(logging.getLogger("test.messages"), rate=2)
+
+    with caplog.at_level(logging.INFO, logger="test.messages"):
+        for i in range(10):
+            messages.info("message %d", i)
+        now[0] += 1
+        messages.info("message %d", 10)
+        messages.debug("hidden")
+
+    assert [record.getMessage() for record in caplog.records] == [
+        "message 0",
+        "message 1",
+        "message 10 (+8 not logged)",
+    ]
+
+
+def test_message_log_unlimited(caplog):
+    messages = MessageLog(logging.getLogger("test.unlimited"), rate=0)
+    with caplog.at_level(logging.INFO, logger="test.unlimited"):
+        for i in range(100):
+            messages.info("message %d", i)
+    assert len(caplog.records) == 100
@@ -0,0 +1,55 @@
+"""Test the message model and the command tables of CDProto."""
+
+import pytest
+
+from src.consts import Command, Serializer
+from src.protocol import (
+    CDProto,
+    CDProtoBadFormat,
+    PublishMessage,
+    TopicListSuccess,
+    message_types,
+)
+from src.utils import encoder_map
+
+CASES = [
+    (Command.SUBSCRIBE, "/a", None),
+    (Command.PUBLISH, "/a/b", 3.5),
+    (Command.PUBLISH_BATCH, "/a", [1, 2, 3]),
+    (Command.TOPIC_LIST, "", None),
+    (Command.TOPIC_LIST_SUCCESS, "", ["/a", "/a/b"]),
+    (Command.UNSUBSCRIBE, "/a", None),
+]
+
+
+def test_slotted():
+    msg = PublishMessage("/a", 1)
+
+    assert not hasattr(msg, "__dict__")
+    assert msg.to_dict() == {"command": "publish", "topic": "/a", "message": 1}
+    assert set(message_types) == {command.value for command in Command}
+
+
+@pytest.mark.parametrize("serializer", list(Serializer))
+@pytest.mark.parametrize("command, topic, message", CASES)
+def test_roundtrip(serializer, command, topic, message):
+    frame = CDProto.encode_msg(command, serializer, topic, message)
+    msg = CDProto.decode_msg(serializer, memoryview(frame)[4:])
+
+    assert msg.command == command
+    assert msg.to_dict() == CDProto.decode_msg(
+        serializer, encoder_map[serializer].encode(msg.to_dict())
+    ).to_dict()
+    if "topic" in msg.fields:
+        assert msg.topic == topic
+    if isinstance(msg, TopicListSuccess):
+        assert msg.message == message
+
+
+def test_unsupported_command():
+    with pytest.raises(ValueError):
+        CDProto.encode_msg("gossip", Serializer.JSON)
+    with pytest.raises(CDProtoBadFormat):
+        CDProto.decode_msg(Serializer.JSON, b'{"command": "gossip"}')
+    with pytest.raises(CDProtoBadFormat):
+        CDProto.decode_msg(Serializer.JSON, b'{"command": "publish", "topic": "/a"}')
@@ -0,0 +1,69 @@
+"""Test prefetching, timeouts and batched pulls in the middleware Queue."""
+
+import time
+
+import pytest
+
+from src.clients import Consumer
+from src.consts import MiddlewareType
+from src.middleware import JSONQueue, PickleQueue
+
+TOPIC = "/prefetch"
+
+
+@pytest.mark.parametrize("prefetch", [0, 8])
+def test_pull_timeout(broker, prefetch):
+    consumer = JSONQueue(f"{TOPIC}/timeout{prefetch}", prefetch=prefetch)
+
+    started = time.monotonic()
+    assert consumer.pull(timeout=0.1) is None
+    assert consumer.pull_many(10, timeout=0.1) == []
+    assert time.monotonic() - started < 1
+
+
+@pytest.mark.parametrize("prefetch", [0, 8])
+def test_pull_many(broker, prefetch):
+    topic = f"{TOPIC}/many{prefetch}"
+    consumer = PickleQueue(topic, prefetch=prefetch)
+    time.sleep(0.1)
+
+    producer = JSONQueue(topic, MiddlewareType.PRODUCER)
+    producer.push_many(range(5))
+    for i in range(5, 20):
+        producer.push(i)
+    time.sleep(0.1)
+
+    received = []
+    while len(received) < 20:
+        items = consumer.pull_many(6, timeout=1)
+        assert 0 < len(items) <= 6
+        received += [data for _, data in items]
+    assert received == list(range(20))
+
+
+def test_topic_list_is_not_a_message(broker):
+    topic = f"{TOPIC}/list"
+    consumer = JSONQueue(topic)
+    JSONQueue(topic, MiddlewareType.PRODUCER).push(1)
+    time.sleep(0.1)
+
+    consumer.list_topics(lambda: None)
+    JSONQueue(topic, MiddlewareType.PRODUCER).push(2)
+
+    assert consumer.pull(timeout=1) == (topic, 1)
+    assert consumer.pull(timeout=1) == (topic, 2)
+    assert topic in consumer.topics
+
+
+def test_iterate_and_batched_consumer(broker):
+    topic = f"{TOPIC}/batched"
+    consumer = Consumer(topic, JSONQueue, prefetch=16)
+    time.sleep(0.1)
+
+    JSONQueue(topic, MiddlewareType.PRODUCER).push_many(range(50))
+    consumer.run(50, batch_size=16, timeout=1)
+    assert consumer.received == list(range(50))
+
+    JSONQueue(topic, MiddlewareType.PRODUCER).push_many(["a", "b"])
+    iterator = iter(consumer.queue)
+    assert [next(iterator), next(iterator)] == [(topic, "a"), (topic, "b")]
@@ -0,0 +1,97 @@
+"""Test publishes crossing the workers of a sharded broker."""
+
+import time
+
+import pytest
+
+from src.consts import MiddlewareType
+from src.middleware import JSONQueue, PickleQueue
+from src.sharding import ShardedBroker, shard_of
+
+
+@pytest.fixture(scope="module")
+def sharded_broker(serve_broker):
+    return serve_broker(ShardedBroker(2, port=0))
+
+
+def topics_per_shard():
+    """Returns one root topic owned by each of the two workers."""
+    topics = {}
+    i = 0
+    while len(topics) < 2:
+        topics.setdefault(shard_of(f"/shard{i}", 2), f"/shard{i}")
+        i += 1
+    return topics[0], topics[1]
+
+
+def test_publish_reaches_subscribers_on_every_worker(sharded_broker):
+    topics = topics_per_shard()
+    # several connections, so the kernel spreads them over both workers
+    consumers = [JSONQueue(topic) for topic in topics for _ in range(4)] + [
+        PickleQueue("")
+    ]
+    time.sleep(0.2)
+
+    for i, topic in enumerate(topics):
+        for _ in range(2):
+            JSONQueue(f"{topic}/leaf", MiddlewareType.PRODUCER).push(i)
+    time.sleep(0.2)
+
+    for consumer in consumers[:4]:
+        assert [consumer.pull(), consumer.pull()] == [(topics[0], 0)] * 2
+    for consumer in consumers[4:8]:
+        assert [consumer.pull(), consumer.pull()] == [(topics[1], 1)] * 2
+    assert sorted(consumers[8].pull()[1] for _ in range(4)) == [0, 0, 1, 1]
+
+
+def test_retained_value_across_workers(sharded_broker):
+    topic = topics_per_shard()[1] + "/retained"
+    JSONQueue(topic, MiddlewareType.PRODUCER).push("kept")
+    time.sleep(0.2)
+
+    for _ in range(4):
+        assert PickleQueue(topic).pull() == (topic, "kept")
+
+
+def test_wildcards_across_workers(sharded_broker):
+    topics = topics_per_shard()
+    for topic in topics:
+        JSONQueue(f"{topic}/wild/retained", MiddlewareType.PRODUCER).push("kept")
+    time.sleep(0.2)
+
+    consumers = [PickleQueue("/+/wild/#") for _ in range(4)]
+    for consumer in consumers:
+        received = sorted(consumer.pull() for _ in range(2))
+        assert received == sorted(
+            (f"{topic}/wild/retained", "kept") for topic in topics
+        )
+
+    for topic in topics:
+        JSONQueue(f"{topic}/wild/live", MiddlewareType.PRODUCER).push("new")
+    for consumer in consumers:
+        received = sorted(consumer.pull() for _ in range(2))
+        assert received == sorted((f"{topic}/wild/live", "new") for topic in topics)
+
+
+def test_reliable_subscriptions_across_workers(sharded_broker):
+    topics = topics_per_shard()
+    for topic in topics:
+        JSONQueue(f"{topic}/reliable", MiddlewareType.PRODUCER).push("kept")
+    time.sleep(0.2)
+
+    consumers = [
+        JSONQueue(f"{topic}/reliable", client=f"reliable{i}")
+        for topic in topics
+        for i in range(4)
+    ]
+    for consumer in consumers:
+        assert consumer.pull(1) == (consumer.topic, "kept")
+
+    for topic in topics:
+        JSONQueue(f"{topic}/reliable", MiddlewareType.PRODUCER).push("live")
+    for consumer in consumers:
+        assert consumer.pull(1) == (consumer.topic, "live")
+        assert consumer.seq == 2
+        consumer.ack()
+        consumer.cancel()
+        consumer.close()
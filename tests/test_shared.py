@@ -0,0 +1,97 @@
+"""Test queues sharing one connection to the broker."""
+
+import time
+
+from src.clients import Producer
+from src.consts import MiddlewareType
+from src.middleware import JSONQueue, PickleQueue, SharedConnection, XMLQueue
+
+TOPIC = "/shared"
+
+
+def test_one_connection_per_process(broker):
+    before = len(broker._outbox)
+    consumers = [
+        JSONQueue(f"{TOPIC}/a", shared=True),
+        PickleQueue(f"{TOPIC}/a", shared=True),
+        XMLQueue(f"{TOPIC}/b", shared=True),
+        JSONQueue(TOPIC, shared=True),
+    ]
+    producer = Producer(
+        [f"{TOPIC}/a", f"{TOPIC}/b"], lambda: iter([1, 2]), JSONQueue, shared=True
+    )
+    time.sleep(0.1)
+
+    assert len({queue.sock for queue in consumers + producer.queue}) == 1
+    assert len(broker._outbox) == before + 1
+
+    producer.run(1)
+    assert consumers[0].pull(timeout=1) == (f"{TOPIC}/a", 1)
+    assert consumers[1].pull(timeout=1) == (f"{TOPIC}/a", 1)
+    assert consumers[2].pull(timeout=1) == (f"{TOPIC}/b", 2)
+    assert sorted(consumers[3].pull_many(2, timeout=1)) == [(TOPIC, 1), (TOPIC, 2)]
+
+
+def test_subscriptions_are_reference_counted(broker):
+    topic = f"{TOPIC}/refcount"
+    first = JSONQueue(topic, shared=True)
+    second = JSONQueue(topic, shared=True)
+    time.sleep(0.1)
+    connection = SharedConnection.get(JSONQueue.address)
+    assert len(broker.list_subscriptions(topic)) == 1
+
+    first.cancel()
+    time.sleep(0.1)
+    assert len(broker.list_subscriptions(topic)) == 1
+
+    JSONQueue(topic, MiddlewareType.PRODUCER).push("still here")
+    assert second.pull(timeout=1) == (topic, "still here")
+    assert first.pull(timeout=0.1) is None
+
+    second.close()
+    time.sleep(0.1)
+    assert broker.list_subscriptions(topic) == []
+    assert topic not in connection._consumers
+
+
+def test_joining_queue_gets_last_value(broker):
+    topic = f"{TOPIC}/joining"
+    JSONQueue(topic, MiddlewareType.PRODUCER).push("retained")
+    time.sleep(0.1)
+
+    first = JSONQueue(topic, shared=True)
+    assert first.pull(timeout=1) == (topic, "retained")
+    second = JSONQueue(topic, shared=True)
+    assert second.pull(timeout=1) == (topic, "retained")
+
+    pattern = JSONQueue(f"{TOPIC}/+", shared=True)
+    assert pattern.pull(timeout=1) is not None
+    later = JSONQueue(f"{TOPIC}/+", shared=True)
+    assert (topic, "retained") in later.pull_many(10, timeout=0.5)
+    for queue in (first, second, pattern, later):
+        queue.close()
+
+
+def test_overlapping_subscriptions_deliver_once(broker):
+    topic = f"{TOPIC}/overlap"
+    queues = [
+        JSONQueue(topic, shared=True),
+        JSONQueue(f"{topic}/b", shared=True),
+        JSONQueue(f"{topic}/+", shared=True),
+        JSONQueue(f"{topic}/#", shared=True),
+    ]
+    time.sleep(0.1)
+
+    producer = JSONQueue(f"{topic}/b", MiddlewareType.PRODUCER)
+    producer.push(1)
+    JSONQueue(topic, MiddlewareType.PRODUCER).push(2)
+    time.sleep(0.2)
+    received = [queue.pull_many(10, timeout=0.5) for queue in queues]
+    assert received == [
+        [(topic, 1), (topic, 2)],
+        [(f"{topic}/b", 1)],
+        [(f"{topic}/b", 1)],
+        [(f"{topic}/b", 1), (topic, 2)],
+    ]
+    for queue in queues + [producer]:
+        queue.close()
@@ -0,0 +1,81 @@
+"""Test the broker's metrics, the STATS command and the $SYS topics."""
+
+import time
+
+import pytest
+
+from src.broker import Broker
+from src.consts import MiddlewareType
+from src.metrics import Histogram
+from src.middleware import JSONQueue, PickleQueue
+
+
+@pytest.fixture(scope="module")
+def stats_broker(serve_broker):
+    return serve_broker(Broker(port=0, stats_interval=0.1))
+
+
+def test_histogram():
+    histogram = Histogram()
+    for value in range(1, 101):
+        histogram.record(value)
+
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 100
+    assert snapshot["mean"] == 50.5
+    assert snapshot["max"] == 100
+    assert 50 <= snapshot["p50"] <= 63
+    assert snapshot["p99"] == 100
+    assert Histogram().snapshot() == {"count": 0}
+
+
+def test_stats_command(stats_broker):
+    consumer = JSONQueue("/stats/a", MiddlewareType.CONSUMER)
+    other = PickleQueue("/stats", MiddlewareType.CONSUMER)
+    producer = PickleQueue("/stats/a", MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+
+    for i in range(5):
+        producer.push(i)
+    for _ in range(5):
+        consumer.pull(1)
+        other.pull(1)
+
+    consumer.request_stats()
+    time.sleep(0.1)
+    producer.push(5)
+    assert consumer.pull(1) == ("/stats/a", 5)
+    stats = consumer.stats
+
+    assert stats["connections"]["current"] == 3
+    assert stats["messages"]["in"]["PICKLE"] >= 5
+    assert stats["messages"]["out"]["JSON"] >= 5
+    assert stats["messages"]["out"]["PICKLE"] >= 5
+    assert stats["fanout"]["max"] == 2
+    assert stats["subscriptions"] == {"/stats/a": 1, "/stats": 1}
+    assert stats["handling_us"]["publish"]["count"] >= 5
+    assert stats["bytes"]["in"] > 0 and stats["bytes"]["out"] > 0
+
+    for queue in (consumer, other, producer):
+        queue.close()
+
+
+def test_sys_topics(stats_broker):
+    consumer = JSONQueue("$SYS/broker/#", MiddlewareType.CONSUMER)
+    everything = JSONQueue("#", MiddlewareType.CONSUMER)
+
+    received = {}
+    while "$SYS/broker/uptime" not in received:
+        topic, value = consumer.pull(1)
+        received[topic] = value
+
+    assert received["$SYS/broker/uptime"] > 0
+    # "#" gets the retained values of other tests, but no "$" topic
+    item = everything.pull(0.3)
+    while item is not None:
+        assert not item[0].startswith("$")
+        item = everything.pull(0.3)
+    assert "$SYS/broker/uptime" not in stats_broker.list_topics()
+
+    consumer.close()
+    everything.close()
@@ -0,0 +1,83 @@
+"""Test the durable retained-value store and broker restarts."""
+
+import os
+import socket
+
+from src.broker import Broker
+from src.consts import Command, Serializer
+from src.protocol import CDProto
+from src.store import RetainedStore
+
+
+def test_reopen(tmp_path):
+    path = str(tmp_path / "retained")
+    store = RetainedStore(path)
+    store.put("/a", 1)
+    store.put("/a/b", {"x": [1, 2]})
+    store.put("/a", "two")
+    store.close()
+
+    store = RetainedStore(path)
+    assert dict(store.items()) == {"/a": "two", "/a/b": {"x": [1, 2]}}
+    store.close()
+
+
+def test_torn_record(tmp_path):
+    path = str(tmp_path / "retained")
+    store = RetainedStore(path)
+    store.put("/a", 1)
+    store.commit(force=True)
+    offset = store._end
+    store.put("/b", 2)
+    store.close()
+
+    # a crash in the middle of the last record
+    with open(path, "r+b") as file:
+        file.seek(offset + 12)
+        file.write(b"\xff\xff")
+
+    store = RetainedStore(path)
+    assert dict(store.items()) == {"/a": 1}
+    store.put("/c", 3)
+    store.close()
+    assert dict(RetainedStore(path).items()) == {"/a": 1, "/c": 3}
+
+
+def test_compaction(tmp_path):
+    path = str(tmp_path / "retained")
+    store = RetainedStore(path, sync_interval=0, min_compact_size=16 * 1024)
+    for i in range(10000):
+        store.put(f"/topic{i % 10}", "x" * 100 + str(i))
+        store.commit()
+
+    assert store._end < 16 * 1024 * store.compact_ratio
+    store.close()
+    assert os.path.getsize(path) < 256 * 1024
+
+    store = RetainedStore(path)
+    assert len(store) == 10
+    assert store.get("/topic9") == "x" * 100 + "9999"
+    store.close()
+
+
+def test_broker_restart(tmp_path):
+    path = str(tmp_path / "retained")
+    broker = Broker(port=0, store_path=path)
+    broker.publish("/weather/temp", 21)
+    broker.publish_batch("/weather/rain", [1, 2, 3])
+    broker.store.close()
+    broker.socket.close()
+
+    broker = Broker(port=0, store_path=path)
+    assert sorted(broker.list_topics()) == ["/weather/rain", "/weather/temp"]
+    assert broker.get_topic("/weather/rain") == 3
+
+    client, conn = socket.socketpair()
+    broker.subscribe("/weather/temp", conn, Serializer.JSON)
+    msg, _ = CDProto.recv_msg(client)
+    assert (msg.command, msg.message) == (Command.PUBLISH, 21)
+
+    broker.store.close()
+    broker.socket.close()
+    client.close()
+    conn.close()
@@ -0,0 +1,33 @@
+"""Test the per-connection subscription index."""
+
+import socket
+
+from src.broker import Broker, Serializer
+
+
+def test_disconnect_only_touches_own_topics():
+    broker = Broker(port=0)
+    a, b = socket.socketpair()
+    other, other_peer = socket.socketpair()
+    broker.register(a)
+
+    for i in range(100):
+        broker.subscribe(f"/many/{i}", other, Serializer.JSON)
+    broker.subscribe("/mine", a, Serializer.JSON)
+    broker.subscribe("/many/7", a, Serializer.PICKLE)
+
+    assert {node.name for node in broker._subscriptions[a]} == {"/mine", "/many/7"}
+    assert broker.list_subscriptions("/many/7") == [
+        (other, Serializer.JSON),
+        (a, Serializer.PICKLE),
+    ]
+
+    broker.disconnect(a)
+
+    assert a not in broker._subscriptions
+    assert broker.list_subscriptions("/mine") == []
+    assert broker.list_subscriptions("/many/7") == [(other, Serializer.JSON)]
+    assert len(broker._subscriptions[other]) == 100
+
+    for sock in (b, other, other_peer, broker.socket):
+        sock.close()
@@ -0,0 +1,27 @@
+"""Test the hierarchical topic index."""
+from src.topics import TopicTrie
+
+
+def test_lineage():
+    trie = TopicTrie()
+    node = trie.insert("/weather2/temperature/celsius")
+
+    assert [level.name for level in node.lineage()] == [
+        "/weather2/temperature/celsius",
+        "/weather2/temperature",
+        "/weather2",
+        "",
+    ]
+    assert trie.find("/weather2/temperature") is node.parent
+    assert trie.insert("/weather2/temperature/celsius") is node
+
+
+def test_topics_only_lists_values():
+    trie = TopicTrie()
+    trie.insert("/a/b")
+    assert trie.topics() == []
+
+    node = trie.insert("/a")
+    node.value, node.has_value = 0, True
+    assert trie.topics() == ["/a"]
+    assert trie.find("/c") is None
@@ -0,0 +1,145 @@
+"""Test brokers listening on Unix domain sockets, alone or along with TCP."""
+
+import asyncio
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from src import transport
+from src.broker import AsyncBroker, Broker
+from src.consts import MiddlewareType
+from src.middleware import JSONAsyncQueue, JSONQueue, PickleQueue
+
+
+def test_parse():
+    assert transport.parse(("localhost", 5000)) == (socket.AF_INET, ("localhost", 5000))
+    assert transport.parse("tcp://127.0.0.1:5001") == (
+        socket.AF_INET,
+        ("127.0.0.1", 5001),
+    )
+    assert transport.parse("unix:///tmp/broker.sock") == (
+        socket.AF_UNIX,
+        "/tmp/broker.sock",
+    )
+    for address in ("tcp://localhost", "unix://", "udp://localhost:5000"):
+        with pytest.raises(ValueError):
+            transport.parse(address)
+
+
+def _start(broker):
+    thread = threading.Thread(target=broker.run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_unix_and_tcp(tmp_path):
+    path = str(tmp_path / "broker.sock")
+    broker = Broker(port=0, unix_path=path)
+    thread = _start(broker)
+    tcp = "tcp://%s:%d" % broker.socket.getsockname()
+
+    local = JSONQueue("/unix/temp", MiddlewareType.CONSUMER, address=f"unix://{path}")
+    remote = PickleQueue("/unix/temp", MiddlewareType.CONSUMER, address=tcp)
+    time.sleep(0.1)
+
+    producer = PickleQueue(
+        "/unix/temp", MiddlewareType.PRODUCER, address=f"unix://{path}"
+    )
+    producer.push(21)
+    producer.push_many([22, 23])
+
+    assert [local.pull(1) for _ in range(3)] == [
+        ("/unix/temp", v) for v in (21, 22, 23)
+    ]
+    assert [remote.pull(1) for _ in range(3)] == [
+        ("/unix/temp", v) for v in (21, 22, 23)
+    ]
+    assert broker.metrics.connections == 3
+
+    for queue in (local, remote, producer):
+        queue.close()
+    broker.canceled = True
+    # a connection wakes the broker up, so it sees it was canceled
+    producer = JSONQueue("/unix/temp", MiddlewareType.PRODUCER, address=tcp)
+    thread.join(timeout=5)
+    producer.close()
+    assert not os.path.exists(path)
+
+
+def test_unix_only(tmp_path):
+    path = str(tmp_path / "broker.sock")
+    with pytest.raises(ValueError):
+        Broker(port=None)
+
+    broker = Broker(port=None, unix_path=path)
+    assert broker.socket.family == socket.AF_UNIX
+    _start(broker)
+
+    consumer = JSONQueue(
+        "/unix/only", MiddlewareType.CONSUMER, address=f"unix://{path}"
+    )
+    producer = JSONQueue(
+        "/unix/only", MiddlewareType.PRODUCER, address=f"unix://{path}"
+    )
+    time.sleep(0.1)
+    producer.push("hello")
+    assert consumer.pull(1) == ("/unix/only", "hello")
+
+    consumer.close()
+    producer.close()
+    broker.canceled = True
+
+
+def test_async_broker_unix(tmp_path):
+    path = str(tmp_path / "broker.sock")
+    broker = AsyncBroker(port=0, unix_path=path)
+    thread = _start(broker)
+    time.sleep(0.2)
+
+    async def scenario():
+        address = f"unix://{path}"
+        consumer = JSONAsyncQueue("/unix/async", address=address)
+        await consumer.connect()
+        await asyncio.sleep(0.1)
+        producer = JSONAsyncQueue(
+            "/unix/async", MiddlewareType.PRODUCER, address=address
+        )
+        await producer.push(1)
+        received = await consumer.pull()
+        for queue in (consumer, producer):
+            await queue.close()
+        return received
+
+    assert asyncio.run(asyncio.wait_for(scenario(), 5)) == ("/unix/async", 1)
+    broker.canceled = True
+    thread.join(timeout=5)
+    assert not os.path.exists(path)
+
+
+def test_listen_only_replaces_stale_sockets(tmp_path):
+    path = str(tmp_path / "broker.sock")
+    regular = tmp_path / "file"
+    regular.write_text("keep me")
+    with pytest.raises(OSError):
+        transport.listen(f"unix://{regular}")
+    assert regular.read_text() == "keep me"
+
+    live = transport.listen(f"unix://{path}")
+    with pytest.raises(OSError):
+        transport.listen(f"unix://{path}")
+    live.close()
+
+    # nobody listens on the file left behind anymore: it is replaced
+    first = transport.listen(f"unix://{path}")
+    first.close()
+    os.unlink(path)
+    second = transport.listen(f"unix://{path}")
+    # the first owner doesn't remove the socket that replaced its own
+    transport.unlink(path, first)
+    assert os.path.exists(path)
+    second.close()
+    transport.unlink(path, second)
+    assert not os.path.exists(path)
@@ -0,0 +1,74 @@
+"""Test "+" and "#" wildcard subscriptions."""
+
+import time
+
+import pytest
+
+from src.consts import MiddlewareType
+from src.middleware import JSONQueue, PickleQueue
+from src.topics import TopicTrie, topic_matches
+
+TOPIC = "/wild"
+
+
+@pytest.mark.parametrize(
+    "pattern, topic, matches",
+    [
+        ("/+/humidity", "/site1/humidity", True),
+        ("/+/humidity", "/site1/temp", False),
+        ("/+/humidity", "/a/b/humidity", False),
+        ("/site1/#", "/site1", True),
+        ("/site1/#", "/site1/a/b", True),
+        ("#", "/site1/a", True),
+        ("/+", "/site1/a", False),
+        ("/site1/#/a", "/site1/x/a", False),
+    ],
+)
+def test_topic_matches(pattern, topic, matches):
+    assert topic_matches(pattern, topic) == matches
+
+    patterns = TopicTrie()
+    patterns.insert(pattern).subscribers["conn"] = None
+    assert bool(patterns.match(topic)) == matches
+
+    topics = TopicTrie()
+    topics.insert(topic)
+    assert (topic in [node.name for node in topics.expand(pattern)]) == matches
+
+
+def test_match_cost_does_not_depend_on_pattern_count():
+    patterns = TopicTrie()
+    for i in range(1000):
+        patterns.insert(f"/site{i}/+").subscribers["conn"] = None
+    patterns.insert("/+/humidity").subscribers["conn"] = None
+
+    assert [node.name for node in patterns.match("/site7/humidity")] == [
+        "/site7/+",
+        "/+/humidity",
+    ]
+
+
+def test_wildcard_subscribers(broker):
+    producer = JSONQueue(f"{TOPIC}/site1/humidity", MiddlewareType.PRODUCER)
+    producer.push(60)
+    time.sleep(0.1)
+
+    humidity = PickleQueue(f"{TOPIC}/+/humidity")
+    everything = JSONQueue(f"{TOPIC}/#", shared=True)
+    # retained values of every matching topic
+    assert humidity.pull(timeout=1) == (f"{TOPIC}/site1/humidity", 60)
+    assert everything.pull(timeout=1) == (f"{TOPIC}/site1/humidity", 60)
+
+    JSONQueue(f"{TOPIC}/site2/humidity", MiddlewareType.PRODUCER).push(70)
+    JSONQueue(f"{TOPIC}/site2/temp", MiddlewareType.PRODUCER).push(20)
+
+    assert humidity.pull(timeout=1) == (f"{TOPIC}/site2/humidity", 70)
+    assert humidity.pull(timeout=0.2) is None
+    assert everything.pull_many(2, timeout=1) == [
+        (f"{TOPIC}/site2/humidity", 70),
+        (f"{TOPIC}/site2/temp", 20),
+    ]
+
+    humidity.cancel()
+    time.sleep(0.1)
+    assert broker.list_subscriptions(f"{TOPIC}/+/humidity") == []
@@ -0,0 +1,31 @@
+"""Test the XML codec keeps types and stays compatible with ElementTree peers."""
+
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from src.utils import XmlUtils
+
+
+@pytest.mark.parametrize(
+    "value", ["a\"<b> & 'c'\n", 42, 2.5, None, True, [1, "x", None], b"\x00\x01"]
+)
+def test_types_preserved(value):
+    message = {"command": "publish", "topic": "/xml", "message": value}
+
+    assert XmlUtils.decode(XmlUtils.encode(message)) == message
+
+
+def test_elementtree_peers():
+    old = ET.tostring(
+        ET.Element("message", {"command": "publish", "topic": "/t&", "message": "4"})
+    )
+    assert XmlUtils.decode(old) == {
+        "command": "publish",
+        "topic": "/t&",
+        "message": "4",
+    }
+
+    new = XmlUtils.encode({"command": "publish", "topic": "/t&", "message": 4})
+    assert ET.XML(new).attrib["topic"] == "/t&"
+    assert ET.XML(new).attrib["message"] == "4"